@@ -5,13 +5,23 @@
 nj=20
 cmd="queue.pl"
 analyze_transitions=false
+transition_width=1  # Frames on either side of a phone boundary counted as transition
 only_combine=false
 shifts='0'
+exclude_wrap=false  # Do not count frames whose shifted features wrap around the utterance
 conf_file=
 add_opts=""
 add_opts_minmax=""
 find_range=true
 frequency_scaling=
+num_bins=100
+binning=global  # global, per_dim or quantile bin edges
+bin_codes=  # Bin code store, written on the first run and read instead of the features once complete
+streaming=false  # Single pass over the features, bin edges are fixed when combining the dumps
+num_workers=1  # Worker processes per job, e.g. --nj 1 --num_workers 64 on a single big node
+mi_opts=""  # Options for compute_mi.py, e.g. "--bias_correction=miller_madow --num_bootstrap=200"
+knn_mi=false  # Also estimate the MI with the kNN estimator on a sample of frames, as a cross-check
+knn_opts=""  # Options for compute_knn_mi.py, e.g. "--max_frames=50000 --dim_groups=0-9,10-19"
 
 . parse_options.sh || exit 1;
 
@@ -23,6 +33,10 @@ if [ ! -z ${conf_file} ] ; then
   source ${conf_file}
 fi
 
+if $streaming && [ ! -z ${bin_codes} ]; then
+  echo "$0: bin_codes needs fixed bin edges, it cannot be used with streaming=true"; exit 1;
+fi
+
 if [ ! -z ${frequency_scaling} ] ; then
   add_opts_minmax="${add_opts_minmax} --frequency_scaling=$frequency_scaling"
 fi
@@ -41,11 +55,57 @@ mkdir -p $out_dir
 log_dir=`realpath ${log_dir}`
 feat_size=`feat-to-dim scp:$scp -`
 
+if $exclude_wrap; then
+  add_opts="$add_opts --exclude_wrap"
+fi
+
 if $analyze_transitions; then 
-  add_opts="$add_opts --analyze_transitions"
+  add_opts="$add_opts --analyze_transitions --transition_width=${transition_width}"
+fi
+
+minmax_ali=$out_dir/minmax.ali.mnx
+minmax_feat=$out_dir/minmax.feat.mnx
+if $streaming; then
+  # No separate min-max pass over the features is needed
+  find_range=false
+  add_opts="$add_opts --streaming"
+  minmax_ali=-
+  minmax_feat=-
+fi
+
+if [ "$binning" != global ]; then
+  # Per dimension range and fine histogram of the features for the bin edges
+  add_opts_minmax="${add_opts_minmax} --num_fine_bins=1024"
+fi
+
+# Read or write the bin codes is decided here once, the jobs must not see a store that is still being written
+write_bin_codes=false
+if [ ! -z ${bin_codes} ] ; then
+  if [ -f ${bin_codes}/complete ]; then
+    add_opts="$add_opts --read_bin_codes=${bin_codes}"
+    if [ -f $minmax_ali ]; then
+      # The features are not read again, the label range of the run that wrote the codes is kept
+      find_range=false
+    fi
+  else
+    write_bin_codes=true
+    add_opts="$add_opts --write_bin_codes=${bin_codes}"
+  fi
 fi
 
 if ! $only_combine; then
+  # Decode the alignments once into a run-length encoded store, every job loads only its utterances from it
+  ali_store=$out_dir/ali_store
+  if [ ! -f $ali_store/index ]; then
+    echo "$0: Converting alignments to $ali_store"
+    $cmd --mem 4G --num-threads $num_workers JOB=1 \
+      $log_dir/alignment_store.JOB.log \
+      alignment_store.py \
+        --num_workers=$num_workers \
+        $ali_dir \
+        $ali_store || exit 1;
+  fi
+
   if ${find_range}; then
     ## Divide the data and compute MI for each part
     echo "$0: Computing min-max of all features"
@@ -54,7 +114,7 @@ if ! $only_combine; then
       $log_dir/getminmax.JOB.log \
        compute_minmax.py \
        $scp \
-       $ali_dir \
+       $ali_store \
        $out_dir/minmax ${add_opts_minmax}\
        --feat_size=$feat_size \
        --make_absolute=True || exit 1 ;
@@ -67,24 +127,75 @@ if ! $only_combine; then
 
   utils/split_scp.pl $scp $split_scp || exit 1;
 
+  if $write_bin_codes; then
+    # Parts left by an interrupted run
+    rm -f ${bin_codes}/*.codes ${bin_codes}/*.index ${bin_codes}/*.tmp ${bin_codes}/edges.npz
+  fi
+
   echo "$0: Computing MI"
   echo "$0: Log file can be found in $log_dir/compute_MI.*.log"
 
-  $cmd --mem 10G JOB=1:$nj \
+  $cmd --mem 10G --num-threads $num_workers JOB=1:$nj \
     $log_dir/compute_MI.JOB.log \
     compute_signal_label_confusion_matrix.py \
       $log_dir/feats.JOB.scp \
-      $ali_dir \
-      $out_dir/minmax.ali.mnx \
-      $out_dir/minmax.feat.mnx \
+      $ali_store \
+      $minmax_ali \
+      $minmax_feat \
       $out_dir/MI_${name}.JOB $add_opts \
       --feat_size=$feat_size \
+      --num_workers=$num_workers \
+      --num_bins=$num_bins \
+      --binning=$binning \
       --shifts=$shifts|| exit 1 ;
+
+  if $write_bin_codes; then
+    bin_codes.py ${bin_codes} || exit 1;
+  fi
 fi
 
 # Combine all the MI data
 
-$cmd --mem 2G JOB=1 \
+$cmd --mem 2G --num-threads $num_workers JOB=1 \
   $log_dir/combine_histogram_dumps.JOB.log \
   combine_histogram_dumps.py \
+    --prefix=MI_${name} \
+    --num_jobs=$nj \
+    --num_workers=$num_workers \
+    --num_bins=$num_bins \
+    --binning=$binning \
+    --write_legacy \
     $out_dir || exit 1;
+
+# Mutual information table per shift and feature dimension
+
+$cmd --mem 2G JOB=1 \
+  $log_dir/compute_mi.JOB.log \
+  compute_mi.py \
+    --prefix=MI_${name} \
+    --num_jobs=$nj ${mi_opts} \
+    $out_dir/combined.hist.npz \
+    $out_dir/MI_${name}.txt || exit 1;
+
+echo "$0: MI table written to $out_dir/MI_${name}.txt"
+
+if $knn_mi; then
+  knn_add_opts=""
+  if $analyze_transitions; then
+    knn_add_opts="--analyze_transitions --transition_width=${transition_width}"
+  fi
+  if $exclude_wrap; then
+    knn_add_opts="$knn_add_opts --exclude_wrap"
+  fi
+  $cmd --mem 8G --num-threads $num_workers JOB=1 \
+    $log_dir/compute_knn_mi.JOB.log \
+    compute_knn_mi.py \
+      --feat_size=$feat_size \
+      --num_workers=$num_workers \
+      --shifts=$shifts ${knn_add_opts} ${knn_opts} \
+      $scp \
+      $out_dir/ali_store \
+      $out_dir/MI_${name}.knn.txt || exit 1;
+
+  echo "$0: kNN MI table written to $out_dir/MI_${name}.knn.txt"
+fi
@@ -6,7 +6,7 @@
 
 nj=100
 cmd=queue.pl
-add_reverb=
+add_reverb=  # e.g. small_room, large_room, an RIR wav file, a directory of RIRs or a comma separated list
 overlap_fraction=0.5
 fduration=1.5
 srate=16000
@@ -40,8 +40,10 @@ fi
 log_dir=$data_dir/log
 
 add_opts=""
+reverb_name=
 if [ ! -z ${add_reverb} ] ; then
   add_opts="${add_opts} --add_reverb=${add_reverb}"
+  reverb_name=`echo ${add_reverb} | tr ',/' '__'`
 fi
 
 if [ ! -z ${append_time} ] ; then
@@ -63,7 +65,7 @@ echo "$0: Computing average spectral features for scp files..."
 
 if $add_segment; then
   $cmd --mem 10G -l 'ram_free=10G' JOB=1:$nj \
-  $log_dir/acc_spectrum_${name}_${add_reverb}.JOB.log \
+  $log_dir/acc_spectrum_${name}_${reverb_name}.JOB.log \
   ${exec_file}  \
     $data_dir/split${nj}/JOB/wav.scp \
     $feat_dir/avg_spectrum_${name}.JOB.pkl ${add_opts} \
@@ -75,7 +77,7 @@ if $add_segment; then
 
 elif ${no_split}; then
    $cmd --mem 10G -l 'ram_free=10G' --mem 5G JOB=1 \
-    $log_dir/acc_spectrum_${name}_${add_reverb}.JOB.log \
+    $log_dir/acc_spectrum_${name}_${reverb_name}.JOB.log \
     ${exec_file} \
       $data_dir/wav.scp \
       $feat_dir/avg_spectrum_${name}.JOB.pkl ${add_opts} \
@@ -87,7 +89,7 @@ elif ${no_split}; then
 else
 
   $cmd --mem 10G -l 'ram_free=10G' --mem 5G JOB=1:$nj \
-    $log_dir/acc_spectrum_${name}_${add_reverb}.JOB.log \
+    $log_dir/acc_spectrum_${name}_${reverb_name}.JOB.log \
     ${exec_file} \
       $data_dir/split${nj}/JOB/wav.scp \
       $feat_dir/avg_spectrum_${name}.JOB.pkl ${add_opts} \
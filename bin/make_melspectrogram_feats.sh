@@ -14,12 +14,20 @@ cmd=queue.pl
 add_opts=
 src_dir='../../src'
 spectrum_type=log
-add_noise=clean
+add_noise=clean # Comma separated noise types from noise_dir, white or clean, e.g. babble,white
+snrs=10 # Comma separated SNRs, features are written for every noise type and SNR
+noise_dir=noises
+noise_seed=0
 add_reverb=clean
 fbank_type="mel,1"
 write_utt2num_frames=false
 check_for_segment="data/train" # Check this data directory for pre-computed segment files
 derivative_signal=false
+fast=false # float32 real-FFT path with a sparse filter bank
+batch_mem_mb=0 # Memory budget in MB for batching frames of several utterances, e.g. 4
+fbank_cache_dir= # Filter banks are built once and shared by all jobs, e.g. exp/fbank_cache
+num_decode_workers=1 # Number of wav.scp entries decoded concurrently per job
+audio_cache_dir= # Cache decoded piped/segment audio here to reuse it across feature configurations
 
 conf_file=
 
@@ -56,6 +64,68 @@ if ${derivative_signal}; then
     add_opts="$add_opts --derivative"
 fi
 
+if ${fast}; then
+    add_opts="$add_opts --fast"
+fi
+
+if [ ${batch_mem_mb} != 0 ] ; then
+    add_opts="$add_opts --batch_mem_mb=${batch_mem_mb}"
+fi
+
+if [ ! -z ${fbank_cache_dir} ] ; then
+    add_opts="$add_opts --fbank_cache_dir=${fbank_cache_dir}"
+fi
+
+if [ ${num_decode_workers} -gt 1 ] ; then
+    add_opts="$add_opts --num_decode_workers=${num_decode_workers}"
+fi
+
+if [ ! -z ${audio_cache_dir} ] ; then
+    add_opts="$add_opts --audio_cache_dir=${audio_cache_dir}"
+fi
+
+# Noise conditions, the features of condition <c> go to feats_<c>.scp
+conditions=""
+if [ "${add_noise}" != "clean" ] ; then
+    add_opts="$add_opts --add_noise=${add_noise} --snrs=${snrs} --noise_dir=${noise_dir} --noise_seed=${noise_seed}"
+    for noise in `echo ${add_noise} | tr ',' ' '`; do
+        if [ ${noise} == "clean" ] ; then
+            conditions="$conditions clean"
+        else
+            for snr in `echo ${snrs} | tr ',' ' '`; do
+                conditions="$conditions ${noise}_snr${snr}"
+            done
+        fi
+    done
+fi
+
+# Concatenate the scp and length files of all jobs
+combine_feats() {
+    if [ -z "${conditions}" ] ; then
+        for n in $(seq $nj); do
+          cat $feat_dir/melspec_$name.$n.scp || exit 1;
+        done > $data_dir/feats.scp
+
+        if $write_utt2num_frames; then
+            for n in $(seq $nj); do
+              cat $feat_dir/melspec_$name.$n.len || exit 1;
+            done > $data_dir/utt2num_frames
+        fi
+    else
+        for c in $conditions; do
+            for n in $(seq $nj); do
+              cat $feat_dir/melspec_$name.$c.$n.scp || exit 1;
+            done > $data_dir/feats_$c.scp
+
+            if $write_utt2num_frames; then
+                for n in $(seq $nj); do
+                  cat $feat_dir/melspec_$name.$c.$n.len || exit 1;
+                done > $data_dir/utt2num_frames_$c
+            fi
+        done
+    fi
+}
+
 # split files
 
 echo $0": Splitting segment OR scp files for parallalization..."
@@ -107,19 +177,10 @@ if [ -f $segment ]; then
     --frate=$frate  || exit 1
 
 
-    for n in $(seq $nj); do
-      cat $feat_dir/melspec_$name.$n.scp || exit 1;
-    done > $data_dir/feats.scp
+    combine_feats || exit 1;
 
     rm $log_dir/segments.*
 
-    # concatenate all length files together
-    if $write_utt2num_frames; then
-        for n in $(seq $nj); do
-          cat $feat_dir/melspec_$name.$n.len || exit 1;
-        done > $data_dir/utt2num_frames
-    fi
-
 elif [ -f $scp ]; then
 
   echo "$0: Splitting scp files..."
@@ -148,21 +209,12 @@ elif [ -f $scp ]; then
         --fbank_type=$fbank_type \
         --frate=$frate  || exit 1
 
-    # concatenate all scp files together
+    # concatenate all scp and length files together
 
-    for n in $(seq $nj); do
-      cat $feat_dir/melspec_$name.$n.scp || exit 1;
-    done > $data_dir/feats.scp
+    combine_feats || exit 1;
 
     rm $log_dir/wav_${name}.*.scp
 
-    # concatenate all length files together
-    if $write_utt2num_frames; then
-        for n in $(seq $nj); do
-          cat $feat_dir/melspec_$name.$n.len || exit 1;
-        done > $data_dir/utt2num_frames
-    fi
-
 else
   echo "$0: Neither scp file nor segment file exists... something is wrong!"
   exit 1;
@@ -21,6 +21,12 @@ add_opts=
 
 write_utt2num_frames=false
 derivative_signal=false
+num_decode_workers=1 # Number of wav.scp entries decoded concurrently per job
+audio_cache_dir= # Cache decoded piped/segment audio here to reuse it across feature configurations
+add_noise=clean # Comma separated noise types from noise_dir, white or clean, e.g. babble,white
+snrs=10 # Comma separated SNRs, features are written for every noise type and SNR
+noise_dir=noises
+noise_seed=0
 
 conf_file=
 
@@ -61,6 +67,29 @@ if [ ! -z ${lifter_file} ] ; then
   add_opts="$add_opts --lifter_file=${lifter_file}"
 fi
 
+if [ ${num_decode_workers} -gt 1 ] ; then
+  add_opts="$add_opts --num_decode_workers=${num_decode_workers}"
+fi
+
+if [ ! -z ${audio_cache_dir} ] ; then
+  add_opts="$add_opts --audio_cache_dir=${audio_cache_dir}"
+fi
+
+# Noise conditions, the features of condition <c> go to feats_<c>.scp
+conditions=""
+if [ "${add_noise}" != "clean" ] ; then
+  add_opts="$add_opts --add_noise=${add_noise} --snrs=${snrs} --noise_dir=${noise_dir} --noise_seed=${noise_seed}"
+  for noise in `echo ${add_noise} | tr ',' ' '`; do
+    if [ ${noise} == "clean" ] ; then
+      conditions="$conditions clean"
+    else
+      for snr in `echo ${snrs} | tr ',' ' '`; do
+        conditions="$conditions ${noise}_snr${snr}"
+      done
+    fi
+  done
+fi
+
 echo $0": Splitting scp files for parallalization..."
 
 split_scp=""
@@ -94,17 +123,33 @@ echo "$0: Computing modulation features for scp files..."
 
   # concatenate all scp files together
 
-  for n in $(seq $nj); do
-    cat $feat_dir/modspec_$name.$n.scp || exit 1;
-  done > $data_dir/feats.scp
+  if [ -z "${conditions}" ] ; then
+    for n in $(seq $nj); do
+      cat $feat_dir/modspec_$name.$n.scp || exit 1;
+    done > $data_dir/feats.scp
+  else
+    for c in $conditions; do
+      for n in $(seq $nj); do
+        cat $feat_dir/modspec_$name.$c.$n.scp || exit 1;
+      done > $data_dir/feats_$c.scp
+    done
+  fi
 
   rm $log_dir/wav_${name}.*.scp
 
   # concatenate all length files together
   if $write_utt2num_frames; then
+    if [ -z "${conditions}" ] ; then
       for n in $(seq $nj); do
         cat $feat_dir/modspec_$name.$n.len || exit 1;
       done > $data_dir/utt2num_frames
+    else
+      for c in $conditions; do
+        for n in $(seq $nj); do
+          cat $feat_dir/modspec_$name.$c.$n.len || exit 1;
+        done > $data_dir/utt2num_frames_$c
+      done
+    fi
   fi
 
 
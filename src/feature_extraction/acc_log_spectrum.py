@@ -6,12 +6,10 @@ Author: samiksadhu, Johns Hopkins University
 """
 
 import numpy as np
-from utils import get_kaldi_ark, addReverb, addReverb_nodistortion
-from scipy.io.wavfile import read
-import subprocess
+from rir_bank import RirBank
+from audio_source import add_audio_args, open_audio_cache, get_audio_reader
 import argparse
 import sys
-import io
 from fdlp.fdlp import FDLP
 import pickle as pkl
 import logging
@@ -26,8 +24,11 @@ def get_args():
     parser.add_argument('--overlap_fraction', type=float, default=0.15, help='Overlap fraction for overlap-add')
     parser.add_argument('--srate', type=int, default=16000, help='Sampling rate of the signal')
     parser.add_argument('--append_len', type=int, default=1000000, help='Append zeros to make signal this long')
-    parser.add_argument('--add_reverb', help='input "clean" OR "small_room" OR "large_room"')
+    parser.add_argument('--add_reverb', default='clean',
+                        help='Comma separated list of "clean", "small_room", "large_room", RIR wav files or '
+                             'directories of RIR wav files, one output file <outfile>.<rir>.pkl per RIR if several')
     parser.add_argument('--speech_type', default='clean', type=str, help="'clean' OR 'reverb'")
+    add_audio_args(parser)
 
     return parser.parse_args()
 
@@ -36,84 +37,46 @@ def compute_modulations(args):
     # Define FDLP class
     feat_model = FDLP(fduration=args.fduration, overlap_fraction=args.overlap_fraction, srate=args.srate)
 
-    acc_dct = np.zeros(args.append_len)
-    acc_dst = np.zeros(args.append_len)
-    count = 0
-
-    with open(args.scp, 'r') as fid:
-
-        add_reverb = args.add_reverb
-        if add_reverb:
-            if add_reverb == 'small_room':
-                sr_r, rir = read('./RIR/RIR_SmallRoom1_near_AnglA.wav')
-                rir = rir[:, 0]
-                rir = rir / np.power(2, 15)
-            elif add_reverb == 'large_room':
-                sr_r, rir = read('./RIR/RIR_LargeRoom1_far_AnglA.wav')
-                rir = rir[:, 0]
-                rir = rir / np.power(2, 15)
-            elif add_reverb == 'clean':
-                print('%s: No reverberation added!' % sys.argv[0])
+    # Accumulators per reverberation condition
+    rir_bank = RirBank(args.add_reverb)
+    if rir_bank.names == ['clean']:
+        print('%s: No reverberation added!' % sys.argv[0])
+    acc_dct = {name: np.zeros(args.append_len) for name in rir_bank.names}
+    acc_dst = {name: np.zeros(args.append_len) for name in rir_bank.names}
+    count = {name: 0 for name in rir_bank.names}
+
+    audio_cache = open_audio_cache(args)
+
+    for uttid, sr, signal in get_audio_reader(args, audio_cache, scale=True):
+        print('%s: Computing Features for file: %s' % (sys.argv[0], uttid))
+        sys.stdout.flush()
+
+        if signal is None:
+            continue
+        if args.scp_type == 'wav':
+            assert sr == args.srate, 'Input file has different sampling rate.'
+
+        for name, signal_rev, idx_shift in rir_bank.apply(signal):
+            if args.speech_type == 'clean':
+                #signal = np.concatenate([np.zeros(idx_shift), signal])
+                sig_out = np.concatenate([signal, np.zeros(signal_rev.shape[0] - signal.shape[0])])
+            elif args.speech_type == 'reverb':
+                sig_out = signal_rev
             else:
-                raise ValueError('Invalid type of reverberation!')
-
-        for line in fid:
-
-            tokens = line.strip().split()
-            uttid, inwav = tokens[0], ' '.join(tokens[1:])
-
-            print('%s: Computing Features for file: %s' % (sys.argv[0], uttid))
-            sys.stdout.flush()
-
-            if args.scp_type == 'wav':
-                if inwav[-1] == '|':
-                    try:
-                        proc = subprocess.run(inwav[:-1], shell=True, stdout=subprocess.PIPE)
-                        sr, signal = read(io.BytesIO(proc.stdout))
-                        skip_rest = False
-                    except Exception:
-                        skip_rest = True
-                else:
-                    try:
-                        sr, signal = read(inwav)
-                        skip_rest = False
-                    except Exception:
-                        skip_rest = True
-
-                assert sr == args.srate, 'Input file has different sampling rate.'
-            elif args.scp_type == 'segment':
-                try:
-                    cmd = 'wav-copy ' + inwav + ' - '
-                    proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
-                    sr, signal = read(io.BytesIO(proc.stdout))
-                    skip_rest = False
-                except Exception:
-                    skip_rest = True
-            else:
-                raise ValueError('Invalid type of scp type, it should be either wav or segment')
-            signal = signal / np.power(2, 15)
-
-            if not skip_rest:
-                if add_reverb:
-                    if not add_reverb == 'clean':
-                        signal_rev, idx_shift = addReverb_nodistortion(signal, rir)
-                    if args.speech_type == 'clean':
-                        #signal = np.concatenate([np.zeros(idx_shift), signal])
-                        signal = np.concatenate([signal, np.zeros(signal_rev.shape[0] - signal.shape[0])])
-                        sig_out = signal
-                    elif args.speech_type == 'reverb':
-                        sig_out = signal_rev
-                    else:
-                        raise ValueError("speech_type can only be 'clean' or 'reverb'")
-
-                cc, dct_sum, dst_sum = feat_model.acc_log_spectrum(sig_out, append_len=args.append_len)
-                if cc is not None:
-                    acc_dct += dct_sum
-                    acc_dst += dst_sum
-                    count += cc
-                    print('%s:Extracted %d frames for file: %s' % (sys.argv[0], cc, uttid))
-
-    pkl.dump({'count': count, 'acc_dct': acc_dct, 'acc_dst': acc_dst}, open(args.outfile, 'wb'))
+                raise ValueError("speech_type can only be 'clean' or 'reverb'")
+
+            cc, dct_sum, dst_sum = feat_model.acc_log_spectrum(sig_out, append_len=args.append_len)
+            if cc is not None:
+                acc_dct[name] += dct_sum
+                acc_dst[name] += dst_sum
+                count[name] += cc
+                print('%s:Extracted %d frames for file: %s (%s)' % (sys.argv[0], cc, uttid, name))
+
+    if audio_cache:
+        audio_cache.close()
+    for name in rir_bank.names:
+        pkl.dump({'count': count[name], 'acc_dct': acc_dct[name], 'acc_dst': acc_dst[name]},
+                 open(rir_bank.outfile(args.outfile, name), 'wb'))
 
 
 if __name__ == '__main__':
@@ -6,16 +6,13 @@ Author: samiksadhu, Johns Hopkins University
 """
 
 import numpy as np
-from utils import get_kaldi_ark, addReverb, addReverb_nodistortion
-from scipy.io.wavfile import read
-import subprocess
+from rir_bank import RirBank
 import argparse
 import sys
-import io
 from fdlp.fdlp import FDLP
 import pickle as pkl
 import logging
-from kaldiio import ReadHelper
+from audio_source import add_audio_args, open_audio_cache, get_audio_reader
 
 
 def get_args():
@@ -30,7 +27,10 @@ def get_args():
     parser.add_argument('--overlap_fraction', type=float, default=0.15, help='Overlap fraction for overlap-add')
     parser.add_argument('--srate', type=int, default=16000, help='Sampling rate of the signal')
     parser.add_argument('--append_len', type=int, default=1000000, help='Append zeros to make signal this long')
-    parser.add_argument('--add_reverb', default=None, help='location of the RIR file')
+    parser.add_argument('--add_reverb', default=None,
+                        help='Comma separated list of RIR wav files, directories of RIR wav files, "small_room", '
+                             '"large_room" or "clean", one output file <outfile>.<rir>.pkl per RIR if several')
+    add_audio_args(parser)
 
     return parser.parse_args()
 
@@ -39,18 +39,28 @@ def compute_modulations(args):
     # Define FDLP class
     feat_model = FDLP(fduration=args.fduration, overlap_fraction=args.overlap_fraction, srate=args.srate)
 
-    acc_logmag = np.zeros(args.append_len)
-    acc_phase = np.zeros(args.append_len)
-    count = 0
-
-    # Load reverberation files if provided
-    add_reverb = args.add_reverb
-    if add_reverb is not None:
-        sr_r, rir = read(add_reverb)
-        rir = rir[:, 0]
-        rir = rir / np.power(2, 15)
-    else:
+    # Accumulators per reverberation condition, the RIRs are loaded once
+    rir_bank = RirBank(args.add_reverb)
+    if rir_bank.names == ['clean']:
         print('%s: No reverberation added!' % sys.argv[0])
+    acc_logmag = {name: np.zeros(args.append_len) for name in rir_bank.names}
+    acc_phase = {name: np.zeros(args.append_len) for name in rir_bank.names}
+    count = {name: 0 for name in rir_bank.names}
+
+    def accumulate(sig):
+        for name, sig_rev, idx_shift in rir_bank.apply(sig):
+            # add reverberation
+            sig_rev = sig_rev[0:sig.shape[0]]
+            if args.use_frames:
+                cc, logmag, phase = feat_model.acc_log_spectrum_fft_frames(sig_rev, append_len=args.append_len,
+                                                                           discont=np.pi)
+            else:
+                cc, logmag, phase = feat_model.acc_log_spectrum_fft(sig_rev, append_len=args.append_len,
+                                                                    discont=np.pi)
+            if cc is not None:
+                acc_logmag[name] += logmag
+                acc_phase[name] += phase
+                count[name] += cc
 
     if args.append_time is not None:
         wavfile = np.zeros(1)
@@ -60,114 +70,34 @@ def compute_modulations(args):
         county = 0
 
     # Feature extraction
-    if args.segment_file is None:
-        with ReadHelper('scp:' + args.scp) as reader:
-            for key, (rate, signal) in reader:
-                if args.append_time is not None:
-                    if time <= time_limit:
-                        wavfile = np.concatenate([wavfile, np.zeros(int(args.fduration * args.srate/4))])
-                        wavfile = np.concatenate([wavfile, signal])
-                        time += signal.shape[0] / args.srate
-                    else:
-                        county += 1
-                        # add reverberation
-                        if add_reverb is not None:
-                            L = wavfile.shape[0]
-                            wavfile, idx_shift = addReverb_nodistortion(wavfile, rir)
-                            wavfile = wavfile[0:L]
-                        print('%s: Computing Features appended speech file number: %d, duration: %f seconds' % (
-                            sys.argv[0], county, wavfile.shape[0] / 16000))
-                        sys.stdout.flush()
-                        if args.use_frames:
-                            cc, logmag, phase = feat_model.acc_log_spectrum_fft_frames(wavfile,
-                                                                                       append_len=args.append_len,
-                                                                                       discont=np.pi)
-                        else:
-                            cc, logmag, phase = feat_model.acc_log_spectrum_fft(wavfile, append_len=args.append_len,
-                                                                                discont=np.pi)
-                        if cc is not None:
-                            acc_logmag += logmag
-                            acc_phase += phase
-                            count += cc
-
-                        wavfile = np.zeros(1)
-                        time = 0
-                else:
-                    print('%s: Computing Features for file: %s' % (sys.argv[0], key))
-                    sys.stdout.flush()
-                    # add reverberation
-                    if add_reverb is not None:
-                        L = signal.shape[0]
-                        signal, idx_shift = addReverb_nodistortion(signal, rir)
-                        signal = signal[0:L]
-
-                    if args.use_frames:
-                        cc, logmag, phase = feat_model.acc_log_spectrum_fft_frames(signal, append_len=args.append_len,
-                                                                                   discont=np.pi)
-                    else:
-                        cc, logmag, phase = feat_model.acc_log_spectrum_fft(signal, append_len=args.append_len,
-                                                                            discont=np.pi)
-
-                    if cc is not None:
-                        acc_logmag += logmag
-                        acc_phase += phase
-                        count += cc
-    else:
-        with ReadHelper('scp:' + args.scp, segments=args.segment_file) as reader:
-            for key, (rate, signal) in reader:
-
-                if args.append_time is not None:
-                    if time <= time_limit:
-                        wavfile = np.concatenate([wavfile, np.zeros(int(args.fduration * args.srate/4))])
-                        wavfile = np.concatenate([wavfile, signal])
-                        time += signal.shape[0] / args.srate
-                    else:
-                        county += 1
-                        sys.stdout.flush()
-                        # add reverberation
-                        L = wavfile.shape[0]
-                        if add_reverb is not None:
-                            wavfile, idx_shift = addReverb_nodistortion(wavfile, rir)
-                            wavfile = wavfile[0:L]
-                        print('%s: Computing Features appended speech file number: %d, duration: %f seconds' % (
-                            sys.argv[0], county, wavfile.shape[0] / 16000))
-                        if args.use_frames:
-                            cc, logmag, phase = feat_model.acc_log_spectrum_fft_frames(wavfile,
-                                                                                       append_len=args.append_len,
-                                                                                       discont=np.pi)
-                        else:
-                            cc, logmag, phase = feat_model.acc_log_spectrum_fft(wavfile, append_len=args.append_len,
-                                                                                discont=np.pi)
-
-                        if cc is not None:
-                            acc_logmag += logmag
-                            acc_phase += phase
-                            count += cc
-                        wavfile = np.zeros(1)
-                        time = 0
-                else:
-                    print('%s: Computing Features for file: %s' % (sys.argv[0], key))
-                    sys.stdout.flush()
-                    # add reverberation
-                    if add_reverb is not None:
-                        L = signal.shape[0]
-                        signal, idx_shift = addReverb_nodistortion(signal, rir)
-                        signal = signal[0:L]
-
-                    if args.use_frames:
-                        cc, logmag, phase = feat_model.acc_log_spectrum_fft_frames(signal, append_len=args.append_len,
-                                                                                   discont=np.pi)
-                    else:
-                        cc, logmag, phase = feat_model.acc_log_spectrum_fft(signal, append_len=args.append_len,
-                                                                            discont=np.pi)
-
-                    if cc is not None:
-                        acc_logmag += logmag
-                        acc_phase += phase
-                        count += cc
-
-    pkl.dump({'count': count, 'acc_logmag': acc_logmag, 'acc_phase': acc_phase}, open(args.outfile, 'wb'))
-
+    audio_cache = open_audio_cache(args)
+    for key, rate, signal in get_audio_reader(args, audio_cache):
+        if signal is None:
+            continue
+        if args.append_time is not None:
+            if time <= time_limit:
+                wavfile = np.concatenate([wavfile, np.zeros(int(args.fduration * args.srate/4))])
+                wavfile = np.concatenate([wavfile, signal])
+                time += signal.shape[0] / args.srate
+            else:
+                county += 1
+                print('%s: Computing Features appended speech file number: %d, duration: %f seconds' % (
+                    sys.argv[0], county, wavfile.shape[0] / 16000))
+                sys.stdout.flush()
+                accumulate(wavfile)
+
+                wavfile = np.zeros(1)
+                time = 0
+        else:
+            print('%s: Computing Features for file: %s' % (sys.argv[0], key))
+            sys.stdout.flush()
+            accumulate(signal)
+
+    if audio_cache:
+        audio_cache.close()
+    for name in rir_bank.names:
+        pkl.dump({'count': count[name], 'acc_logmag': acc_logmag[name], 'acc_phase': acc_phase[name]},
+                 open(rir_bank.outfile(args.outfile, name), 'wb'))
 
 if __name__ == '__main__':
     args = get_args()
@@ -0,0 +1,218 @@
+"""
+Persistent cache of decoded audio shared by the feature extraction jobs
+
+Author: Samik Sadhu
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import time
+import numpy as np
+
+
+class DecodedAudioCache(object):
+    '''Content-addressed cache of int16 audio decoded by scp commands
+
+    Decoded samples are appended to one pack file and located through an
+    append-only index, so every job reads cached audio zero-copy from a
+    memory map of the pack. Entries are keyed by the sha1 of the command
+    string. When the pack grows beyond the size limit, the least recently
+    used entries are dropped by writing a new pack generation.
+
+    Layout of cache_dir:
+        index: "gen <n>" followed by "e <key> <offset> <num_samples> <num_channels> <srate> <time>"
+            entries and "u <key> <time>" usage records.
+        pack.<n>: Raw little-endian int16 samples.
+        lock: Serializes appends and compaction between jobs.
+
+    Args:
+        cache_dir (str): Cache directory, shared by all jobs.
+        max_gb (float): Size limit of the pack file in GB.
+
+    '''
+
+    def __init__(self, cache_dir, max_gb=100):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * 2 ** 30)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_file = os.path.join(cache_dir, 'index')
+        self.lock_file = open(os.path.join(cache_dir, 'lock'), 'a')
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+        with self._locked(fcntl.LOCK_EX):
+            if not os.path.isfile(self.index_file):
+                self._write_index(0, [])
+        self._reload()
+
+    @contextlib.contextmanager
+    def _locked(self, mode):
+        fcntl.flock(self.lock_file, mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _write_index(self, gen, entries):
+        open(os.path.join(self.cache_dir, 'pack.{:d}'.format(gen)), 'ab').close()
+        tmp_file = '{:s}.{:d}.tmp'.format(self.index_file, os.getpid())
+        with open(tmp_file, 'w') as fid:
+            fid.write('gen {:d}\n'.format(gen))
+            for key, (offset, num_samples, num_channels, srate, last_used) in entries:
+                fid.write('e {:s} {:d} {:d} {:d} {:d} {:f}\n'.format(key, offset, num_samples, num_channels, srate,
+                                                                     last_used))
+        os.replace(tmp_file, self.index_file)
+
+    def _reload(self):
+        # The index and its pack are opened together, compaction cannot run in between
+        with self._locked(fcntl.LOCK_SH):
+            self._open_index()
+
+    def _open_index(self):
+        self.index_fid = open(self.index_file, 'r')
+        self.index_inode = os.fstat(self.index_fid.fileno()).st_ino
+        self.gen = int(self.index_fid.readline().split()[1])
+        self.pack_file = os.path.join(self.cache_dir, 'pack.{:d}'.format(self.gen))
+        self.pack_fid = open(self.pack_file, 'rb')
+        self.entries = {}
+        self.last_used = {}
+        self.pack = None
+        self._read_index()
+
+    def _read_index(self):
+        # Only the lines appended since the last read are parsed
+        while True:
+            pos = self.index_fid.tell()
+            line = self.index_fid.readline()
+            if not line.endswith('\n'):
+                # End of the index or a partially written line, read it again next time
+                self.index_fid.seek(pos)
+                break
+            tokens = line.split()
+            if tokens[0] == 'e':
+                offset, num_samples, num_channels, srate = [int(x) for x in tokens[2:6]]
+                self.entries[tokens[1]] = (offset, num_samples, num_channels, srate)
+                self.last_used[tokens[1]] = max(self.last_used.get(tokens[1], 0), float(tokens[6]))
+            elif tokens[0] == 'u':
+                self.last_used[tokens[1]] = max(self.last_used.get(tokens[1], 0), float(tokens[2]))
+
+    def _refresh(self, locked=False):
+        if os.stat(self.index_file).st_ino != self.index_inode:
+            # Compacted by another job. flock on the same file would replace a held exclusive lock
+            self.index_fid.close()
+            self.pack_fid.close()
+            if locked:
+                self._open_index()
+            else:
+                self._reload()
+        else:
+            self._read_index()
+
+    @staticmethod
+    def key(cmd):
+        return hashlib.sha1(cmd.encode('utf-8')).hexdigest()
+
+    def lookup(self, cmd):
+        '''Cached (srate, signal) of a command or None, the signal is a read-only view of the pack'''
+
+        key = self.key(cmd)
+        if key not in self.entries:
+            self._refresh()
+            if key not in self.entries:
+                self.misses += 1
+                return None
+        self.hits += 1
+        offset, num_samples, num_channels, srate = self.entries[key]
+        self.used.add(key)
+        if num_samples * num_channels == 0:
+            # Empty decodes add nothing to the pack, which cannot be mapped while it is empty
+            signal = np.zeros(0, dtype='<i2')
+        else:
+            end = offset + 2 * num_samples * num_channels
+            if self.pack is None or len(self.pack) < end:
+                self.pack = mmap.mmap(self.pack_fid.fileno(), 0, access=mmap.ACCESS_READ)
+            signal = np.frombuffer(self.pack, dtype='<i2', count=num_samples * num_channels, offset=offset)
+        return srate, (signal.reshape(num_samples, num_channels) if num_channels > 1 else signal)
+
+    def store(self, cmd, srate, signal):
+        '''Add decoded audio to the cache, only int16 audio is cached'''
+
+        if signal.dtype != np.int16:
+            return
+        key = self.key(cmd)
+        num_channels = 1 if signal.ndim == 1 else signal.shape[1]
+        data = np.ascontiguousarray(signal, dtype='<i2').tobytes()
+        with self._locked(fcntl.LOCK_EX):
+            self._refresh(locked=True)
+            if key in self.entries:
+                return
+            with open(self.pack_file, 'ab') as pack:
+                offset = pack.tell()
+                pack.write(data)
+            # The index line is written after the samples, so readers never see incomplete audio
+            with open(self.index_file, 'a') as index:
+                index.write('e {:s} {:d} {:d} {:d} {:d} {:f}\n'.format(key, offset, signal.shape[0], num_channels,
+                                                                       srate, time.time()))
+            if offset + len(data) > self.max_bytes:
+                self._evict()
+        self.used.add(key)
+
+    def _evict(self):
+        # Called with the exclusive lock held, keeps the most recently used entries in a new pack generation
+        self._read_index()
+        order = sorted(self.entries, key=lambda k: self.last_used.get(k, 0), reverse=True)
+        src = open(self.pack_file, 'rb')
+        new_gen = self.gen + 1
+        kept = []
+        total = 0
+        with open(os.path.join(self.cache_dir, 'pack.{:d}'.format(new_gen)), 'wb') as dst:
+            for key in order:
+                offset, num_samples, num_channels, srate = self.entries[key]
+                nbytes = 2 * num_samples * num_channels
+                if total + nbytes > 0.8 * self.max_bytes:
+                    continue
+                src.seek(offset)
+                dst.write(src.read(nbytes))
+                kept.append((key, (total, num_samples, num_channels, srate, self.last_used.get(key, 0))))
+                total += nbytes
+        src.close()
+        old_pack = self.pack_file
+        self._write_index(new_gen, kept)
+        os.remove(old_pack)
+        print('Audio cache: kept {:d} of {:d} utterances ({:.2f} GB)'.format(len(kept), len(order), total / 2 ** 30))
+        self.index_fid.close()
+        self.pack_fid.close()
+        self._open_index()
+
+    def get(self, cmd, decode):
+        '''Cached audio of a command, decode(cmd) returns (srate, signal) on a miss'''
+
+        cached = self.lookup(cmd)
+        if cached is not None:
+            return cached
+        srate, signal = decode(cmd)
+        self.store(cmd, srate, signal)
+        return srate, signal
+
+    def close(self):
+        # Usage records drive the LRU eviction of later jobs
+        if self.used:
+            with self._locked(fcntl.LOCK_EX):
+                with open(self.index_file, 'a') as index:
+                    now = time.time()
+                    for key in self.used:
+                        index.write('u {:s} {:f}\n'.format(key, now))
+        print('Audio cache: {:d} hits, {:d} misses'.format(self.hits, self.misses))
+        self.index_fid.close()
+        self.pack_fid.close()
+        self.lock_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
@@ -0,0 +1,252 @@
+"""
+Reading the audio of wav.scp entries for the feature extraction scripts
+
+Author: Samik Sadhu
+"""
+
+import collections
+import io
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.io.wavfile import read
+from audio_cache import DecodedAudioCache
+
+
+def decode_command(cmd):
+    '''Run a command that writes a wav file to stdout'''
+
+    proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
+    return read(io.BytesIO(proc.stdout))
+
+
+def entry_source(inwav, scp_type):
+    '''Kind of an scp entry: file, pipe, ark or segment'''
+
+    if scp_type == 'segment':
+        return 'segment'
+    elif scp_type != 'wav':
+        raise ValueError('Invalid type of scp type, it should be either wav or segment')
+    if inwav[-1] == '|':
+        return 'pipe'
+    if re.match(r'^.+:\d+$', inwav) and not os.path.exists(inwav):
+        return 'ark'
+    return 'file'
+
+
+def entry_command(inwav, scp_type):
+    '''Command that decodes an scp entry, None if the entry is not decoded by a command'''
+
+    source = entry_source(inwav, scp_type)
+    if source == 'pipe':
+        return inwav[:-1]
+    elif source == 'segment':
+        return 'wav-copy ' + inwav + ' - '
+    return None
+
+
+def decode_entry(inwav, scp_type):
+    source = entry_source(inwav, scp_type)
+    if source == 'file':
+        return read(inwav)
+    elif source == 'ark':
+        # Wav data stored in a Kaldi archive, e.g. written by wav-copy
+        import kaldiio
+        return kaldiio.load_mat(inwav)
+    return decode_command(entry_command(inwav, scp_type))
+
+
+def int16_to_float32(signal):
+    '''Scale PCM samples to [-1, 1) in float32 without a float64 copy'''
+
+    return np.multiply(signal, np.float32(1.0 / 32768), dtype=np.float32)
+
+
+class AudioReader(object):
+    '''Iterates over (uttid, srate, signal) of an scp file in scp order
+
+    Entries can be wav files, piped commands ending with "|", wav data in
+    Kaldi archives (path:offset) or, with scp_type segment, extended
+    filenames for wav-copy. With a Kaldi segments file the utterances are
+    cut from the recordings of the scp, every recording is decoded once.
+
+    With num_workers > 1, up to lookahead utterances are decoded ahead in a
+    thread pool, so sph2pipe/sox/wav-copy run while the features of earlier
+    utterances are computed. The cache is only used from the iterating
+    thread. Entries that fail to decode are counted, reported and returned
+    with srate and signal set to None. Decode statistics per source are
+    printed when the iteration ends.
+
+    Args:
+        scp (str): wav.scp or segment scp file.
+        scp_type (str): wav or segment.
+        segments (str): Kaldi segments file (utt recording start end), None to read the scp entries.
+        num_workers (int): Number of concurrent decodes.
+        lookahead (int): Maximum number of utterances decoded ahead (default: 2 * num_workers).
+        cache (DecodedAudioCache): Cache of decoded piped and segment entries.
+        scale (bool): Return float32 signals scaled by 1 / 2^15 instead of the raw samples.
+
+    '''
+
+    def __init__(self, scp, scp_type='wav', segments=None, num_workers=1, lookahead=None, cache=None, scale=False):
+        if scp_type not in ['wav', 'segment']:
+            raise ValueError('Invalid type of scp type, it should be either wav or segment')
+        self.scp = scp
+        self.scp_type = scp_type
+        self.segments = segments
+        self.num_workers = num_workers
+        self.lookahead = lookahead if lookahead else 2 * num_workers
+        self.cache = cache
+        self.scale = scale
+        self.stats = collections.OrderedDict()
+        self.failed = []
+
+    def _scp_entries(self):
+        with open(self.scp, 'r') as fid:
+            for line in fid:
+                tokens = line.strip().split()
+                if tokens:
+                    yield tokens[0], ' '.join(tokens[1:])
+
+    def _entries(self):
+        # (uttid, scp entry, start, end) of every utterance
+        if self.segments is None:
+            for uttid, inwav in self._scp_entries():
+                yield uttid, inwav, None, None
+            return
+        recordings = dict(self._scp_entries())
+        with open(self.segments, 'r') as fid:
+            for line in fid:
+                tokens = line.strip().split()
+                if not tokens:
+                    continue
+                if len(tokens) != 4:
+                    raise ValueError('Invalid segments line: "{:s}"'.format(line.strip()))
+                uttid, recid, start, end = tokens
+                if recid not in recordings:
+                    raise ValueError('Recording {:s} of {:s} not found in {:s}'.format(recid, uttid, self.scp))
+                yield uttid, recordings[recid], float(start), float(end)
+
+    def _decode(self, inwav):
+        start_time = time.time()
+        try:
+            result = decode_entry(inwav, self.scp_type)
+        except Exception as err:
+            result = err
+        return entry_source(inwav, self.scp_type), result, time.time() - start_time
+
+    def _submit(self, pool, inwav):
+        cmd = entry_command(inwav, self.scp_type)
+        if self.cache is not None and cmd is not None:
+            start_time = time.time()
+            cached = self.cache.lookup(cmd)
+            if cached is not None:
+                return 'cache', cached, time.time() - start_time
+        if pool is None:
+            return self._decode(inwav)
+        return pool.submit(self._decode, inwav)
+
+    def _resolve(self, inwav, decoded):
+        # Waits for a decode and accounts for it once
+        if not isinstance(decoded, tuple):
+            start_time = time.time()
+            decoded = decoded.result()
+            self.wait_time += time.time() - start_time
+        source, result, seconds = decoded
+        stats = self.stats.setdefault(source, {'decoded': 0, 'failed': 0, 'audio_seconds': 0.0, 'seconds': 0.0})
+        stats['seconds'] += seconds
+        if isinstance(result, Exception):
+            stats['failed'] += 1
+            return None, str(result)
+        srate, signal = result
+        stats['decoded'] += 1
+        stats['audio_seconds'] += signal.shape[0] / srate
+        cmd = entry_command(inwav, self.scp_type)
+        if self.cache is not None and cmd is not None and source != 'cache':
+            self.cache.store(cmd, srate, signal)
+        return result, None
+
+    def _next(self, pending, decoding):
+        uttid, inwav, start, end = pending.popleft()
+        entry = decoding[inwav]
+        if entry[2] is None and entry[3] is None:
+            entry[2], entry[3] = self._resolve(inwav, entry[0])
+        result, error = entry[2], entry[3]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del decoding[inwav]
+        if result is None:
+            self.failed.append(uttid)
+            print('%s: Failed to decode %s: %s' % (sys.argv[0], uttid, error))
+            return uttid, None, None
+
+        srate, signal = result
+        if start is not None:
+            # Same convention as extract-segments, an end time of -1 means the end of the recording
+            signal = signal[int(start * srate):] if end == -1 else signal[int(start * srate):int(end * srate)]
+        if self.scale:
+            signal = int16_to_float32(signal)
+        return uttid, srate, signal
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        start_time = time.time()
+        pool = ThreadPoolExecutor(self.num_workers) if self.num_workers > 1 else None
+        pending = collections.deque()
+        # Decodes in flight or kept for further segments: entry -> [decode, uses left, result, error]
+        decoding = {}
+        try:
+            for item in self._entries():
+                inwav = item[1]
+                if inwav in decoding:
+                    decoding[inwav][1] += 1
+                else:
+                    decoding[inwav] = [self._submit(pool, inwav), 1, None, None]
+                pending.append(item)
+                if len(pending) >= self.lookahead:
+                    yield self._next(pending, decoding)
+            while pending:
+                yield self._next(pending, decoding)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        self.report(time.time() - start_time)
+
+    def report(self, wall_time):
+        for source, stats in self.stats.items():
+            speed = stats['audio_seconds'] / stats['seconds'] if stats['seconds'] > 0 else float('inf')
+            print('%s: %s: %d decoded, %d failed, %.1f s of audio in %.1f s (%.1fx real time)' % (
+                sys.argv[0], source, stats['decoded'], stats['failed'], stats['audio_seconds'], stats['seconds'],
+                speed))
+        if self.num_workers > 1:
+            print('%s: Waited %.1f s for audio out of %.1f s' % (sys.argv[0], self.wait_time, wall_time))
+        if self.failed:
+            print('%s: %d utterances could not be decoded: %s' % (sys.argv[0], len(self.failed),
+                                                                 ' '.join(self.failed[:20])))
+
+
+def add_audio_args(parser):
+    '''Audio reading options shared by the feature extraction scripts'''
+
+    parser.add_argument("--num_decode_workers", type=int, default=1,
+                        help="Number of scp entries decoded concurrently")
+    parser.add_argument("--decode_lookahead", type=int, default=None,
+                        help="Maximum number of entries decoded ahead (default: 2 x num_decode_workers)")
+    parser.add_argument("--audio_cache_dir", type=str, default=None,
+                        help="Cache decoded audio of piped and segment entries in this directory (default: no cache)")
+    parser.add_argument("--audio_cache_gb", type=float, default=100, help="Size limit of the audio cache in GB")
+
+
+def open_audio_cache(args):
+    return DecodedAudioCache(args.audio_cache_dir, args.audio_cache_gb) if args.audio_cache_dir else None
+
+
+def get_audio_reader(args, cache=None, scale=False):
+    '''AudioReader configured by add_audio_args options and the scp_type/segment_file options of a script'''
+
+    return AudioReader(args.scp, scp_type=getattr(args, 'scp_type', 'wav'), segments=getattr(args, 'segment_file', None),
+                       num_workers=args.num_decode_workers, lookahead=args.decode_lookahead, cache=cache, scale=scale)
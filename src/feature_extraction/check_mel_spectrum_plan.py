@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+Author: samiksadhu, Johns Hopkins University
+"""
+
+'Check that the --fast mel spectrogram path matches the default FFT and dense filter bank path'
+
+import argparse
+import sys
+import numpy as np
+from utils import FrameWindower, getFbank
+from compute_mel_spectrogram import MelSpectrumPlan, fbank_energies
+
+# Filter banks covered by the check, in the --fbank_type format
+FBANK_TYPES = ['mel,1', 'cochlear,0.2,2.5,1,2.5,1', 'uniform', 'hearing']
+
+# (rtol, atol) of the float32 path per spectrum type. Log energies close to 0 (energies close to 1) have no
+# relative precision, they are held to the float32 resolution of log10 instead
+TOLERANCES = {'log': (1e-5, 1e-6), 'power': (1e-4, 0)}
+
+
+def check_plan(fbank_type, spectrum_type, signal, srate=16000, nfilters=23, nfft=1024, frate=100, fduration=0.02):
+    '''Largest difference between the fast and the default energies of a signal, as a fraction of the tolerance
+
+    The signal is passed to both paths as is, like compute_mel_spectrogram.py
+    passes the int16 samples it reads. Raises AssertionError if the difference
+    is above the tolerance of the spectrum type.
+    '''
+
+    fbank = getFbank(fbank_type, nfilters, nfft, srate)
+    plan = MelSpectrumPlan(fbank, nfft, srate, frate, fduration, np.hamming, spectrum_type)
+    fast = plan(signal)
+    reference = fbank_energies(FrameWindower(srate, frate, fduration, np.hamming)(signal), fbank, nfft,
+                               spectrum_type)
+    rtol, atol = TOLERANCES[spectrum_type]
+    np.testing.assert_allclose(fast, reference, rtol=rtol, atol=atol,
+                               err_msg='{:s} {:s} spectrum'.format(fbank_type, spectrum_type))
+    return np.max(np.abs(fast - reference) / (atol + rtol * np.abs(reference)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Check the --fast mel spectrogram path against the default one')
+    parser.add_argument("--num_utts", type=int, default=5, help="Number of random utterances")
+    parser.add_argument("--nfft", type=int, default=1024, help="Number of points of computing FFT")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random utterances")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    # 1-5 s of unscaled int16 noise at full scale, and one utterance a few LSBs loud
+    scales = [8000.0] * args.num_utts + [3.0]
+    signals = [np.clip(np.round(scale * rng.standard_normal(rng.randint(16000, 80000))), -32768,
+                       32767).astype(np.int16) for scale in scales]
+    failed = 0
+    for fbank_type in FBANK_TYPES:
+        for spectrum_type in ['log', 'power']:
+            try:
+                max_diff = max(check_plan(fbank_type, spectrum_type, signal, nfft=args.nfft) for signal in signals)
+                print('%s: %s %s: largest difference is %.3f of the tolerance' % (sys.argv[0], fbank_type,
+                                                                                  spectrum_type, max_diff))
+            except AssertionError as err:
+                failed += 1
+                print('%s: FAILED %s' % (sys.argv[0], err))
+    sys.exit(1 if failed else 0)
@@ -6,13 +6,16 @@ Author: samiksadhu, Johns Hopkins University
 """
 
 import numpy as np
-from utils import getFrames, createFbank, createFbankCochlear, createLinearFbank, createHearingFbank, get_kaldi_ark
+from utils import FrameWindower, getFbank, numFrames
+from kaldi_ark import KaldiArkWriter
 from scipy.fftpack import fft
-from scipy.io.wavfile import read
-import subprocess
+import scipy.fft
+import scipy.sparse
+from audio_source import add_audio_args, open_audio_cache, get_audio_reader
+from noise_mixer import add_noise_args, open_noise_mixer
 import argparse
+import contextlib
 import sys
-import io
 
 
 def get_args():
@@ -29,14 +32,126 @@ def get_args():
                         help='mel,warp_fact OR cochlear,om_w,alpa,fixed,beta,warp_fact, OR uniform OR hearing')
     parser.add_argument('--derivative', action='store_true', help='Set to compute derivative of the signal')
     parser.add_argument("--write_utt2num_frames", action="store_true", help="Set to write utt2num_frames")
+    parser.add_argument("--fbank_cache_dir", type=str, default=None,
+                        help="Directory to cache filter banks across jobs (default: no cache)")
+    parser.add_argument("--fast", action="store_true",
+                        help="Use the float32 real-FFT path with a sparse filter bank")
+    parser.add_argument("--batch_mem_mb", type=float, default=0,
+                        help="Memory budget in MB to process the frames of several utterances at once "
+                             "(default: one utterance at a time)")
+    add_audio_args(parser)
+    add_noise_args(parser)
 
     return parser.parse_args()
 
 
+def fbank_energies(time_frames, fbank, nfft, spectrum_type='log'):
+    '''Filter bank energies of windowed frames with a complex FFT and a dense float64 filter bank product'''
+
+    spectrum = np.abs(fft(time_frames, nfft, axis=1)[:, :int(nfft / 2 + 1)])
+    if spectrum_type == "log":
+        return np.log10(np.matmul(spectrum, np.transpose(fbank)))
+    elif spectrum_type == "power":
+        return np.power(np.matmul(spectrum, np.transpose(fbank)), 2)
+    else:
+        print("Spectrum type not supported! ")
+        sys.exit(1)
+
+
+class MelSpectrumPlan(object):
+    '''Float32 real-FFT filter bank energies with everything prepared once per job
+
+    Args:
+        fbank (numpy.ndarray): Filter bank (nfilters x nfft / 2 + 1).
+        nfft (int): Number of points of the FFT.
+        srate (int): Sampling rate.
+        frate (int): Frame rate in Hz.
+        fduration (float): Window length in seconds.
+        window (function): Window function.
+        spectrum_type (str): log or power.
+
+    '''
+
+    def __init__(self, fbank, nfft, srate, frate, fduration, window=np.hamming, spectrum_type='log'):
+        if spectrum_type not in ['log', 'power']:
+            raise ValueError('Spectrum type not supported: {:s}'.format(spectrum_type))
+        self.nfft = nfft
+        self.spectrum_type = spectrum_type
+        self.windower = FrameWindower(srate, frate, fduration, window, dtype=np.float32)
+        # Triangular filters are mostly zeros
+        self.fbank = scipy.sparse.csr_matrix(np.asarray(fbank, dtype=np.float32))
+
+    def __call__(self, signal):
+        return self.energies(self.windower(signal))
+
+    def energies(self, frames):
+        magnitude = np.abs(scipy.fft.rfft(frames, self.nfft, axis=1))
+        energy = np.asarray(self.fbank.dot(magnitude.T)).T
+        if self.spectrum_type == 'log':
+            return np.log10(energy)
+        return np.power(energy, 2)
+
+
+def frames_per_batch(batch_mem_mb, flength_samples, nfft, nfilters, fast=False):
+    """Number of frames whose FFT and filter bank energies fit in the memory budget"""
+
+    if fast:
+        # float32 frames, complex64 real FFT, magnitude and energies
+        per_frame = 4 * (flength_samples + 3 * (nfft // 2 + 1) + 2 * nfilters)
+    else:
+        # float64 frames, complex128 full FFT, magnitude and energies
+        per_frame = 8 * (flength_samples + 2 * nfft + (nfft // 2 + 1) + 2 * nfilters)
+    return max(1, int(batch_mem_mb * 2 ** 20) // per_frame)
+
+
+class FrameBatch(object):
+    '''Collects the windowed frames of consecutive utterances for one FFT and filter bank call
+
+    Frames are concatenated without padding, so utterances of any length
+    share a batch and come out in input order.
+
+    Args:
+        windower (FrameWindower): Frame extraction and windowing.
+        energies (function): Maps windowed frames to filter bank energies.
+        max_frames (int): Capacity of the batch.
+
+    '''
+
+    def __init__(self, windower, energies, max_frames):
+        self.windower = windower
+        self.energies = energies
+        self.buffer = np.empty((max_frames, len(windower.win)), dtype=windower.dtype)
+        self.utts = []
+        self.num_frames = 0
+
+    def add(self, uttid, signal):
+        """Add an utterance, returns the (uttid, feats) pairs completed by it"""
+
+        n = numFrames(len(signal), self.windower.srate, self.windower.frate, self.windower.flength)
+        done = []
+        if self.num_frames + n > self.buffer.shape[0]:
+            done = self.flush()
+        if n > self.buffer.shape[0]:
+            done.append((uttid, self.energies(self.windower(signal))))
+            return done
+        self.windower(signal, out=self.buffer[self.num_frames:self.num_frames + n])
+        self.utts.append((uttid, n))
+        self.num_frames += n
+        return done
+
+    def flush(self):
+        if not self.utts:
+            return []
+        feats = self.energies(self.buffer[:self.num_frames])
+        splits = np.cumsum([n for _, n in self.utts])[:-1]
+        done = list(zip([uttid for uttid, _ in self.utts], np.split(feats, splits)))
+        self.utts = []
+        self.num_frames = 0
+        return done
+
+
 def compute_mel_spectrum(args, srate=16000,
                          window=np.hamming):
-    wavs = args.scp
-    scp_type = args.scp_type
     outfile = args.outfile
     nfft = args.nfft
     fduration = args.fduration
@@ -44,97 +159,74 @@ def compute_mel_spectrum(args, srate=16000,
     nfilters = args.nfilters
 
     # Set up mel-filterbank
-    fbank_type = args.fbank_type.strip().split(',')
-    if fbank_type[0] == "mel":
-        if len(fbank_type) < 2:
-            raise ValueError('Mel filter bank not configured properly....')
-        fbank = createFbank(nfilters, nfft, srate, warp_fact=float(fbank_type[1]))
-    elif fbank_type[0] == "cochlear":
-        if len(fbank_type) < 6:
-            raise ValueError('Cochlear filter bank not configured properly....')
-        if int(fbank_type[3]) == 1:
-            print('%s: Alpha is fixed and will not change as a function of the center frequency...' % sys.argv[0])
-        fbank = createFbankCochlear(nfilters, nfft, srate, om_w=float(fbank_type[1]),
-                                    alp=float(fbank_type[2]), fixed=int(fbank_type[3]), bet=float(fbank_type[4]),
-                                    warp_fact=float(fbank_type[5]))
-    elif fbank_type[0] == "uniform":
-        fbank = createLinearFbank(nfilters, nfft, srate)
-    elif fbank_type[0] == "hearing":
-        fbank = createHearingFbank(nfft, srate)
-    else:
-        raise ValueError('Invalid type of filter bank, use mel or cochlear with proper configuration')
-
-    with open(wavs, 'r') as fid:
+    fbank = getFbank(args.fbank_type, nfilters, nfft, srate, cache_dir=args.fbank_cache_dir)
 
-        all_feats = {}
-        if args.write_utt2num_frames:
-            all_lens = {}
+    if args.fast:
+        plan = MelSpectrumPlan(fbank, nfft, srate, frate, fduration, window, args.spectrum_type)
+        windower, energies = plan.windower, plan.energies
+    else:
+        windower = FrameWindower(srate, frate, fduration, window)
 
-        for line in fid:
-            tokens = line.strip().split()
-            uttid, inwav = tokens[0], ' '.join(tokens[1:])
+        def energies(time_frames):
+            return fbank_energies(time_frames, fbank, nfft, args.spectrum_type)
 
+    # One output per noise condition
+    noise_mixer = open_noise_mixer(args)
+    if noise_mixer is None:
+        outfiles = [outfile]
+    else:
+        outfiles = [noise_mixer.outfile(outfile, name) for name in noise_mixer.names]
+
+    batches = None
+    if args.batch_mem_mb > 0:
+        max_frames = frames_per_batch(args.batch_mem_mb / len(outfiles), len(windower.win), nfft, fbank.shape[0],
+                                      fast=args.fast)
+        print('%s: Processing up to %d frames per batch' % (sys.argv[0], max_frames))
+        batches = [FrameBatch(windower, energies, max_frames) for _ in outfiles]
+
+    audio_cache = open_audio_cache(args)
+    # Every utterance is written as soon as it is computed, so memory does not grow with the scp
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(KaldiArkWriter(f)) for f in outfiles]
+        len_files = [stack.enter_context(open(f + '.len', 'w')) for f in outfiles] if args.write_utt2num_frames \
+            else None
+
+        def write_feats(k, key, feats):
+            writers[k].write(key, feats)
+            writers[k].flush()
+            if len_files:
+                len_files[k].write("{:s} {:d}\n".format(key, feats.shape[0]))
+                len_files[k].flush()
+
+        for uttid, sr, signal in get_audio_reader(args, audio_cache):
             print('%s: Computing Features for file: %s' % (sys.argv[0], uttid))
             sys.stdout.flush()
 
-            if scp_type == 'wav':
-                if inwav[-1] == '|':
-                    try:
-                        proc = subprocess.run(inwav[:-1], shell=True, stdout=subprocess.PIPE)
-                        sr, signal = read(io.BytesIO(proc.stdout))
-                        skip_rest = False
-                    except Exception:
-                        skip_rest = True
-                else:
-                    try:
-                        sr, signal = read(inwav)
-                        skip_rest = False
-                    except Exception:
-                        skip_rest = True
-
+            if signal is None:
+                continue
+            if args.scp_type == 'wav':
                 assert sr == srate, 'Input file has different sampling rate.'
-            elif scp_type == 'segment':
-                try:
-                    cmd = 'wav-copy ' + inwav + ' - '
-                    proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
-                    sr, signal = read(io.BytesIO(proc.stdout))
-                    skip_rest = False
-                except Exception:
-                    skip_rest = True
-            else:
-                raise ValueError('Invalid type of scp type, it should be either wav or segment')
             #signal = signal / np.power(2, 15)
-            if args.derivative:
-                signal = np.diff(signal)
-
-            if not skip_rest:
+            signals = [signal] if noise_mixer is None else noise_mixer.mix(uttid, signal)
 
-                time_frames = np.array([frame for frame in
-                                        getFrames(signal, srate, frate, fduration, window)])
+            for k, signal in enumerate(signals):
+                if args.derivative:
+                    signal = np.diff(signal)
 
-                if args.spectrum_type == "log":
-                    melEnergy_frames = np.log10(
-                        np.matmul(np.abs(fft(time_frames, nfft, axis=1)[:, :int(nfft / 2 + 1)]), np.transpose(fbank)))
-                elif args.spectrum_type == "power":
-                    melEnergy_frames = np.power(
-                        np.matmul(np.abs(fft(time_frames, nfft, axis=1)[:, :int(nfft / 2 + 1)]), np.transpose(fbank)),
-                        2)
+                if batches is not None:
+                    done = batches[k].add(uttid, signal)
                 else:
-                    print("Spectrum type not supported! ")
-                    sys.exit(1)
-
-                all_feats[uttid] = melEnergy_frames
-                if args.write_utt2num_frames:
-                    all_lens[uttid] = melEnergy_frames.shape[0]
-        get_kaldi_ark(all_feats, outfile)
+                    done = [(uttid, energies(windower(signal)))]
+                for key, melEnergy_frames in done:
+                    write_feats(k, key, melEnergy_frames)
 
-        if args.write_utt2num_frames:
-            with open(outfile + '.len', 'w+') as file:
-                for key, lens in all_lens.items():
-                    p = "{:s} {:d}".format(key, lens)
-                    file.write(p)
-                    file.write("\n")
+        if batches is not None:
+            for k, batch in enumerate(batches):
+                for key, melEnergy_frames in batch.flush():
+                    write_feats(k, key, melEnergy_frames)
 
+    if audio_cache:
+        audio_cache.close()
 
 if __name__ == '__main__':
     args = get_args()
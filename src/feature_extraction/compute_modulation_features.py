@@ -6,12 +6,12 @@ Author: samiksadhu, Johns Hopkins University
 """
 
 import numpy as np
-from utils import get_kaldi_ark
-from scipy.io.wavfile import read
-import subprocess
+from kaldi_ark import KaldiArkWriter
+from audio_source import add_audio_args, open_audio_cache, get_audio_reader
+from noise_mixer import add_noise_args, open_noise_mixer
 import argparse
+import contextlib
 import sys
-import io
 from fdlp.src.fdlp import fdlp
 
 
@@ -44,6 +44,8 @@ def get_args():
     parser.add_argument('--normalize_uttwise_variance', type=bool, default=False,
                         help='Set to perform utterancewise variance normalization')
     parser.add_argument("--write_utt2num_frames", action="store_true", help="Set to write utt2num_frames")
+    add_audio_args(parser)
+    add_noise_args(parser)
 
     return parser.parse_args()
 
@@ -56,64 +58,43 @@ def compute_modulations(args):
                       lifter_file=args.lifter_file, lfr=args.lfr, return_mvector=args.return_mvector,
                       complex_mvectors=args.complex_mvectors, no_window=args.no_window, srate=args.srate)
 
-    with open(args.scp, 'r') as fid:
-
-        all_feats = {}
-        if args.write_utt2num_frames:
-            all_lens = {}
-
-        for line in fid:
-            tokens = line.strip().split()
-            uttid, inwav = tokens[0], ' '.join(tokens[1:])
-
+    # One output per noise condition
+    noise_mixer = open_noise_mixer(args)
+    if noise_mixer is None:
+        outfiles = [args.outfile]
+    else:
+        outfiles = [noise_mixer.outfile(args.outfile, name) for name in noise_mixer.names]
+
+    audio_cache = open_audio_cache(args)
+    # Every utterance is written as soon as it is computed, so memory does not grow with the scp
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(KaldiArkWriter(f)) for f in outfiles]
+        len_files = [stack.enter_context(open(f + '.len', 'w')) for f in outfiles] if args.write_utt2num_frames \
+            else None
+
+        for uttid, sr, signal in get_audio_reader(args, audio_cache, scale=True):
             print('%s: Computing Features for file: %s' % (sys.argv[0], uttid))
             sys.stdout.flush()
 
+            if signal is None:
+                continue
             if args.scp_type == 'wav':
-                if inwav[-1] == '|':
-                    try:
-                        proc = subprocess.run(inwav[:-1], shell=True, stdout=subprocess.PIPE)
-                        sr, signal = read(io.BytesIO(proc.stdout))
-                        skip_rest = False
-                    except Exception:
-                        skip_rest = True
-                else:
-                    try:
-                        sr, signal = read(inwav)
-                        skip_rest = False
-                    except Exception:
-                        skip_rest = True
-
                 assert sr == args.srate, 'Input file has different sampling rate.'
-            elif args.scp_type == 'segment':
-                try:
-                    cmd = 'wav-copy ' + inwav + ' - '
-                    proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
-                    sr, signal = read(io.BytesIO(proc.stdout))
-                    skip_rest = False
-                except Exception:
-                    skip_rest = True
-            else:
-                raise ValueError('Invalid type of scp type, it should be either wav or segment')
-            signal = signal / np.power(2, 15)
+            # All noise conditions of an utterance are one batch of signals
+            signals = signal[np.newaxis, :] if noise_mixer is None else noise_mixer.mix(uttid, signal)
             if args.derivative:
-                signal = np.diff(signal)
-
-            if not skip_rest:
-                feats, _ = feat_model.extract_feats(signal[np.newaxis, :])
-                feats = feats[0]
-                all_feats[uttid] = feats
-                if args.write_utt2num_frames:
-                    all_lens[uttid] = feats.shape[0]
-        get_kaldi_ark(all_feats, args.outfile)
-
-        if args.write_utt2num_frames:
-            with open(args.outfile + '.len', 'w+') as file:
-                for key, lens in all_lens.items():
-                    p = "{:s} {:d}".format(key, lens)
-                    file.write(p)
-                    file.write("\n")
-
+                signals = np.diff(signals, axis=1)
+
+            all_feats, _ = feat_model.extract_feats(signals)
+            for k, feats in enumerate(all_feats):
+                writers[k].write(uttid, feats)
+                writers[k].flush()
+                if len_files:
+                    len_files[k].write("{:s} {:d}\n".format(uttid, feats.shape[0]))
+                    len_files[k].flush()
+
+    if audio_cache:
+        audio_cache.close()
 
 if __name__ == '__main__':
     args = get_args()
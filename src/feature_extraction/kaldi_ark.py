@@ -0,0 +1,349 @@
+"""
+Reading and writing Kaldi binary archives without the Kaldi binaries
+
+Author: Samik Sadhu
+"""
+
+import mmap
+import numpy as np
+import struct
+from collections.abc import Mapping
+
+
+# Kaldi CompressedMatrix constants, see kaldi/src/matrix/compressed-matrix.cc
+_ONE_OVER_65535 = np.float32(1.52590218966964e-05)
+
+
+def _float_to_uint16(min_value, value_range, values):
+    f = (np.asarray(values, dtype=np.float32) - min_value) / value_range
+    f = np.clip(f, np.float32(0), np.float32(1))
+    # float product, double addition and truncation like the C++ code
+    return ((f * np.float32(65535)).astype(np.float64) + 0.499).astype(np.int64)
+
+
+def _uint16_to_float(min_value, value_range, values):
+    return min_value + value_range * _ONE_OVER_65535 * np.asarray(values).astype(np.float32)
+
+
+def _uint8_to_float(min_value, value_range, values):
+    return min_value + value_range * np.float32(1.0 / 255.0) * np.asarray(values).astype(np.float32)
+
+
+def _char_to_float(p0, p25, p75, p100, values):
+    values = values.astype(np.float32)
+    low = p0 + (p25 - p0) * values * np.float32(1 / 64.0)
+    mid = p25 + (p75 - p25) * (values - 64) * np.float32(1 / 128.0)
+    high = p75 + (p100 - p75) * (values - 192) * np.float32(1 / 63.0)
+    return np.where(values <= 64, low, np.where(values <= 192, mid, high))
+
+
+def _global_header(mat):
+    min_value = np.float32(np.min(mat))
+    max_value = np.float32(np.max(mat))
+    if max_value == min_value:
+        max_value = np.float32(np.float64(min_value) + (1.0 + abs(np.float64(min_value))))
+    if not (np.isfinite(min_value) and np.isfinite(max_value)):
+        raise ValueError("Cannot compress a matrix with Nan's or Inf's")
+    return min_value, np.float32(max_value - min_value)
+
+
+def _column_percentiles(min_value, value_range, mat):
+    num_rows = mat.shape[0]
+    sdata = np.sort(mat, axis=0)
+    if num_rows >= 5:
+        quarter_nr = num_rows // 4
+        positions = [0, quarter_nr, 3 * quarter_nr, num_rows - 1]
+        p0, p25, p75, p100 = [_float_to_uint16(min_value, value_range, sdata[p]) for p in positions]
+        p0 = np.minimum(p0, 65532)
+        p25 = np.minimum(np.maximum(p25, p0 + 1), 65533)
+        p75 = np.minimum(np.maximum(p75, p25 + 1), 65534)
+        p100 = np.maximum(p100, p75 + 1)
+    else:
+        p0 = np.minimum(_float_to_uint16(min_value, value_range, sdata[0]), 65532)
+        if num_rows > 1:
+            p25 = np.minimum(np.maximum(_float_to_uint16(min_value, value_range, sdata[1]), p0 + 1), 65533)
+        else:
+            p25 = p0 + 1
+        if num_rows > 2:
+            p75 = np.minimum(np.maximum(_float_to_uint16(min_value, value_range, sdata[2]), p25 + 1), 65534)
+        else:
+            p75 = p25 + 1
+        if num_rows > 3:
+            p100 = np.maximum(_float_to_uint16(min_value, value_range, sdata[3]), p75 + 1)
+        else:
+            p100 = p75 + 1
+    return np.stack([p0, p25, p75, p100]).astype(np.uint16)
+
+
+def _float_to_char(p0, p25, p75, p100, values):
+    # Piecewise linear quantization between the column percentiles
+    def quantize(lo, hi, scale):
+        f = (values - lo) / (hi - lo)
+        return np.trunc((f * np.float32(scale)).astype(np.float64) + 0.5)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        low = np.clip(quantize(p0, p25, 64), 0, 64)
+        mid = np.clip(64 + quantize(p25, p75, 128), 64, 192)
+        high = np.clip(192 + quantize(p75, p100, 63), 192, 255)
+    ans = np.where(values < p25, low, np.where(values < p75, mid, high))
+    return ans.astype(np.uint8)
+
+
+def compress_matrix(mat):
+    '''Kaldi CompressedMatrix with the automatic compression method of copy-feats --compress=true
+
+    Matrices with more than 8 rows use one byte per element with per-column
+    percentile headers (CM), smaller ones two bytes per element (CM2).
+
+    Args:
+        mat (numpy.ndarray): Matrix to compress.
+
+    Returns:
+        data (bytes): Serialized matrix starting with the CM/CM2 token.
+
+    '''
+
+    mat = np.asarray(mat, dtype=np.float32)
+    num_rows, num_cols = mat.shape
+    min_value, value_range = _global_header(mat)
+    header = struct.pack('<ffii', min_value, value_range, num_rows, num_cols)
+    if num_rows > 8:
+        percentiles = _column_percentiles(min_value, value_range, mat)
+        p0, p25, p75, p100 = [_uint16_to_float(min_value, value_range, p) for p in percentiles]
+        byte_data = _float_to_char(p0, p25, p75, p100, mat)
+        return b'CM ' + header + percentiles.T.astype('<u2').tobytes() + byte_data.T.tobytes()
+    else:
+        data = _float_to_uint16(min_value, value_range, mat).astype('<u2')
+        return b'CM2 ' + header + data.tobytes()
+
+
+def decompress_matrix(buf, pos, token):
+    '''Decode a Kaldi CompressedMatrix (CM, CM2 or CM3) starting after its token
+
+    Returns:
+        mat (numpy.ndarray): Float32 matrix.
+        pos (int): Position after the matrix.
+
+    '''
+
+    min_value, value_range, num_rows, num_cols = struct.unpack_from('<ffii', buf, pos)
+    min_value, value_range = np.float32(min_value), np.float32(value_range)
+    pos += 16
+    size = num_rows * num_cols
+    if token == 'CM':
+        percentiles = np.frombuffer(buf, dtype='<u2', count=4 * num_cols, offset=pos).reshape(num_cols, 4)
+        pos += 8 * num_cols
+        p0, p25, p75, p100 = [_uint16_to_float(min_value, value_range, p) for p in percentiles.T]
+        # Stored column by column
+        data = np.frombuffer(buf, dtype=np.uint8, count=size, offset=pos).reshape(num_cols, num_rows).T
+        mat = _char_to_float(p0, p25, p75, p100, data)
+        pos += size
+    elif token == 'CM2':
+        data = np.frombuffer(buf, dtype='<u2', count=size, offset=pos).reshape(num_rows, num_cols)
+        mat = _uint16_to_float(min_value, value_range, data)
+        pos += 2 * size
+    elif token == 'CM3':
+        data = np.frombuffer(buf, dtype=np.uint8, count=size, offset=pos).reshape(num_rows, num_cols)
+        mat = _uint8_to_float(min_value, value_range, data)
+        pos += size
+    else:
+        raise ValueError('Unknown compressed matrix type: {:s}'.format(token))
+    return mat.astype(np.float32), pos
+
+
+def matrix_to_bytes(mat, compress=False):
+    '''Serialize a matrix in Kaldi binary format, without the binary marker'''
+
+    mat = np.asarray(mat, dtype='<f4')
+    if mat.ndim != 2:
+        raise ValueError('Only matrices can be written to the archive')
+    if compress:
+        return compress_matrix(mat)
+    return b'FM \x04' + struct.pack('<i', mat.shape[0]) + b'\x04' + struct.pack('<i', mat.shape[1]) + mat.tobytes()
+
+
+class KaldiArkWriter(object):
+    '''Streams matrices into a binary Kaldi ark file and its scp index
+
+    The output is what ``copy-feats ark,t:- ark,scp:<outfile>.ark,<outfile>.scp``
+    writes for float32 matrices, the scp points to ``<outfile>.ark:<offset>``.
+
+    Args:
+        outfile (str): Output file name without extension.
+        compress (bool): Write Kaldi compressed matrices.
+
+    '''
+
+    def __init__(self, outfile, compress=False):
+        self.ark_file = outfile + '.ark'
+        self.compress = compress
+        self.ark = open(self.ark_file, 'wb')
+        self.scp = open(outfile + '.scp', 'w')
+
+    def write(self, key, mat):
+        if not key or len(key.split()) != 1:
+            raise ValueError('Invalid utterance id: "{:s}"'.format(key))
+        self.ark.write(key.encode('utf-8') + b' ')
+        offset = self.ark.tell()
+        self.ark.write(b'\x00B' + matrix_to_bytes(mat, compress=self.compress))
+        self.scp.write('{:s} {:s}:{:d}\n'.format(key, self.ark_file, offset))
+
+    def flush(self):
+        self.ark.flush()
+        self.scp.flush()
+
+    def close(self):
+        self.ark.close()
+        self.scp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_BINARY_TYPES = {'FM': '<f4', 'DM': '<f8', 'FV': '<f4', 'DV': '<f8'}
+
+
+def _read_token(buf, pos):
+    end = buf.find(b' ', pos)
+    if end < 0:
+        raise ValueError('Truncated Kaldi archive at byte {:d}'.format(pos))
+    return buf[pos:end].decode('utf-8'), end + 1
+
+
+def _read_int32(buf, pos):
+    if buf[pos:pos + 1] != b'\x04':
+        raise ValueError('Expected a 4 byte integer at byte {:d}'.format(pos))
+    return struct.unpack_from('<i', buf, pos + 1)[0], pos + 5
+
+
+def _read_text_matrix(buf, pos):
+    end = buf.find(b']', pos)
+    if end < 0:
+        raise ValueError('Unterminated text matrix at byte {:d}'.format(pos))
+    rows = [row.split() for row in bytes(buf[buf.find(b'[', pos) + 1:end]).decode('utf-8').splitlines()]
+    rows = [row for row in rows if row]
+    mat = np.array(rows, dtype=np.float32).reshape(len(rows), -1) if rows else np.zeros((0, 0), np.float32)
+    return mat, end + 1
+
+
+def read_matrix(buf, pos=0, copy=True):
+    '''Parse the Kaldi matrix or vector starting at a position of a buffer
+
+    Binary float matrices are returned as views of the buffer when copy is
+    False, which makes reads from a memory mapped archive lazy.
+
+    Args:
+        buf (bytes or mmap.mmap): Archive content.
+        pos (int): Position of the binary marker or the text matrix.
+        copy (bool): Copy float matrices out of the buffer.
+
+    Returns:
+        mat (numpy.ndarray): Matrix (float32 for compressed matrices).
+        pos (int): Position after the matrix.
+
+    '''
+
+    if buf[pos:pos + 2] != b'\x00B':
+        return _read_text_matrix(buf, pos)
+    token, pos = _read_token(buf, pos + 2)
+    if token.startswith('CM'):
+        return decompress_matrix(buf, pos, token)
+    if token not in _BINARY_TYPES:
+        raise ValueError('Unsupported Kaldi object: {:s}'.format(token))
+    dtype = np.dtype(_BINARY_TYPES[token])
+    if token.endswith('M'):
+        num_rows, pos = _read_int32(buf, pos)
+        num_cols, pos = _read_int32(buf, pos)
+        shape = (num_rows, num_cols)
+    else:
+        num_cols, pos = _read_int32(buf, pos)
+        shape = (num_cols,)
+    size = int(np.prod(shape))
+    mat = np.frombuffer(buf, dtype=dtype, count=size, offset=pos).reshape(shape)
+    return (mat.copy() if copy else mat), pos + size * dtype.itemsize
+
+
+def _open_buffer(ark_file, use_mmap):
+    with open(ark_file, 'rb') as fid:
+        if use_mmap:
+            return mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        return fid.read()
+
+
+def read_ark_buffer(buf, copy=True):
+    '''Iterate over (key, matrix) pairs of an archive held in a buffer'''
+
+    pos = 0
+    while pos < len(buf):
+        # Skip separators between text matrices
+        while pos < len(buf) and buf[pos:pos + 1].isspace():
+            pos += 1
+        if pos >= len(buf):
+            break
+        key, pos = _read_token(buf, pos)
+        mat, pos = read_matrix(buf, pos, copy=copy)
+        yield key, mat
+
+
+def read_ark(ark_file, use_mmap=False):
+    '''Iterate over (key, matrix) pairs of a Kaldi ark file
+
+    Args:
+        ark_file (str): Binary or text archive.
+        use_mmap (bool): Memory map the archive and return float matrices as
+            read-only views of it instead of reading it into memory.
+
+    '''
+
+    buf = _open_buffer(ark_file, use_mmap)
+    for key, mat in read_ark_buffer(buf, copy=not use_mmap):
+        yield key, mat
+
+
+def read_scp_index(scp_file):
+    '''Map every key of an scp file to the (ark file, byte offset) of its matrix'''
+
+    index = {}
+    with open(scp_file, 'r') as fid:
+        for line in fid:
+            tokens = line.strip().split(None, 1)
+            if not tokens:
+                continue
+            if len(tokens) != 2 or tokens[1].endswith('|') or tokens[1].endswith(']'):
+                raise ValueError('Only ark:offset entries are supported: "{:s}"'.format(line.strip()))
+            ark_file, offset = tokens[1].rsplit(':', 1)
+            index[tokens[0]] = (ark_file, int(offset))
+    return index
+
+
+class KaldiScpReader(Mapping):
+    '''Random access to the matrices of an scp file, read on demand
+
+    Every archive is opened once, matrices are only parsed when accessed.
+
+    Args:
+        scp_file (str): scp file with ark:offset entries.
+        use_mmap (bool): Memory map the archives and return float matrices as
+            read-only views instead of copies.
+
+    '''
+
+    def __init__(self, scp_file, use_mmap=True):
+        self.index = read_scp_index(scp_file)
+        self.use_mmap = use_mmap
+        self.buffers = {}
+
+    def __getitem__(self, key):
+        ark_file, offset = self.index[key]
+        if ark_file not in self.buffers:
+            self.buffers[ark_file] = _open_buffer(ark_file, self.use_mmap)
+        return read_matrix(self.buffers[ark_file], offset, copy=not self.use_mmap)[0]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
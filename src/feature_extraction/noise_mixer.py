@@ -0,0 +1,110 @@
+"""
+Additive noise for feature extraction in noisy conditions
+
+Author: Samik Sadhu
+"""
+
+import collections
+import hashlib
+import os
+import numpy as np
+from scipy.io.wavfile import read
+from utils import mixAtSnrs
+
+
+class NoiseMixer(object):
+    '''Mixes every noise type into an utterance at every SNR
+
+    Noise wav files are memory-mapped once per job and only the segment
+    added to an utterance is read. The segments are drawn by a random
+    generator seeded with the seed and the utterance id, so the noisy
+    signals are reproducible and do not depend on how the scp is split into
+    jobs. All SNRs of a noise type share one segment and are mixed in one
+    vectorized pass. The noise type "white" is white Gaussian noise and
+    "clean" adds no noise.
+
+    Args:
+        noise_types (list): Noise names (<noise_dir>/<name>.wav), "white" or "clean".
+        snrs (list): SNRs in dB as given on the command line, names of the conditions use them as is.
+        noise_dir (str): Directory of the noise wav files.
+        seed (int): Seed of the noise segment selection.
+
+    '''
+
+    def __init__(self, noise_types, snrs, noise_dir='noises', seed=0):
+        self.noise_dir = noise_dir
+        self.seed = seed
+        self.snrs = [float(snr) for snr in snrs]
+        self.noises = collections.OrderedDict()
+        self.names = []
+        for noise_type in noise_types:
+            if noise_type in self.noises:
+                raise ValueError('Noise type {:s} is given twice'.format(noise_type))
+            if noise_type == 'clean':
+                self.noises[noise_type] = None
+                self.names.append('clean')
+                continue
+            self.noises[noise_type] = None if noise_type == 'white' else self.load(noise_type)
+            self.names += ['{:s}_snr{:s}'.format(noise_type, snr) for snr in snrs]
+
+    def load(self, noise_type):
+        noise_file = os.path.join(self.noise_dir, noise_type + '.wav')
+        if not os.path.isfile(noise_file):
+            raise IOError('Noise file {:s} not found'.format(noise_file))
+        sr, noise = read(noise_file, mmap=True)
+        return noise[:, 0] if noise.ndim > 1 else noise
+
+    def rng(self, uttid):
+        return np.random.default_rng([self.seed, int(hashlib.sha1(uttid.encode('utf-8')).hexdigest()[:15], 16)])
+
+    def segment(self, rng, noise_type, length):
+        '''Noise segment of length samples, noises shorter than the utterance are repeated'''
+
+        if noise_type == 'white':
+            return rng.standard_normal(length, dtype=np.float32)
+        noise = self.noises[noise_type]
+        if len(noise) < length:
+            return np.resize(noise, length)
+        start = int(rng.integers(0, len(noise) - length + 1))
+        return noise[start:start + length]
+
+    def mix(self, uttid, signal):
+        '''Noisy signals, one float32 row per condition in the order of names'''
+
+        rng = self.rng(uttid)
+        out = np.empty((len(self.names), len(signal)), dtype=np.float32)
+        row = 0
+        for noise_type in self.noises:
+            if noise_type == 'clean':
+                out[row] = signal
+                row += 1
+            else:
+                mixAtSnrs(signal, self.segment(rng, noise_type, len(signal)), self.snrs,
+                          out=out[row:row + len(self.snrs)])
+                row += len(self.snrs)
+        return out
+
+    def outfile(self, outfile, name):
+        '''Output file of a condition, the condition name goes before the extension (e.g. the job number)'''
+
+        root, ext = os.path.splitext(outfile)
+        return '{:s}.{:s}{:s}'.format(root, name, ext)
+
+
+def add_noise_args(parser):
+    '''Noise mixing options shared by the feature extraction scripts'''
+
+    parser.add_argument("--add_noise", type=str, default='clean',
+                        help="Comma separated noise types (noise_dir/<type>.wav, white or clean), features are "
+                             "written for every noise type and SNR to <outfile>.<type>_snr<snr> (default: clean)")
+    parser.add_argument("--snrs", type=str, default='10', help="Comma separated SNRs in dB")
+    parser.add_argument("--noise_dir", type=str, default='noises', help="Directory of the noise wav files")
+    parser.add_argument("--noise_seed", type=int, default=0, help="Seed of the noise segment selection")
+
+
+def open_noise_mixer(args):
+    '''NoiseMixer of the add_noise_args options, None for clean speech only'''
+
+    if args.add_noise == 'clean':
+        return None
+    return NoiseMixer(args.add_noise.split(','), args.snrs.split(','), noise_dir=args.noise_dir, seed=args.noise_seed)
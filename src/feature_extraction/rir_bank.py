@@ -0,0 +1,127 @@
+"""
+Room impulse responses for reverberation sweeps
+
+Author: Samik Sadhu
+"""
+
+import collections
+import glob
+import os
+import numpy as np
+import scipy.fft
+from scipy.io.wavfile import read
+from utils import reverbFftSize, reverbFromSpectra
+
+# Short names of the RIRs used by the average spectrum recipes
+PRESET_RIRS = collections.OrderedDict([
+    ('small_room', './RIR/RIR_SmallRoom1_near_AnglA.wav'),
+    ('large_room', './RIR/RIR_LargeRoom1_far_AnglA.wav'),
+])
+
+
+def load_rir(rir_file):
+    '''First channel of a RIR wav file, PCM samples are scaled by 1 / 2^15'''
+
+    sr, rir = read(rir_file)
+    if rir.ndim > 1:
+        rir = rir[:, 0]
+    if np.issubdtype(rir.dtype, np.integer):
+        return rir / np.power(2, 15)
+    return rir.astype(np.float64)
+
+
+def resolve_rirs(spec):
+    '''(name, wav file) of the conditions of a comma separated RIR specification
+
+    Every item is "clean" (no reverberation, the wav file is None), one of
+    PRESET_RIRS, a wav file or a directory of wav files.
+    '''
+
+    conditions = []
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if item == 'clean':
+            conditions.append(('clean', None))
+        elif item in PRESET_RIRS:
+            conditions.append((item, PRESET_RIRS[item]))
+        elif os.path.isdir(item):
+            rir_files = sorted(glob.glob(os.path.join(item, '*.wav')))
+            if not rir_files:
+                raise ValueError('No wav files found in RIR directory {:s}'.format(item))
+            conditions += [(os.path.splitext(os.path.basename(f))[0], f) for f in rir_files]
+        elif os.path.isfile(item):
+            conditions.append((os.path.splitext(os.path.basename(item))[0], item))
+        else:
+            raise ValueError('Invalid type of reverberation: {:s}'.format(item))
+    names = [name for name, _ in conditions]
+    if len(set(names)) != len(names):
+        raise ValueError('RIR names are not unique: {:s}'.format(' '.join(names)))
+    return conditions
+
+
+class RirBank(object):
+    '''Set of room impulse responses applied together to every utterance
+
+    The RIRs are read once per job. For every utterance the signal is
+    transformed once at an FFT size that fits the longest RIR, and each RIR
+    is applied with its cached spectrum at that size, so a sweep over K
+    rooms costs one audio read and one forward FFT instead of K corpus
+    passes. The output of every RIR is the same as addReverb_nodistortion.
+
+    Args:
+        spec (str): Comma separated RIR specification, see resolve_rirs. None means clean only.
+        max_sizes (int): Number of FFT sizes for which the RIR spectra are kept.
+
+    '''
+
+    def __init__(self, spec=None, max_sizes=4):
+        self.conditions = resolve_rirs(spec if spec else 'clean')
+        self.rirs = collections.OrderedDict(
+            (name, load_rir(rir_file) if rir_file else None) for name, rir_file in self.conditions)
+        self.names = list(self.rirs)
+        self.max_len = max([len(rir) for rir in self.rirs.values() if rir is not None] + [1])
+        self.max_sizes = max_sizes
+        self._spectra = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def spectra(self, nfft):
+        '''rfft of every RIR at size nfft, None for the clean condition'''
+
+        if nfft in self._spectra:
+            self._spectra.move_to_end(nfft)
+        else:
+            if len(self._spectra) >= self.max_sizes:
+                self._spectra.popitem(last=False)
+            self._spectra[nfft] = [scipy.fft.rfft(rir, nfft) if rir is not None else None
+                                   for rir in self.rirs.values()]
+        return self._spectra[nfft]
+
+    def apply(self, sig):
+        '''Yields (name, reverberated signal, index of the direct path) for every condition
+
+        The clean condition yields the signal itself with index 0.
+        '''
+
+        sig = np.asarray(sig, dtype=np.float64)
+        if any(rir is not None for rir in self.rirs.values()):
+            nfft = reverbFftSize(len(sig) + self.max_len - 1)
+            sig_spec = scipy.fft.rfft(sig, nfft)
+            spectra = self.spectra(nfft)
+        for k, (name, rir) in enumerate(self.rirs.items()):
+            if rir is None:
+                yield name, sig, 0
+            else:
+                out, indM = reverbFromSpectra(sig_spec, spectra[k], nfft, len(sig), len(rir))
+                yield name, out, indM
+
+    def outfile(self, outfile, name):
+        '''Output file of a condition, outfile itself when the bank has a single condition'''
+
+        if len(self) == 1:
+            return outfile
+        root, ext = os.path.splitext(outfile)
+        return '{:s}.{:s}{:s}'.format(root, name, ext)
@@ -4,122 +4,273 @@ Utility functions for feature computation
 Author: Samik Sadhu
 """
 
+import hashlib
 import numpy as np
+import scipy.fft
 import scipy.linalg as lpc_solve
 import subprocess
 import os
 import sys
 from scipy.io.wavfile import read
+from kaldi_ark import KaldiArkWriter, read_ark, read_ark_buffer
 
 
-def get_kaldi_ark(feat_dict, outfile, kaldi_cmd='copy-feats'):
-    with open(outfile + '.txt', 'w+') as file:
+def get_kaldi_ark(feat_dict, outfile, kaldi_cmd=None, compress=False):
+    '''Write a dict of matrices to <outfile>.ark and <outfile>.scp
+
+    The archive is written directly in binary, kaldi_cmd is kept for
+    backward compatibility and ignored.
+    '''
+
+    with KaldiArkWriter(outfile, compress=compress) as writer:
         for key, feat in feat_dict.items():
-            np.savetxt(file, feat, fmt='%.3f', header=key + ' [', footer=' ]', comments='')
-    cmd = kaldi_cmd + ' ark,t:' + outfile + '.txt' + ' ark,scp:' + outfile + '.ark,' + outfile + '.scp'
-    subprocess.run(cmd, shell=True)
-    os.remove(outfile + '.txt')
+            writer.write(key, feat)
+
+
+def mixAtSnrs(sig, noise, snrs, dtype=np.float32, out=None):
+    '''Add a noise segment to a signal at several SNRs in one pass
+
+    Args:
+        sig (numpy.ndarray): Signal.
+        noise (numpy.ndarray): Noise segment with the length of the signal.
+        snrs (list): Signal to noise ratios in dB.
+        dtype (numpy.dtype): Data type of the computation and of the output.
+        out (numpy.ndarray): Optional output array (len(snrs) x len(sig)).
+
+    Returns:
+        numpy.ndarray: Noisy signals, one row per SNR.
+    '''
+
+    sig = np.asarray(sig, dtype=dtype)
+    noise = np.asarray(noise, dtype=dtype)
+    # Energies as dot products, without squared copies of the signals
+    E_s = float(np.dot(sig, sig)) / sig.size
+    E_n = float(np.dot(noise, noise)) / noise.size
+    snrs = np.asarray(snrs, dtype=np.float64)
+    if E_n > 0:
+        alp = np.sqrt(E_s / (E_n * np.power(10, snrs / 10)))
+    else:
+        alp = np.zeros(snrs.shape)
+    if out is None:
+        out = np.empty((snrs.size, sig.size), dtype=dtype)
+    np.multiply(alp.astype(dtype)[:, np.newaxis], noise, out=out)
+    out += sig
+    return out
 
 
 def add_noise_to_wav(sig, noise, snr):
     rand_num = int(np.floor(np.random.rand() * (len(noise) - len(sig))))
     ns = noise[rand_num:rand_num + len(sig)]
-    E_s = np.mean(sig ** 2)
-    E_n = np.mean(ns ** 2)
-    alp = np.sqrt(E_s / (E_n * (10 ** (snr / 10))))
 
-    return sig + alp * ns
+    return mixAtSnrs(sig, ns, [snr], dtype=np.float64)[0]
 
 
-def load_noise(noise_type):
-    noise_file = "noises/" + noise_type + ".wav"
+def load_noise(noise_type, noise_dir='noises'):
+    noise_file = os.path.join(noise_dir, noise_type + ".wav")
 
     if os.path.isfile(noise_file):
-
-        sr, noise = read(noise_file)
+        # Memory-mapped, only the segments that are used are read
+        sr, noise = read(noise_file, mmap=True)
     else:
         print("Noise file " + noise_file + " not found!")
-        os.exit(1)
+        sys.exit(1)
 
     return noise  # / np.power(2, 15)
 
 
 def add_agwn(sig, noise, snr):
-    P_sig = np.sum(sig ** 2) / sig.size
-    P_noise = np.sum(noise ** 2) / noise.size
-
     if sig.size != noise.size:
         print('Signal and Noise dimension are not the same, not adding noise!')
 
         sig_mod = sig
     else:
 
-        k = np.sqrt(P_sig / (P_noise * np.power(10, (snr / 10))))
-        sig_mod = sig + k * noise
+        sig_mod = mixAtSnrs(sig, noise, [snr], dtype=np.float64)[0]
 
     return sig_mod
 
 
-def dict2Ark(feat_dict, outfile, kaldi_cmd):
-    with open(outfile + '.txt', 'w+') as file:
-        for key, feat in feat_dict.items():
-            np.savetxt(file, feat, fmt='%.3f', header=key + ' [', footer=' ]', comments='')
-    cmd = kaldi_cmd + ' ark,t:' + outfile + '.txt' + ' ark,scp:' + outfile + '.ark,' + outfile + '.scp'
-    subprocess.run(cmd, shell=True)
-    os.remove(outfile + '.txt')
-
-
-def ark2Dict(ark, dim, kaldi_cmd):
-    cmd = kaldi_cmd + ' ark:' + ark + ' ark,t:-'
-    proc = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
-    x = proc.stdout.decode('utf-8')
-    feat_count = 0
-    start = 0
-    feats = np.empty((0, dim))
-    all_feats = {}
-    fcount = 0;
-    for line in x.splitlines():
-
-        line = line.strip().split()
-        if len(line) >= 1:
-            if line[-1] == '[':
-                start = 1
-                feat_count += 1  # Starting of a feature
-                uttname = line[0]
-                feats = np.empty((0, dim))
-                fcount += 1;
-            if start == 1 and line[-1] != '[':
-                if line[-1] == ']':
-                    line = line[0:-1]
-                    x = np.array(line).astype(np.float)
-                    x = np.reshape(x, (1, len(x)))
-
-                    feats = np.concatenate((feats, x), axis=0)
-                    all_feats[uttname] = feats
-                    # Refresh everything
-                    start = 0
-                    feats = np.empty((0, dim))
-                else:
-                    x = np.array(line).astype(np.float)
-                    x = np.reshape(x, (1, len(x)))
-                    feats = np.concatenate((feats, x), axis=0)
-    print('%s: Tranfered %d utterances from ark to dict' % (sys.argv[0], fcount))
+def dict2Ark(feat_dict, outfile, kaldi_cmd=None, compress=False):
+    get_kaldi_ark(feat_dict, outfile, kaldi_cmd=kaldi_cmd, compress=compress)
+
+
+def ark2Dict(ark, dim=None, kaldi_cmd=None):
+    '''Load a Kaldi archive into a dict of matrices
+
+    Archive files are parsed directly. If kaldi_cmd is given (e.g.
+    copy-feats) or ark is a pipe ending with "|", the archive is read from
+    the binary output of the command.
+    '''
+
+    if kaldi_cmd is not None:
+        buf = subprocess.run(kaldi_cmd + ' ark:' + ark + ' ark:-', shell=True, stdout=subprocess.PIPE).stdout
+        all_feats = dict(read_ark_buffer(buf))
+    elif ark.endswith('|'):
+        buf = subprocess.run(ark[:-1], shell=True, stdout=subprocess.PIPE).stdout
+        all_feats = dict(read_ark_buffer(buf))
+    else:
+        all_feats = dict(read_ark(ark))
+    if dim is not None:
+        for uttname, feats in all_feats.items():
+            if feats.shape[-1] != dim:
+                raise ValueError('{:s} has dimension {:d}, expected {:d}'.format(uttname, feats.shape[-1], dim))
+    print('%s: Tranfered %d utterances from ark to dict' % (sys.argv[0], len(all_feats)))
     return all_feats
 
 
+# Spectra of the room impulse responses per FFT size, shared by all utterances of a job
+_rir_spectra = {}
+_RIR_SPECTRA_MAX = 32
+
+
+def reverbFftSize(length):
+    '''FFT size of at least length on a grid of 2^k * {1, 5/4, 3/2, 7/4}
+
+    The coarse grid keeps the number of distinct sizes over a corpus small, so
+    the cached RIR spectra are reused, at most 25% of the FFT is padding.
+    '''
+
+    if length <= 8:
+        return 8
+    base = 1 << (int(length - 1).bit_length() - 3)
+    return base * int(np.ceil(length / base))
+
+
+def rirSpectrum(reverb, nfft):
+    '''Real FFT of a room impulse response at size nfft, cached across calls'''
+
+    reverb = np.ascontiguousarray(reverb, dtype=np.float64)
+    key = (hashlib.sha1(reverb.tobytes()).hexdigest(), nfft)
+    spectrum = _rir_spectra.get(key)
+    if spectrum is None:
+        if len(_rir_spectra) >= _RIR_SPECTRA_MAX:
+            del _rir_spectra[next(iter(_rir_spectra))]
+        spectrum = scipy.fft.rfft(reverb, nfft)
+        _rir_spectra[key] = spectrum
+    return spectrum
+
+
+def reverbFromSpectra(sig_spec, reverb_spec, nfft, sig_len, reverb_len):
+    '''Reverberated signal and direct path index from the real FFTs of the signal and the RIR
+
+    Args:
+        sig_spec (numpy.ndarray): rfft of the signal at size nfft.
+        reverb_spec (numpy.ndarray): rfft of the room impulse response at size nfft.
+        nfft (int): FFT size, at least sig_len + reverb_len - 1.
+        sig_len (int): Number of samples of the signal.
+        reverb_len (int): Number of taps of the room impulse response.
+
+    Returns:
+        (numpy.ndarray, int): Full convolution of the signal with the RIR and the index of the direct path in it.
+    '''
+
+    # The delay is the lag of the maximum of the cross-correlation of the reverberated
+    # signal with the clean one over the reverb_len valid lags, same as
+    # np.correlate(sig, out, 'valid'), which has them in reverse order.
+    out_spec = sig_spec * reverb_spec
+    out = scipy.fft.irfft(out_spec, nfft)[:sig_len + reverb_len - 1]
+    out_spec *= sig_spec.conj()
+    xxc = scipy.fft.irfft(out_spec, nfft)[:reverb_len]
+    indM = len(xxc) - np.argmax(xxc[::-1])
+    return out, indM
+
+
+def _convolveReverb(sig, reverb):
+    # Full convolution and the index of the direct path, one FFT of the signal serves both
+    sig = np.asarray(sig, dtype=np.float64)
+    nfft = reverbFftSize(len(sig) + len(reverb) - 1)
+    return reverbFromSpectra(scipy.fft.rfft(sig, nfft), rirSpectrum(reverb, nfft), nfft, len(sig), len(reverb))
+
+
 def addReverb(sig, reverb):
-    out = np.convolve(sig, reverb)
-    xxc = np.correlate(sig, out, 'valid')
-    indM = len(xxc) - np.argmax(xxc)
+    out, indM = _convolveReverb(sig, reverb)
     out = out[indM:indM + len(sig)]
     return out
 
 def addReverb_nodistortion(sig, reverb):
-    out = np.convolve(sig, reverb, mode='full')
-    xxc = np.correlate(sig, out, 'valid')
-    indM = len(xxc) - np.argmax(xxc)
-    return out, indM
+    return _convolveReverb(sig, reverb)
+
+
+
+def _frame_geometry(srate, frate, flength):
+    flength_samples = int(srate * flength)
+    frate_samples = int(srate / frate)
 
+    if flength_samples % 2 == 0:
+        extend = int(flength_samples / 2) - 1
+    else:
+        extend = int((flength_samples - 1) / 2)
+    return flength_samples, frate_samples, extend
+
+
+def frameSignal(signal, srate, frate, flength):
+    '''Overlapping frames as a read-only strided view
+
+    Frame n spans samples n * frate_samples to n * frate_samples + flength_samples
+    of the reflect-padded signal, exactly the frames yielded by getFrames.
+
+    Args:
+        signal (numpy.ndarray): Audio signal.
+        srate (float): Sampling rate of the signal.
+        frate (float): Frame rate in Hz.
+        flength (float): Frame length in second.
+
+    Returns:
+        frames (numpy.ndarray): View of shape (n_frames, flength_samples).
+
+    '''
+
+    flength_samples, frate_samples, extend = _frame_geometry(srate, frate, flength)
+    sig_padded = np.pad(signal, extend, 'reflect')
+    if len(sig_padded) < flength_samples:
+        return np.zeros((0, flength_samples), dtype=sig_padded.dtype)
+    return np.lib.stride_tricks.sliding_window_view(sig_padded, flength_samples)[::frate_samples]
+
+
+def numFrames(num_samples, srate, frate, flength):
+    '''Number of frames frameSignal returns for a signal of num_samples samples'''
+
+    flength_samples, frate_samples, extend = _frame_geometry(srate, frate, flength)
+    padded_length = num_samples + 2 * extend
+    if padded_length < flength_samples:
+        return 0
+    return (padded_length - flength_samples) // frate_samples + 1
+
+
+class FrameWindower(object):
+    '''Windowed frames of a signal written into a reusable buffer
+
+    The window is applied to the strided frame view of frameSignal in one
+    broadcast multiply. The returned array is a view of the internal
+    buffer and is overwritten by the next call, unless an output array
+    with at least numFrames rows is given.
+
+    Args:
+        srate (float): Sampling rate of the signal.
+        frate (float): Frame rate in Hz.
+        flength (float): Frame length in second.
+        window (function): Window function (see numpy.hamming for instance).
+        dtype (numpy.dtype): Data type of the windowed frames.
+
+    '''
+
+    def __init__(self, srate, frate, flength, window=np.hamming, dtype=np.float64):
+        self.srate = srate
+        self.frate = frate
+        self.flength = flength
+        self.dtype = dtype
+        self.win = window(int(srate * flength)).astype(dtype)
+        self.buffer = np.empty((0, len(self.win)), dtype=dtype)
+
+    def __call__(self, signal, out=None):
+        frames = frameSignal(signal, self.srate, self.frate, self.flength)
+        if out is None:
+            if frames.shape[0] > self.buffer.shape[0]:
+                self.buffer = np.empty((frames.shape[0], len(self.win)), dtype=self.dtype)
+            out = self.buffer
+        out = out[:frames.shape[0]]
+        np.multiply(frames, self.win, out=out, casting='unsafe')
+        return out
 
 
 def getFrames(signal, srate, frate, flength, window):
@@ -138,27 +289,9 @@ def getFrames(signal, srate, frate, flength, window):
 
     '''
 
-    flength_samples = int(srate * flength)
-    frate_samples = int(srate / frate)
-
-    if flength_samples % 2 == 0:
-        sp_b = int(flength_samples / 2) - 1
-        sp_f = int(flength_samples / 2)
-        extend = int(flength_samples / 2) - 1
-    else:
-        sp_b = int((flength_samples - 1) / 2)
-        sp_f = int((flength_samples - 1) / 2)
-        extend = int((flength_samples - 1) / 2)
-
-    sig_padded = np.pad(signal, extend, 'reflect')
-    # sig_padded = signal
-    win = window(flength_samples)
-    idx = sp_b
-
-    while (idx + sp_f) < len(sig_padded):
-        frame = sig_padded[idx - sp_b:idx + sp_f + 1]
+    win = window(int(srate * flength))
+    for frame in frameSignal(signal, srate, frate, flength):
         yield frame * win
-        idx += frate_samples
 
 
 def spliceFeats(feats, context):
@@ -176,59 +309,39 @@ def spliceFeats(feats, context):
     return spliced_feats
 
 
+def _triangularFilters(bin, nbins):
+    # Filter m rises from bin[m - 1] to bin[m] and falls until bin[m + 1]
+    k = np.arange(nbins)[np.newaxis, :]
+    left, center, right = bin[:-2, np.newaxis], bin[1:-1, np.newaxis], bin[2:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rising = np.where((k >= left) & (k < center), (k - left) / (center - left), 0)
+        falling = np.where((k >= center) & (k < right), (right - k) / (right - center), 0)
+    return rising + falling
+
+
 def createFbank(nfilters, nfft, srate, warp_fact=1):
     mel_max = 2595 * np.log10(1 + (srate / warp_fact) / 1400)
     fwarped = np.linspace(0, mel_max, nfilters + 2)
 
-    mel_filts = np.zeros((nfilters, int(np.floor(nfft / 2 + 1))))
     hz_points = warp_fact * (700 * (10 ** (fwarped / 2595) - 1))
     bin = np.floor((nfft + 1) * hz_points / srate)
 
-    for m in range(1, nfilters + 1):
-        f_m_minus = int(bin[m - 1])  # left
-        f_m = int(bin[m])  # center
-        f_m_plus = int(bin[m + 1])  # right
-
-        for k in range(f_m_minus, f_m):
-            mel_filts[m - 1, k] = (k - bin[m - 1]) / (bin[m] - bin[m - 1])
-        for k in range(f_m, f_m_plus):
-            mel_filts[m - 1, k] = (bin[m + 1] - k) / (bin[m + 1] - bin[m])
-
-    return mel_filts
+    return _triangularFilters(bin, int(np.floor(nfft / 2 + 1)))
 
 def createHearingFbank(nfft, srate):
 
-    nfilters=20
     hz_points = np.asarray([250, 375, 505, 654, 795, 995, 1130, 1315, 1515, 1720, 1930, 2140, 2355, 2600, 2900, 3255, 3680, 4200, 4860, 5720, 7000])
     bin = np.floor((nfft + 1) * hz_points / srate)
-    mel_filts = np.zeros((nfilters, int(np.floor(nfft / 2 + 1))))
-
-    for m in range(1, nfilters + 1):
-        f_m_minus = int(bin[m - 1])  # left
-        f_m_plus = int(bin[m])  # center
-
-        for k in range(f_m_minus, f_m_plus):
-            mel_filts[m - 1, k] = 1
+    k = np.arange(int(np.floor(nfft / 2 + 1)))[np.newaxis, :]
 
-    return mel_filts
+    return ((k >= bin[:-1, np.newaxis]) & (k < bin[1:, np.newaxis])).astype(np.float64)
 
 def createLinearFbank(nfilters, nfft, srate):
 
-    mel_filts = np.zeros((nfilters, int(np.floor(nfft / 2 + 1))))
     hz_points = np.linspace(0, srate/2, nfilters + 2)
     bin = np.floor((nfft + 1) * hz_points / srate)
 
-    for m in range(1, nfilters + 1):
-        f_m_minus = int(bin[m - 1])  # left
-        f_m = int(bin[m])  # center
-        f_m_plus = int(bin[m + 1])  # right
-
-        for k in range(f_m_minus, f_m):
-            mel_filts[m - 1, k] = (k - bin[m - 1]) / (bin[m] - bin[m - 1])
-        for k in range(f_m, f_m_plus):
-            mel_filts[m - 1, k] = (bin[m + 1] - k) / (bin[m + 1] - bin[m])
-
-    return mel_filts
+    return _triangularFilters(bin, int(np.floor(nfft / 2 + 1)))
 
 
 def warp_func_bark(x, warp_fact=1):
@@ -241,23 +354,104 @@ def createFbankCochlear(nfilters, nfft, srate, om_w=0.2, alp=2.5, fixed=1, bet=2
     fwarped_cf = np.linspace(0, warped_max, nfilters)
     f_linear = np.linspace(0, f_max, int(np.floor(nfft / 2 + 1)))
     f_warped = warp_func_bark(f_linear, warp_fact)
-    filts = np.zeros((nfilters, int(np.floor(nfft / 2 + 1))))
-    alp_c = alp
-    for i in range(nfilters):
-        fc = fwarped_cf[i]
-        if fixed == 1:
-            alp = alp_c
-        else:
-            alp = alp_c * np.exp(-0.1 * fc)
-        for j, fw in enumerate(f_warped):
-            if fw - fc <= -om_w / 2:
-                filts[i, j] = np.power(10, alp * (fw - fc + om_w / 2))
-            elif fw - fc > -om_w / 2 and fw - fc < om_w / 2:
-                filts[i, j] = 1
-            else:
-                filts[i, j] = np.power(10, -bet * (fw - fc - om_w / 2))
-
-    return filts
+
+    if fixed == 1:
+        alp = np.full(nfilters, alp)
+    else:
+        alp = alp * np.exp(-0.1 * fwarped_cf)
+    # Distance of every frequency from every center frequency on the warped scale
+    dist = f_warped[np.newaxis, :] - fwarped_cf[:, np.newaxis]
+    lower = np.power(10, alp[:, np.newaxis] * np.minimum(dist + om_w / 2, 0))
+    upper = np.power(10, -bet * np.maximum(dist - om_w / 2, 0))
+
+    return np.where(dist <= -om_w / 2, lower, np.where(dist < om_w / 2, 1, upper))
+
+
+def parseFbankType(fbank_type, nfilters, nfft, srate):
+    '''Filter bank name and parameters of a --fbank_type string
+
+    Returns:
+        params (tuple): Every parameter that determines the filter bank.
+
+    '''
+
+    fbank_type = fbank_type.strip().split(',')
+    if fbank_type[0] == "mel":
+        if len(fbank_type) < 2:
+            raise ValueError('Mel filter bank not configured properly....')
+        return ('mel', nfilters, nfft, srate, float(fbank_type[1]))
+    elif fbank_type[0] == "cochlear":
+        if len(fbank_type) < 6:
+            raise ValueError('Cochlear filter bank not configured properly....')
+        if int(fbank_type[3]) == 1:
+            print('%s: Alpha is fixed and will not change as a function of the center frequency...' % sys.argv[0])
+        return ('cochlear', nfilters, nfft, srate, float(fbank_type[1]), float(fbank_type[2]), int(fbank_type[3]),
+                float(fbank_type[4]), float(fbank_type[5]))
+    elif fbank_type[0] == "uniform":
+        return ('uniform', nfilters, nfft, srate)
+    elif fbank_type[0] == "hearing":
+        return ('hearing', nfft, srate)
+    else:
+        raise ValueError('Invalid type of filter bank, use mel or cochlear with proper configuration')
+
+
+def createFbankFromParams(params):
+    name = params[0]
+    if name == 'mel':
+        _, nfilters, nfft, srate, warp_fact = params
+        return createFbank(nfilters, nfft, srate, warp_fact=warp_fact)
+    elif name == 'cochlear':
+        _, nfilters, nfft, srate, om_w, alp, fixed, bet, warp_fact = params
+        return createFbankCochlear(nfilters, nfft, srate, om_w=om_w, alp=alp, fixed=fixed, bet=bet,
+                                   warp_fact=warp_fact)
+    elif name == 'uniform':
+        _, nfilters, nfft, srate = params
+        return createLinearFbank(nfilters, nfft, srate)
+    elif name == 'hearing':
+        _, nfft, srate = params
+        return createHearingFbank(nfft, srate)
+    raise ValueError('Invalid type of filter bank: {:s}'.format(name))
+
+
+# Bump when a filter bank definition changes so that stale cache entries are not used
+FBANK_CACHE_VERSION = 1
+
+
+def getFbank(fbank_type, nfilters, nfft, srate, cache_dir=None):
+    '''Filter bank of a --fbank_type string, optionally cached on disk
+
+    Cached filter banks are stored as <cache_dir>/<name>_<hash>.npy where the
+    hash covers every parameter, so parallel jobs of the same configuration
+    build the filter bank once and load it afterwards.
+
+    Args:
+        fbank_type (str): mel,warp_fact OR cochlear,om_w,alpa,fixed,beta,warp_fact, OR uniform OR hearing.
+        nfilters (int): Number of filters.
+        nfft (int): Number of points of the FFT.
+        srate (int): Sampling rate.
+        cache_dir (str): Cache directory, None to always build the filter bank.
+
+    Returns:
+        fbank (numpy.ndarray): Filter bank (nfilters x nfft / 2 + 1).
+
+    '''
+
+    params = parseFbankType(fbank_type, nfilters, nfft, srate)
+    if cache_dir is None:
+        return createFbankFromParams(params)
+
+    key = hashlib.sha1(repr((FBANK_CACHE_VERSION,) + params).encode('utf-8')).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, '{:s}_{:s}.npy'.format(params[0], key))
+    if os.path.isfile(cache_file):
+        return np.load(cache_file)
+
+    fbank = createFbankFromParams(params)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write under a unique name and rename, concurrent jobs may build the same filter bank
+    tmp_file = '{:s}.{:d}.tmp.npy'.format(cache_file[:-4], os.getpid())
+    np.save(tmp_file, fbank)
+    os.replace(tmp_file, cache_file)
+    return fbank
 
 
 def computeLpcFast(signal, order, keepreal=True):
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+Author: samiksadhu, Johns Hopkins University
+"""
+
+'Convert phoneme alignments into a run-length encoded label store'
+
+import argparse
+import collections
+import collections.abc
+import multiprocessing
+import os
+import numpy as np
+import kaldi_io
+
+# Longer runs are split, so run lengths fit in uint16
+MAX_RUN = np.iinfo(np.uint16).max
+
+
+def get_ali_files(ali_dir):
+    '''(alignment file, model) of every ali.*.gz file of a comma separated list of alignment directories'''
+
+    ali_files = []
+    for one_dir in ali_dir.split(','):
+        mdl = os.path.join(one_dir, 'final.mdl')
+        ali_files.extend([(os.path.join(one_dir, f), mdl) for f in sorted(os.listdir(one_dir)) if f.startswith('ali.')])
+    return ali_files
+
+
+def decode_phone_alignments(ali_file, mdl):
+    '''Per-frame phone labels of all the utterances in one alignment file'''
+
+    pdf_ali_file = "ark:ali-to-phones --per-frame {} ark:'gunzip -c {} |' ark:- |".format(mdl, ali_file)
+    return [(u, d) for u, d in kaldi_io.read_vec_int_ark(pdf_ali_file)]
+
+
+def run_length_encode(labels):
+    '''Labels and uint16 lengths of the runs of equal labels in a frame-wise label sequence'''
+
+    labels = np.asarray(labels)
+    if len(labels) == 0:
+        return labels[:0], np.zeros(0, dtype=np.uint16)
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(labels)) + 1])
+    lengths = np.diff(np.concatenate([starts, [len(labels)]]))
+    values = labels[starts]
+    if np.any(lengths > MAX_RUN):
+        pieces = (lengths + MAX_RUN - 1) // MAX_RUN
+        values = np.repeat(values, pieces)
+        split_lengths = np.full(np.sum(pieces), MAX_RUN, dtype=np.int64)
+        split_lengths[np.cumsum(pieces) - 1] = lengths - (pieces - 1) * MAX_RUN
+        lengths = split_lengths
+    return values, lengths.astype(np.uint16)
+
+
+def _encode_ali_file(job):
+    ali_file, mdl = job
+    encoded = [(uttid,) + run_length_encode(ali) for uttid, ali in decode_phone_alignments(ali_file, mdl)]
+    print('Decoded {:d} utterances from {:s}'.format(len(encoded), ali_file))
+    return encoded
+
+
+def write_alignment_store(ali_dir, store_dir, num_workers=1):
+    '''Decode the alignments once and write them to a run-length encoded store
+
+    The store directory holds the run labels (uint8 or uint16) and run
+    lengths (uint16) of all utterances back to back in labels.npy and
+    lengths.npy, and an index with the first run, the number of runs and
+    the number of frames of every utterance. The index is written last, a
+    store is complete once it exists.
+
+    Args:
+        ali_dir (str): Comma separated alignment directories with ali.*.gz and final.mdl.
+        store_dir (str): Output directory.
+        num_workers (int): Number of alignment files decoded in parallel.
+
+    '''
+
+    jobs = get_ali_files(ali_dir)
+    if not jobs:
+        raise IOError('No alignment files found in {:s}'.format(ali_dir))
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            encoded = [utt for one_file in pool.map(_encode_ali_file, jobs) for utt in one_file]
+    else:
+        encoded = [utt for job in jobs for utt in _encode_ali_file(job)]
+
+    values = np.concatenate([v for _, v, _ in encoded])
+    lengths = np.concatenate([l for _, _, l in encoded])
+    min_label, max_label = int(np.min(values)), int(np.max(values))
+    if min_label < 0 or max_label > np.iinfo(np.uint16).max:
+        raise ValueError('Labels must be between 0 and 65535, found {:d} to {:d}'.format(min_label, max_label))
+    values = values.astype(np.uint8 if max_label <= np.iinfo(np.uint8).max else np.uint16)
+
+    os.makedirs(store_dir, exist_ok=True)
+    index_file = os.path.join(store_dir, 'index')
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+    np.save(os.path.join(store_dir, 'labels.npy'), values)
+    np.save(os.path.join(store_dir, 'lengths.npy'), lengths)
+    with open(index_file + '.tmp', 'w') as fid:
+        fid.write('# min_label {:d} max_label {:d}\n'.format(min_label, max_label))
+        start = 0
+        for uttid, v, l in encoded:
+            fid.write('{:s} {:d} {:d} {:d}\n'.format(uttid, start, len(v), int(np.sum(l, dtype=np.int64))))
+            start += len(v)
+    os.replace(index_file + '.tmp', index_file)
+    print('Wrote {:d} utterances, {:d} runs of {:d} frames to {:s}'.format(len(encoded), len(values),
+                                                                       int(np.sum(lengths, dtype=np.int64)),
+                                                                       store_dir))
+
+
+def is_alignment_store(path):
+    return os.path.isfile(os.path.join(path, 'index'))
+
+
+class AlignmentStore(collections.abc.Mapping):
+    '''Read-only dict of frame-wise labels backed by a store of write_alignment_store
+
+    The runs are memory mapped and only the index lines of the requested
+    utterances are kept, so a job holds the labels of its own shard. Labels
+    are expanded to int32 arrays on access, as read by kaldi_io.
+
+    Args:
+        store_dir (str): Store directory.
+        uttids (iterable): Utterances to load, all if None.
+
+    '''
+
+    def __init__(self, store_dir, uttids=None):
+        self.store_dir = store_dir
+        self.labels = np.load(os.path.join(store_dir, 'labels.npy'), mmap_mode='r')
+        self.lengths = np.load(os.path.join(store_dir, 'lengths.npy'), mmap_mode='r')
+        uttids = set(uttids) if uttids is not None else None
+        self.index = collections.OrderedDict()
+        with open(os.path.join(store_dir, 'index'), 'r') as fid:
+            header = fid.readline().split()
+            self.min_label, self.max_label = int(header[2]), int(header[4])
+            for line in fid:
+                tokens = line.split()
+                if uttids is None or tokens[0] in uttids:
+                    self.index[tokens[0]] = (int(tokens[1]), int(tokens[2]), int(tokens[3]))
+
+    def __getitem__(self, uttid):
+        start, num_runs, _ = self.index[uttid]
+        return np.repeat(self.labels[start:start + num_runs].astype(np.int32), self.lengths[start:start + num_runs])
+
+    def __contains__(self, uttid):
+        return uttid in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def num_frames(self, uttid):
+        return self.index[uttid][2]
+
+
+def load_alignments(ali_dir, uttids=None):
+    '''Frame-wise phone labels from an alignment store, or decoded from alignment directories
+
+    Args:
+        ali_dir (str): Alignment store or comma separated alignment directories.
+        uttids (iterable): Utterances needed, only used with a store.
+
+    Returns:
+        alis: AlignmentStore or dict of int32 label arrays.
+
+    '''
+
+    if is_alignment_store(ali_dir):
+        return AlignmentStore(ali_dir, uttids=uttids)
+    pdf_ali_dict = {}
+    for ali_file, mdl in get_ali_files(ali_dir):
+        pdf_ali_dict.update(decode_phone_alignments(ali_file, mdl))
+    return pdf_ali_dict
+
+
+def scp_uttids(scp):
+    with open(scp, 'r') as fid:
+        return [line.split(None, 1)[0] for line in fid if line.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Convert phoneme alignments into a run-length encoded label store')
+    parser.add_argument('phoneme_ali_dir', help='Phoneme alignment directory, several can be separated by commas')
+    parser.add_argument('store_dir', help='Output store directory')
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Number of alignment files decoded in parallel")
+    args = parser.parse_args()
+
+    write_alignment_store(args.phoneme_ali_dir, args.store_dir, num_workers=args.num_workers)
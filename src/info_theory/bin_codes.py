@@ -0,0 +1,174 @@
+"""
+Per-frame bin codes of features, to histogram other label sets or shifts without reading the features again
+
+Author: Samik Sadhu
+"""
+
+import argparse
+import collections
+import collections.abc
+import glob
+import os
+import numpy as np
+
+# Bin indices are stored as uint8
+MAX_CODE_BINS = np.iinfo(np.uint8).max + 1
+
+
+def _edges_file(store_dir):
+    return os.path.join(store_dir, 'edges.npz')
+
+
+def _complete_file(store_dir):
+    return os.path.join(store_dir, 'complete')
+
+
+def read_store_edges(store_dir):
+    '''(bin edges, binning, feature dimension) of a bin code store'''
+
+    with np.load(_edges_file(store_dir)) as data:
+        return data['sig_bins'], str(data['binning']), int(data['feat_dim'])
+
+
+def is_bin_code_store(store_dir):
+    '''Whether a store is complete, i.e. all its writers have finished'''
+
+    return os.path.isfile(_complete_file(store_dir))
+
+
+def mark_complete(store_dir):
+    '''Mark a store complete, to be called once all the jobs writing it have succeeded'''
+
+    if not os.path.isfile(_edges_file(store_dir)):
+        raise IOError('No bin code store in {:s}'.format(store_dir))
+    open(_complete_file(store_dir), 'w').close()
+
+
+class BinCodeWriter(object):
+    '''Appends the uint8 bin codes of utterances to one part of a bin code store
+
+    A store directory holds the bin edges (edges.npz) and, for every part
+    (e.g. one job or worker), the codes of its utterances back to back in
+    <part>.codes (frames x feat_dim) with an index <part>.index of
+    "uttid offset num_frames" lines. The edges and every index are written
+    under a temporary name and renamed, the index on close. All parts of a
+    store share the same edges. Jobs write their parts concurrently, so a
+    store can only be read after the jobs have finished and it has been
+    marked complete with mark_complete (or the "complete" file).
+
+    Args:
+        store_dir (str): Store directory.
+        part (str): Name of the part, unique among the writers of the store.
+        sig_bins (numpy.ndarray): Bin edges, shared or per dimension.
+        binning (str): Binning strategy of the edges.
+        feat_dim (int): Feature dimension.
+
+    '''
+
+    def __init__(self, store_dir, part, sig_bins, binning, feat_dim):
+        if sig_bins.shape[-1] - 1 > MAX_CODE_BINS:
+            raise ValueError('Bin codes need at most {:d} bins, got {:d}'.format(MAX_CODE_BINS,
+                                                                                 sig_bins.shape[-1] - 1))
+        os.makedirs(store_dir, exist_ok=True)
+        try:
+            # The store is being rewritten, it is not complete until the writers finish again
+            os.remove(_complete_file(store_dir))
+        except FileNotFoundError:
+            pass
+        if os.path.isfile(_edges_file(store_dir)):
+            store_bins, store_binning, store_dim = read_store_edges(store_dir)
+            if store_binning != binning or store_dim != feat_dim or not np.array_equal(store_bins, sig_bins):
+                raise ValueError('Bin code store {:s} was written with different bin edges'.format(store_dir))
+        else:
+            # Concurrent jobs write the same edges
+            tmp_file = '{:s}.{:d}.tmp'.format(_edges_file(store_dir), os.getpid())
+            with open(tmp_file, 'wb') as fid:
+                np.savez(fid, sig_bins=sig_bins, binning=np.asarray(binning), feat_dim=np.asarray(feat_dim))
+            os.replace(tmp_file, _edges_file(store_dir))
+        self.feat_dim = feat_dim
+        self.prefix = os.path.join(store_dir, part)
+        if os.path.isfile(self.prefix + '.index'):
+            os.remove(self.prefix + '.index')
+        self.codes_fid = open(self.prefix + '.codes', 'wb')
+        self.index = []
+        self.num_frames = 0
+
+    def write(self, uttid, bin_idx):
+        '''Add the bin indices (frames x feat_dim) of an utterance'''
+
+        codes = np.ascontiguousarray(bin_idx[:, :self.feat_dim], dtype=np.uint8)
+        self.codes_fid.write(codes.tobytes())
+        self.index.append((uttid, self.num_frames, codes.shape[0]))
+        self.num_frames += codes.shape[0]
+
+    def close(self):
+        self.codes_fid.close()
+        with open(self.prefix + '.index.tmp', 'w') as fid:
+            for uttid, offset, num_frames in self.index:
+                fid.write('{:s} {:d} {:d}\n'.format(uttid, offset, num_frames))
+        os.replace(self.prefix + '.index.tmp', self.prefix + '.index')
+        print('Wrote bin codes of {:d} utterances, {:d} frames to {:s}.codes'.format(len(self.index),
+                                                                                   self.num_frames, self.prefix))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BinCodeStore(collections.abc.Mapping):
+    '''Read-only dict of the uint8 bin codes (frames x feat_dim) of every utterance of a store
+
+    The codes of every part are memory mapped, only the index lines of the
+    requested utterances are kept. The store must be complete.
+
+    Args:
+        store_dir (str): Store directory.
+        uttids (iterable): Utterances to load, all if None.
+
+    '''
+
+    def __init__(self, store_dir, uttids=None):
+        if not is_bin_code_store(store_dir):
+            raise IOError('Bin code store {:s} is not marked complete, its writers may not have finished'.format(
+                store_dir))
+        self.store_dir = store_dir
+        self.sig_bins, self.binning, self.feat_dim = read_store_edges(store_dir)
+        uttids = set(uttids) if uttids is not None else None
+        self.codes = {}
+        self.index = collections.OrderedDict()
+        for index_file in sorted(glob.glob(os.path.join(store_dir, '*.index'))):
+            part = index_file[:-len('.index')]
+            with open(index_file, 'r') as fid:
+                for line in fid:
+                    tokens = line.split()
+                    if uttids is None or tokens[0] in uttids:
+                        self.index[tokens[0]] = (part, int(tokens[1]), int(tokens[2]))
+
+    def _part_codes(self, part):
+        if part not in self.codes:
+            codes = np.memmap(part + '.codes', dtype=np.uint8, mode='r')
+            self.codes[part] = codes.reshape(-1, self.feat_dim)
+        return self.codes[part]
+
+    def __getitem__(self, uttid):
+        part, offset, num_frames = self.index[uttid]
+        return self._part_codes(part)[offset:offset + num_frames]
+
+    def __contains__(self, uttid):
+        return uttid in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Mark a bin code store complete once all the jobs writing it have finished')
+    parser.add_argument('store_dir', help='Bin code store directory')
+    args = parser.parse_args()
+
+    mark_complete(args.store_dir)
@@ -8,19 +8,136 @@ Author: samiksadhu, Johns Hopkins University
 'Computing Joint Histogram of features and Labels'
 
 import argparse
+import multiprocessing
 import os
 import pickle as pkl
+import numpy as np
+from histogram_utils import BINNINGS, JointHistogram, StreamingJointHistogram, get_bin_edges, load_histogram, \
+    save_histogram, get_dump_files
+
+
+def check_dumps(hist_files):
+    """Make sure all dumps can be added
+
+    Returns the first histogram, the frame count of every dump and whether all
+    dumps are dense, i.e. memory mapped.
+    """
+
+    header = load_histogram(hist_files[0], mmap=True)
+    num_frames = [header.num_frames]
+    dense = isinstance(header.counts, np.memmap)
+    for hfile in hist_files[1:]:
+        hist = load_histogram(hfile, mmap=True)
+        if type(hist) != type(header):
+            raise ValueError('{:s} mixes streaming and fixed-edge dumps'.format(hfile))
+        try:
+            header.check_compatible(hist)
+        except ValueError as err:
+            raise ValueError('{:s}: {:s}'.format(hfile, str(err)))
+        num_frames.append(hist.num_frames)
+        dense = dense and isinstance(hist.counts, np.memmap)
+    return header, num_frames, dense
+
+
+def _sum_dims(job):
+    """Sum a range of feature dimensions over all dense dumps"""
+
+    hist_files, d_start, d_end = job
+    total = None
+    for hfile in hist_files:
+        counts = load_histogram(hfile, mmap=True).counts[:, d_start:d_end]
+        if total is None:
+            total = np.array(counts, dtype=np.uint64)
+        else:
+            total += counts
+    return d_start, d_end, total
+
+
+def _merge_pair(pair):
+    """Merge two streaming dumps (file names or histograms)"""
+
+    hists = [load_histogram(item) if isinstance(item, str) else item for item in pair]
+    for hist in hists[1:]:
+        hists[0].merge(hist)
+    return hists[0]
+
+
+def combine_dense(hist_files, header, num_workers=1, dims_per_chunk=None):
+    num_shifts, feat_dim, num_bins, num_labels = header.counts.shape
+    if dims_per_chunk is None:
+        dims_per_chunk = max(1, feat_dim // (4 * num_workers))
+    jobs = [(hist_files, d, min(d + dims_per_chunk, feat_dim)) for d in range(0, feat_dim, dims_per_chunk)]
+
+    total = np.zeros(header.counts.shape, dtype=np.uint64)
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            for d_start, d_end, counts in pool.imap_unordered(_sum_dims, jobs):
+                total[:, d_start:d_end] = counts
+    else:
+        for job in jobs:
+            d_start, d_end, counts = _sum_dims(job)
+            total[:, d_start:d_end] = counts
+    return total
+
+
+def combine_streaming(hist_files, num_workers=1):
+    # Pairwise tree reduction, every level merges disjoint pairs in parallel
+    items = list(hist_files)
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            while len(items) > 1:
+                items = pool.map(_merge_pair, [items[n:n + 2] for n in range(0, len(items), 2)])
+    else:
+        while len(items) > 1:
+            items = [_merge_pair(items[n:n + 2]) for n in range(0, len(items), 2)]
+    return _merge_pair(items)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Combine histogram dumps')
     parser.add_argument('out_dir', help='Dump directory')
+    parser.add_argument("--prefix", type=str, default='', help="Only combine dumps starting with this prefix")
+    parser.add_argument("--num_jobs", type=int, default=None,
+                        help="Expect exactly the dumps <prefix>.1.hist.npz to <prefix>.<num_jobs>.hist.npz")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--num_bins", type=int, default=100,
+                        help="Number of histogram bins used to re-bin streaming dumps")
+    parser.add_argument("--binning", type=str, default='global', choices=BINNINGS,
+                        help="Bin edges used to re-bin streaming dumps, see compute_signal_label_confusion_matrix.py")
+    parser.add_argument("--out_file", type=str, default=None,
+                        help="Combined histogram (default: <out_dir>/combined.hist.npz)")
+    parser.add_argument("--write_legacy", action="store_true",
+                        help="Also write the float histogram with 1e-13 added to <out_dir>/combined.all")
     args = parser.parse_args()
 
-    pkl_files = [os.path.join(args.out_dir, f) for f in os.listdir(args.out_dir) if f.endswith('.pkl')]
+    out_file = args.out_file if args.out_file else os.path.join(args.out_dir, 'combined.hist.npz')
+    hist_files = get_dump_files(args.out_dir, prefix=args.prefix, num_jobs=args.num_jobs,
+                                exclude=os.path.abspath(out_file))
+    print('Combining {:d} histogram dumps'.format(len(hist_files)))
+    header, num_frames, dense = check_dumps(hist_files)
+
+    if isinstance(header, StreamingJointHistogram):
+        # Dumps from --streaming jobs, fix the global bin edges now
+        merged = combine_streaming(hist_files, num_workers=args.num_workers)
+        mn_f, mx_f = merged.minmax()
+        print('Global feature range of streaming dumps: {:f} to {:f}'.format(mn_f, mx_f))
+        pkl.dump({'min': mn_f, 'max': mx_f}, open(args.out_dir + '/minmax.feat.mnx', 'wb'))
+        # The merged fine histograms are the sketch of the per_dim and quantile edges
+        sig_bins = get_bin_edges(args.binning, args.num_bins, merged)
+        dist = JointHistogram(sig_bins, merged.shifts, merged.counts.shape[1], merged.counts.shape[3],
+                              labels=merged.labels, exclude_wrap=merged.exclude_wrap)
+        dist.counts = merged.finalize(sig_bins)
+    else:
+        dist = JointHistogram(header.sig_bins, header.shifts, header.counts.shape[1], header.counts.shape[3],
+                              labels=header.labels, exclude_wrap=header.exclude_wrap)
+        # Sparse dumps are decompressed as a whole, so they are not split along the feature dimension
+        dist.counts = combine_dense(hist_files, header, num_workers=args.num_workers,
+                                    dims_per_chunk=None if dense else header.counts.shape[1])
+    dist.num_frames = sum(num_frames)
 
-    dist = pkl.load(open(pkl_files[0], 'rb'))
-    for pfile in pkl_files[1:]:
-        dist += pkl.load(open(pfile, 'rb'))
+    save_histogram(out_file, dist, dump_num_frames=np.asarray(num_frames, dtype=np.int64),
+                   dump_files=np.asarray([os.path.basename(f) for f in hist_files]))
+    print('Wrote combined histogram of {:d} frames to {:s}'.format(dist.num_frames, out_file))
 
-    dist += 0.0000000000001
-    pkl.dump(dist, open(args.out_dir+'/combined.all', 'wb'))
+    if args.write_legacy:
+        pkl.dump(dist.counts.astype(np.float64) + 0.0000000000001, open(args.out_dir + '/combined.all', 'wb'))
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+Author: samiksadhu, Johns Hopkins University
+"""
+
+'Compute mutual information between features and labels with a k-nearest neighbor estimator'
+
+import argparse
+import numpy as np
+import kaldi_io
+from scipy.spatial import cKDTree
+from scipy.special import digamma
+from alignment_store import load_alignments, scp_uttids
+from compute_signal_label_confusion_matrix import get_transition_labels
+from histogram_utils import ThroughputMeter
+
+
+def parse_dim_groups(dim_groups, feat_dim):
+    """Feature dimensions of every group of a comma separated list like '0-9,10-19,20', every dimension if None"""
+
+    if not dim_groups:
+        return [[dim] for dim in range(feat_dim)]
+    groups = []
+    for item in dim_groups.split(','):
+        first, _, last = item.partition('-')
+        group = list(range(int(first), int(last if last else first) + 1))
+        if not group or group[-1] >= feat_dim:
+            raise ValueError('Invalid dimension group {:s} for {:d} dimensional features'.format(item, feat_dim))
+        groups.append(group)
+    return groups
+
+
+def group_name(group):
+    return str(group[0]) if len(group) == 1 else '{:d}-{:d}'.format(group[0], group[-1])
+
+
+def sample_frames(scp, alis, shifts, feat_dim=80, max_frames=20000, make_absolute=False, transition_width=None,
+                  exclude_wrap=False, seed=0):
+    """Uniform random subset of the labelled frames of an scp file
+
+    Every frame gets a random key and the frames with the max_frames
+    smallest keys are kept, so the sample is drawn in one pass without
+    knowing the number of frames in advance. The features of a frame are
+    taken at every shift the way np.roll shifts them in the histograms,
+    with the same frames marked invalid as shift_segments leaves out with
+    exclude_wrap.
+
+    Args:
+        scp (str): Feature scp file.
+        alis (dict): Frame-wise labels of every utterance.
+        shifts (list): Shifts of the features along the time axis.
+        feat_dim (int): Feature dimension.
+        max_frames (int): Frame budget.
+        make_absolute (bool): Compute np.abs() on the features.
+        transition_width (int): If given, the labels are 1 within this many frames of a phone boundary and 0
+            elsewhere instead of the phones.
+        exclude_wrap (bool): Mark invalid the frames whose shifted features wrap around the utterance.
+        seed (int): Seed of the frame selection.
+
+    Returns:
+        feats (numpy.ndarray): Features of the sampled frames (frames x num_shifts x feat_dim).
+        labels (numpy.ndarray): Labels of the sampled frames.
+        valid (numpy.ndarray): Whether a sampled frame is used at a shift (frames x num_shifts).
+        num_frames (int): Number of labelled frames in the scp file.
+
+    """
+
+    rng = np.random.RandomState(seed)
+    shifts = np.asarray(shifts)
+    keys, feats, labels = [np.zeros(0)], [np.zeros((0, len(shifts), feat_dim), dtype=np.float32)], \
+        [np.zeros(0, dtype=np.int64)]
+    valid = [np.zeros((0, len(shifts)), dtype=bool)]
+    buffered = 0
+    threshold = np.inf
+    num_frames = 0
+    absent_keys = 0
+    meter = ThroughputMeter()
+    for key, one_feats in kaldi_io.read_mat_scp(scp):
+        meter.update(one_feats.shape[0], one_feats.nbytes)
+        if key not in alis:
+            absent_keys += 1
+            continue
+        if transition_width is None:
+            one_labels = alis[key] - 1
+        else:
+            one_labels = get_transition_labels(alis[key], transition_width)
+        num = min(len(one_labels), one_feats.shape[0])
+        num_frames += num
+        one_keys = rng.random_sample(num)
+        # Only frames that can still make it into the sample are copied
+        idx = np.flatnonzero(one_keys < threshold)
+        if len(idx) == 0:
+            continue
+        rows = idx[:, np.newaxis] - shifts
+        if exclude_wrap:
+            valid.append((rows >= 0) & (rows < one_feats.shape[0]))
+        else:
+            valid.append(np.ones(rows.shape, dtype=bool))
+        one_feats = one_feats[rows % one_feats.shape[0], :feat_dim]
+        keys.append(one_keys[idx])
+        feats.append(np.abs(one_feats) if make_absolute else one_feats)
+        labels.append(np.asarray(one_labels[idx], dtype=np.int64))
+        buffered += len(idx)
+        if buffered >= 2 * max_frames:
+            keys, feats, labels, valid, threshold = _keep_smallest_keys(keys, feats, labels, valid, max_frames)
+            buffered = len(keys[0])
+
+    meter.report()
+    print('{:d} utterances were absent in the alignment dictionary'.format(absent_keys))
+    keys, feats, labels, valid, _ = _keep_smallest_keys(keys, feats, labels, valid, max_frames)
+    return feats[0], labels[0], valid[0], num_frames
+
+
+def _keep_smallest_keys(keys, feats, labels, valid, max_frames):
+    keys, feats, labels, valid = np.concatenate(keys), np.concatenate(feats), np.concatenate(labels), \
+        np.concatenate(valid)
+    if len(keys) > max_frames:
+        keep = np.argpartition(keys, max_frames - 1)[:max_frames]
+        keys, feats, labels, valid = keys[keep], feats[keep], labels[keep], valid[keep]
+    threshold = np.max(keys) if len(keys) >= max_frames else np.inf
+    return [keys], [feats], [labels], [valid], threshold
+
+
+def knn_mutual_information(x, labels, k=3, num_workers=1):
+    """Mutual information between continuous features and discrete labels (Ross, 2014)
+
+    For every frame, the distance to its k-th nearest neighbor among the
+    frames of the same label is found, and the frames of any label within
+    that distance are counted. Distances use the max-norm. Labels with a
+    single frame are left out, labels with fewer than k + 1 frames use fewer
+    neighbors.
+
+    Args:
+        x (numpy.ndarray): Features (frames x dims).
+        labels (numpy.ndarray): Label of every frame.
+        k (int): Number of nearest neighbors.
+        num_workers (int): Number of threads of the KD-tree queries, -1 for all cores.
+
+    Returns:
+        mi (float): Mutual information in nats, negative estimates are clipped to 0.
+
+    """
+
+    _, inverse, label_counts = np.unique(labels, return_inverse=True, return_counts=True)
+    keep = label_counts[inverse] > 1
+    x, inverse = x[keep], inverse[keep]
+    num_frames = len(inverse)
+    if num_frames == 0:
+        return 0.0
+
+    radius = np.zeros(num_frames)
+    k_all = np.zeros(num_frames)
+    for label in np.unique(inverse):
+        mask = inverse == label
+        one_k = min(k, label_counts[label] - 1)
+        dist, _ = cKDTree(x[mask]).query(x[mask], k=one_k + 1, p=np.inf, workers=num_workers)
+        # Neighbors strictly closer than the k-th one of the same label are counted below
+        radius[mask] = np.nextafter(dist[:, -1], 0)
+        k_all[mask] = one_k
+
+    m_all = cKDTree(x).query_ball_point(x, radius, p=np.inf, return_length=True, workers=num_workers)
+    mi = digamma(num_frames) + np.mean(digamma(k_all)) - np.mean(digamma(label_counts[inverse])) \
+        - np.mean(digamma(m_all))
+    return max(mi, 0.0)
+
+
+def get_knn_mi(feats, labels, dim_groups, valid=None, k=3, num_workers=1, seed=0):
+    """kNN MI of every shift and group of dimensions
+
+    Every dimension is scaled to unit variance and a tiny amount of noise
+    is added to break the ties of repeated feature values.
+
+    Args:
+        feats (numpy.ndarray): Sampled features (frames x num_shifts x feat_dim).
+        labels (numpy.ndarray): Labels of the sampled frames.
+        dim_groups (list): Feature dimensions of every group.
+        valid (numpy.ndarray): Frames used at every shift (frames x num_shifts), all if None.
+        k (int): Number of nearest neighbors.
+        num_workers (int): Number of threads of the KD-tree queries.
+        seed (int): Seed of the tie-breaking noise.
+
+    Returns:
+        mi (numpy.ndarray): MI in nats (num_shifts x num_groups).
+
+    """
+
+    rng = np.random.RandomState(seed)
+    feats = np.asarray(feats, dtype=np.float64)
+    std = np.std(feats, axis=0)
+    feats = feats / np.where(std > 0, std, 1)
+    feats += 1e-10 * rng.standard_normal(feats.shape)
+
+    mi = np.zeros((feats.shape[1], len(dim_groups)))
+    for sh_idx in range(feats.shape[1]):
+        rows = valid[:, sh_idx] if valid is not None else slice(None)
+        for g_idx, group in enumerate(dim_groups):
+            mi[sh_idx, g_idx] = knn_mutual_information(feats[rows, sh_idx][:, group], labels[rows], k=k,
+                                                       num_workers=num_workers)
+    return mi
+
+
+def write_knn_mi_table(out_file, shifts, dim_groups, mi, units='bits', num_frames=None, num_samples=None,
+                       exclude_wrap=None):
+    scale = 1 / np.log(2) if units == 'bits' else 1
+    with open(out_file, 'w') as fid:
+        if num_frames is not None:
+            fid.write('# frames {:d}\n'.format(num_frames))
+        if num_samples is not None:
+            fid.write('# sampled_frames {:d}\n'.format(num_samples))
+        if exclude_wrap is not None:
+            fid.write('# exclude_wrap {:d}\n'.format(int(exclude_wrap)))
+        fid.write('# shift dim mi_{:s}\n'.format(units))
+        for sh_idx, sh in enumerate(shifts):
+            for g_idx, group in enumerate(dim_groups):
+                fid.write('{:d} {:s} {:.6f}\n'.format(sh, group_name(group), mi[sh_idx, g_idx] * scale))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Compute mutual information between features and labels with a kNN estimator')
+    parser.add_argument('scp', help='Feature scp file')
+    parser.add_argument('phoneme_ali_dir', help='Phoneme alignment directory or alignment store')
+    parser.add_argument('out_file', help='Output MI table, same layout as compute_mi.py')
+    parser.add_argument("--feat_size", type=int, default=80, help="Feature size")
+    parser.add_argument("--make_absolute", type=bool, default=False,
+                        help="Compute np.abs() on features before computing MI")
+    parser.add_argument("--analyze_transitions", action="store_true", help="Set to compute MI at transitions")
+    parser.add_argument("--transition_width", type=int, default=1,
+                        help="Frames on either side of a phone boundary counted as transition with "
+                             "--analyze_transitions")
+    parser.add_argument("--shifts", type=str, default='0',
+                        help="Shift features along time axis along these dimension eg. '-1,0,1'")
+    parser.add_argument("--exclude_wrap", action="store_true",
+                        help="Do not use frames whose shifted features would wrap around the utterance, as with "
+                             "the --exclude_wrap histograms")
+    parser.add_argument("--dim_groups", type=str, default=None,
+                        help="Comma separated groups of feature dimensions whose joint MI is computed, e.g. "
+                             "'0-9,10-19' (default: every dimension on its own)")
+    parser.add_argument("--max_frames", type=int, default=20000,
+                        help="Number of frames sampled from the scp file, the cost grows with it")
+    parser.add_argument("--k", type=int, default=3, help="Number of nearest neighbors")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Number of threads of the KD-tree queries, -1 for all cores")
+    parser.add_argument("--units", type=str, default='bits', help="bits OR nats")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the frame sampling")
+    args = parser.parse_args()
+
+    if args.units not in ['bits', 'nats']:
+        raise ValueError('Invalid units, use bits or nats')
+
+    shifts = [int(x) for x in args.shifts.split(',')]
+    dim_groups = parse_dim_groups(args.dim_groups, args.feat_size)
+    # With an alignment store only the utterances of the scp file are loaded
+    all_alis = load_alignments(args.phoneme_ali_dir, uttids=scp_uttids(args.scp))
+
+    feats, labels, valid, num_frames = sample_frames(args.scp, all_alis, shifts, feat_dim=args.feat_size,
+                                                     max_frames=args.max_frames, make_absolute=args.make_absolute,
+                                                     transition_width=args.transition_width
+                                                     if args.analyze_transitions else None,
+                                                     exclude_wrap=args.exclude_wrap, seed=args.seed)
+    print('Sampled {:d} of {:d} frames'.format(len(labels), num_frames))
+    mi = get_knn_mi(feats, labels, dim_groups, valid=valid, k=args.k, num_workers=args.num_workers, seed=args.seed)
+    write_knn_mi_table(args.out_file, shifts, dim_groups, mi, units=args.units, num_frames=num_frames,
+                       num_samples=len(labels), exclude_wrap=args.exclude_wrap)
+    print('Wrote kNN MI of {:d} shifts x {:d} dimension groups to {:s}'.format(mi.shape[0], mi.shape[1],
+                                                                             args.out_file))
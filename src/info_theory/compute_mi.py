@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+Author: samiksadhu, Johns Hopkins University
+"""
+
+'Compute mutual information between features and labels from joint histograms'
+
+import argparse
+import os
+import pickle as pkl
+import numpy as np
+from histogram_utils import JointHistogram, StreamingJointHistogram, load_histogram, get_dump_files
+
+
+def _entropy_terms(counts, axis):
+    """Sum of c * log(c) over the given axes and the number of non-zero cells"""
+
+    counts = np.asarray(counts, dtype=np.float64)
+    positive = counts > 0
+    xlogx = np.where(positive, counts * np.log(np.where(positive, counts, 1)), 0)
+    return np.sum(xlogx, axis=axis), np.sum(positive, axis=axis)
+
+
+def mutual_information(counts, bias_correction=None):
+    """Mutual information between feature bins and labels for every (shift, dimension)
+
+    Args:
+        counts (numpy.ndarray): Joint counts (num_shifts x feat_dim x num_bins x num_labels).
+        bias_correction (str): None or 'miller_madow'.
+
+    Returns:
+        mi (numpy.ndarray): Mutual information in nats (num_shifts x feat_dim).
+
+    """
+
+    counts = np.asarray(counts, dtype=np.float64)
+    num = np.sum(counts, axis=(2, 3))
+    xy_terms, m_xy = _entropy_terms(counts, axis=(2, 3))
+    x_terms, m_x = _entropy_terms(np.sum(counts, axis=3), axis=2)
+    y_terms, m_y = _entropy_terms(np.sum(counts, axis=2), axis=2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # I(X;Y) = H(X) + H(Y) - H(X,Y) with H = log(N) - sum(c log c) / N
+        mi = np.log(num) + (xy_terms - x_terms - y_terms) / num
+        if bias_correction == 'miller_madow':
+            mi += ((m_x - 1) + (m_y - 1) - (m_xy - 1)) / (2 * num)
+        elif bias_correction is not None:
+            raise ValueError('Invalid bias correction: {:s}'.format(bias_correction))
+    return np.where(num > 0, mi, 0)
+
+
+def get_counts(hist, sig_bins, d_start, d_end):
+    """Counts of a range of feature dimensions, streaming dumps are re-binned with sig_bins"""
+
+    if isinstance(hist, StreamingJointHistogram):
+        sub = StreamingJointHistogram(hist.shifts, d_end - d_start, hist.counts.shape[3],
+                                      num_fine_bins=hist.counts.shape[2], labels=hist.labels)
+        sub.counts = hist.counts[:, d_start:d_end]
+        sub.width, sub.offset = hist.width[d_start:d_end], hist.offset[d_start:d_end]
+        return sub.finalize(sig_bins if sig_bins.ndim == 1 else sig_bins[d_start:d_end])
+    return hist.counts[:, d_start:d_end]
+
+
+def compute_mi_table(combined_file, dump_files=None, num_bootstrap=0, confidence=0.95, bias_correction=None,
+                     dims_per_chunk=16, seed=0):
+    """MI of every (shift, dimension) and optional bootstrap confidence intervals
+
+    The histograms are processed in chunks of feature dimensions, so the full
+    4-D tensor is never held in memory.
+
+    Args:
+        combined_file (str): Combined histogram (combined.hist.npz or legacy combined.all).
+        dump_files (list): Per-job dumps, resampled with replacement for the bootstrap.
+        num_bootstrap (int): Number of bootstrap samples.
+        confidence (float): Confidence level of the intervals.
+        bias_correction (str): None or 'miller_madow'.
+        dims_per_chunk (int): Number of feature dimensions processed at once.
+        seed (int): Seed of the bootstrap resampling.
+
+    Returns:
+        shifts (list): Shifts of the features.
+        mi (numpy.ndarray): MI in nats (num_shifts x feat_dim).
+        ci (numpy.ndarray): Lower and upper bounds (2 x num_shifts x feat_dim) or None.
+        num_frames (int): Number of frames in the combined histogram.
+
+    """
+
+    if combined_file.endswith('.npz'):
+        combined = load_histogram(combined_file, mmap=True)
+    else:
+        # Legacy float histogram with 1e-13 added to every cell, it does not store the shifts so their
+        # indices are reported instead
+        counts = pkl.load(open(combined_file, 'rb'))
+        combined = JointHistogram(np.zeros(counts.shape[2] + 1), range(counts.shape[0]), counts.shape[1],
+                                  counts.shape[3])
+        combined.counts = np.maximum(counts - 0.0000000000001, 0)
+        combined.num_frames = int(np.sum(combined.counts[0, 0]))
+    num_shifts, feat_dim = combined.counts.shape[:2]
+
+    mi = np.zeros((num_shifts, feat_dim))
+    ci = None
+    if num_bootstrap > 0:
+        dumps = [load_histogram(f, mmap=True) for f in dump_files]
+        rng = np.random.RandomState(seed)
+        # Number of times every dump is drawn in every bootstrap sample
+        weights = rng.multinomial(len(dumps), np.ones(len(dumps)) / len(dumps), size=num_bootstrap)
+        boot_mi = np.zeros((num_bootstrap, num_shifts, feat_dim))
+
+    for d_start in range(0, feat_dim, dims_per_chunk):
+        d_end = min(d_start + dims_per_chunk, feat_dim)
+        mi[:, d_start:d_end] = mutual_information(combined.counts[:, d_start:d_end], bias_correction)
+        if num_bootstrap > 0:
+            chunk = np.stack([get_counts(hist, combined.sig_bins, d_start, d_end) for hist in dumps])
+            for b in range(num_bootstrap):
+                boot_counts = np.tensordot(weights[b], chunk, axes=1)
+                boot_mi[b, :, d_start:d_end] = mutual_information(boot_counts, bias_correction)
+
+    if num_bootstrap > 0:
+        alpha = (1 - confidence) / 2
+        ci = np.percentile(boot_mi, [100 * alpha, 100 * (1 - alpha)], axis=0)
+
+    return combined.shifts, mi, ci, combined.num_frames
+
+
+def write_mi_table(out_file, shifts, mi, ci=None, units='bits', num_frames=None):
+    scale = 1 / np.log(2) if units == 'bits' else 1
+    with open(out_file, 'w') as fid:
+        if num_frames is not None:
+            fid.write('# frames {:d}\n'.format(num_frames))
+        header = '# shift dim mi_{:s}'.format(units)
+        if ci is not None:
+            header += ' ci_low ci_high'
+        fid.write(header + '\n')
+        for sh_idx, sh in enumerate(shifts):
+            for dim in range(mi.shape[1]):
+                line = '{:d} {:d} {:.6f}'.format(sh, dim, mi[sh_idx, dim] * scale)
+                if ci is not None:
+                    line += ' {:.6f} {:.6f}'.format(ci[0, sh_idx, dim] * scale, ci[1, sh_idx, dim] * scale)
+                fid.write(line + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Compute mutual information from combined joint histograms')
+    parser.add_argument('combined_file', help='Combined histogram (combined.hist.npz or legacy combined.all)')
+    parser.add_argument('out_file', help='Output MI table')
+    parser.add_argument("--units", type=str, default='bits', help="bits OR nats")
+    parser.add_argument("--bias_correction", type=str, default=None, help="Set to miller_madow for bias correction")
+    parser.add_argument("--num_bootstrap", type=int, default=0,
+                        help="Number of bootstrap samples over the per-job dumps for confidence intervals")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the intervals")
+    parser.add_argument("--prefix", type=str, default='', help="Prefix of the per-job dumps used for bootstrap")
+    parser.add_argument("--num_jobs", type=int, default=None, help="Number of per-job dumps used for bootstrap")
+    parser.add_argument("--dims_per_chunk", type=int, default=16,
+                        help="Number of feature dimensions loaded at once")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for bootstrap resampling")
+    args = parser.parse_args()
+
+    if args.units not in ['bits', 'nats']:
+        raise ValueError('Invalid units, use bits or nats')
+
+    dump_files = None
+    if args.num_bootstrap > 0:
+        dump_dir = os.path.dirname(os.path.abspath(args.combined_file))
+        dump_files = get_dump_files(dump_dir, prefix=args.prefix, num_jobs=args.num_jobs,
+                                    exclude=os.path.abspath(args.combined_file))
+        print('Bootstrapping over {:d} histogram dumps'.format(len(dump_files)))
+
+    shifts, mi, ci, num_frames = compute_mi_table(args.combined_file, dump_files=dump_files,
+                                                  num_bootstrap=args.num_bootstrap, confidence=args.confidence,
+                                                  bias_correction=args.bias_correction,
+                                                  dims_per_chunk=args.dims_per_chunk, seed=args.seed)
+    write_mi_table(args.out_file, shifts, mi, ci=ci, units=args.units, num_frames=num_frames)
+    print('Wrote MI of {:d} shifts x {:d} dimensions to {:s}'.format(mi.shape[0], mi.shape[1], args.out_file))
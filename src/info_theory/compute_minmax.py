@@ -10,34 +10,21 @@ import logging
 
 import argparse
 import numpy as np
-import bisect
-import os
 import kaldi_io
 import pickle as pkl
+from alignment_store import AlignmentStore, load_alignments
+from histogram_utils import StreamingJointHistogram
 
 
 def get_phoneme_labels(ali_dir):
-    ali_files = []
-    all_ali_dirs = ali_dir.split(',')
-    for ali_dir in all_ali_dirs:
-        ali_files.extend([os.path.join(ali_dir, f) for f in os.listdir(ali_dir) if f.startswith('ali.')])
-
-    pdf_ali_dict = {}
-
-    for file in ali_files:
-        pdf_ali_file = "ark:ali-to-phones --per-frame {} ark:'gunzip -c {} |' ark:- |".format(
-            os.path.join(ali_dir, "final.mdl"),
-            file)
-        pdf_ali_dict.update({u: d for u, d in kaldi_io.read_vec_int_ark(pdf_ali_file)})
-
-    return pdf_ali_dict
+    return load_alignments(ali_dir)
 
 
 def get_feats(feat_scp):
     return {uttid: feats for uttid, feats in kaldi_io.read_mat_scp(feat_scp)}
 
 
-def get_minmax(dict_or_scp, scp_input=False, make_absolute=False, frequency_scaling=None):
+def get_minmax(dict_or_scp, scp_input=False, make_absolute=False, frequency_scaling=None, sketch=None):
     feat_min = +np.inf
     feat_max = -np.inf
     if frequency_scaling:
@@ -55,6 +42,9 @@ def get_minmax(dict_or_scp, scp_input=False, make_absolute=False, frequency_scal
                 feats *= freq_multiplier
                 feats = np.reshape(feats, (-1, frequency_scaling[0] * frequency_scaling[1]))
 
+            if sketch is not None:
+                # Per dimension range and fine histogram for the per_dim and quantile binnings
+                sketch.update(feats, np.zeros(feats.shape[0], dtype=np.int64))
             one_max = np.max(feats)
             one_min = np.min(feats)
             if one_max > feat_max:
@@ -77,22 +67,34 @@ def get_minmax(dict_or_scp, scp_input=False, make_absolute=False, frequency_scal
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Compute min-max values of labels and data for binning Histograms')
     parser.add_argument('scp', help='Feature scp file')
-    parser.add_argument('phoneme_ali_dir', help='Phoneme alignment directory')
+    parser.add_argument('phoneme_ali_dir', help='Phoneme alignment directory or alignment store')
     parser.add_argument('out_file', help='Output file')
     parser.add_argument("--feat_size", type=int, default=80, help="Feature size")
     parser.add_argument("--make_absolute", type=bool, default=False,
                         help="Compute np.abs() on features before computing MI")
     parser.add_argument("--frequency_scaling", type=str, default=None,
                         help="If scaling by 1/f you can set this option as num_filters,num_freq_components,freq_resolution [Option used when computing MI of modulation spectrum]")
+    parser.add_argument("--num_fine_bins", type=int, default=0,
+                        help="Number of fine bins per feature dimension of the sketch used by the per_dim and "
+                             "quantile binnings, e.g. 1024 (default: 0, only the global range for global binning)")
     args = parser.parse_args()
 
     all_alis = get_phoneme_labels(args.phoneme_ali_dir)
 
     if args.frequency_scaling:
         logging.info('Frequency scaling activated')
-    mn_a, mx_a = get_minmax(dict_or_scp=all_alis)
+    if isinstance(all_alis, AlignmentStore):
+        # Label range of the whole store, the labels are not decoded
+        mn_a, mx_a = all_alis.min_label, all_alis.max_label
+    else:
+        mn_a, mx_a = get_minmax(dict_or_scp=all_alis)
+    sketch = StreamingJointHistogram([0], args.feat_size, 1, num_fine_bins=args.num_fine_bins) \
+        if args.num_fine_bins > 0 else None
     mn_f, mx_f = get_minmax(dict_or_scp=args.scp, scp_input=True, make_absolute=args.make_absolute,
-                            frequency_scaling=args.frequency_scaling)
+                            frequency_scaling=args.frequency_scaling, sketch=sketch)
 
     pkl.dump({'min': mn_a, 'max': mx_a}, open(args.out_file + '.ali.mnx', 'wb'))
-    pkl.dump({'min': mn_f, 'max': mx_f}, open(args.out_file + '.feat.mnx', 'wb'))
+    mnx_f = {'min': mn_f, 'max': mx_f}
+    if sketch is not None:
+        mnx_f['sketch'] = sketch
+    pkl.dump(mnx_f, open(args.out_file + '.feat.mnx', 'wb'))
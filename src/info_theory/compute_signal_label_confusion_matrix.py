@@ -8,12 +8,17 @@ Author: samiksadhu, Johns Hopkins University
 'Computing Joint Histogram of features and Labels'
 
 import argparse
+import functools
+import multiprocessing
 import numpy as np
-import bisect
 import os
 import kaldi_io
 import pickle as pkl
 import logging
+from alignment_store import AlignmentStore, load_alignments, scp_uttids
+from bin_codes import BinCodeStore, BinCodeWriter
+from histogram_utils import BINNINGS, JointHistogram, StreamingJointHistogram, ThroughputMeter, get_bin_edges, \
+    save_histogram
 
 def get_minmax(feat_dict):
     feat_min = +np.inf
@@ -29,119 +34,233 @@ def get_minmax(feat_dict):
     return feat_min, feat_max
 
 
+def histogram_scp_lines(scp_lines, alis, new_dist, make_absolute=False, frequency_scaling=None,
+                        transition_width=None, bin_codes=None, new_code_writer=None, part=None):
+    """Accumulate the joint histogram of the utterances in a list of scp lines
+
+    Args:
+        scp_lines (list): Lines of a feature scp file.
+        alis (dict): Frame-wise labels of every utterance.
+        new_dist (function): Returns an empty JointHistogram or StreamingJointHistogram.
+        make_absolute (bool): Compute np.abs() on the features.
+        frequency_scaling (list): num_filters, num_freq, freq_resolution.
+        transition_width (int): If given, the labels are 1 within this many frames of a phone boundary and 0
+            elsewhere instead of the phones.
+        bin_codes (BinCodeStore): If given, the bin codes of the utterances are read from it instead of the
+            features.
+        new_code_writer (function): If given, returns a BinCodeWriter for a part, the bin codes of all
+            utterances are written to it.
+        part (str): Name of the bin code part written by this call.
+
+    Returns:
+        dist: Joint histogram.
+        absent_keys (int): Number of utterances without alignment.
+
+    """
+
+    if frequency_scaling:
+        freq_multiplier = np.linspace(0, frequency_scaling[1] * frequency_scaling[2], frequency_scaling[1])
+
+    dist = new_dist()
+    code_writer = new_code_writer(part) if new_code_writer else None
+    meter = ThroughputMeter(total=len(scp_lines))
+    absent_keys = 0
+    for line in scp_lines:
+        key, rxfile = line.strip().split(None, 1)
+        if bin_codes is not None:
+            if key not in bin_codes:
+                raise KeyError('Utterance {:s} is missing from bin code store {:s}'.format(key,
+                                                                                       bin_codes.store_dir))
+            bin_idx = bin_codes[key]
+            meter.update(bin_idx.shape[0], bin_idx.nbytes)
+        else:
+            feats = kaldi_io.read_mat(rxfile)
+            meter.update(feats.shape[0], feats.nbytes)
+            if make_absolute:
+                feats = np.abs(feats)
+            if frequency_scaling:
+                feats = np.reshape(feats, (-1, frequency_scaling[0], frequency_scaling[1]))
+                feats *= freq_multiplier
+                feats = np.reshape(feats, (-1, frequency_scaling[0] * frequency_scaling[1]))
+            if code_writer is not None:
+                bin_idx = dist.bin_indices(feats)
+                code_writer.write(key, bin_idx)
+
+        if key in alis:
+            if transition_width is None:
+                labels = alis[key] - 1
+            else:
+                labels = get_transition_labels(alis[key], transition_width)
+            try:
+                if bin_codes is not None or code_writer is not None:
+                    dist.update_bin_indices(bin_idx, labels)
+                else:
+                    dist.update(feats, labels)
+            except ValueError as err:
+                raise ValueError('Utterance {:s}: {:s}'.format(key, str(err)))
+        else:
+            absent_keys += 1
+
+    if code_writer is not None:
+        code_writer.close()
+    meter.report()
+    return dist, absent_keys
+
+
+# Shared with the forked worker processes, so that the alignments are not pickled for every shard
+_shard_job = None
+
+
+def _histogram_shard(shard):
+    part, scp_lines = shard
+    return histogram_scp_lines(scp_lines, part=part, **_shard_job)
+
+
+def get_sig_bins(minmax_feat, binning='global', num_bins=100):
+    """Bin edges of a binning strategy from a feature minmax file of compute_minmax.py"""
+
+    mnx_f = pkl.load(open(minmax_feat, 'rb'))
+    if binning == 'global':
+        return np.linspace(mnx_f['min'], mnx_f['max'], num_bins + 1)
+    if mnx_f.get('sketch') is None:
+        raise ValueError('{:s} has no feature sketch, which the {:s} binning needs. Run compute_minmax.py with '
+                         '--num_fine_bins > 0'.format(minmax_feat, binning))
+    return get_bin_edges(binning, num_bins, mnx_f['sketch'])
+
+
 def get_signal_label_joint_distribution(alis, feat_scp, minmax_ali, minmax_feat, shifts, feat_dim=80, num_bins=100,
-                                        make_absolute=False, frequency_scaling=None):
+                                        make_absolute=False, frequency_scaling=None, streaming=False,
+                                        num_fine_bins=1024, num_workers=1, transition_width=None, exclude_wrap=False,
+                                        binning='global', write_bin_codes=None, read_bin_codes=None, part='codes'):
+    """Joint histogram of the features of an scp file and the phone (or transition) labels
+
+    With write_bin_codes, the uint8 bin codes of the features are written to
+    a bin code store in that directory. Once all the jobs writing the store
+    have finished and it is marked complete, read_bin_codes reads the codes
+    instead of the features, with the bin edges of the store, so other
+    label sets and shifts are histogrammed without the features or the
+    minmax file. The feature options then have no effect, the codes were
+    computed with the options of the run that wrote them.
+
+    See the __main__ options for the other arguments. part names the bin
+    code part written by this call, workers add their shard index.
+    """
+
+    global _shard_job
+
     shifts = [int(x) for x in shifts.split(',')]
-    num_shifts = len(shifts)
     if frequency_scaling:
         frequency_scaling = [x for x in frequency_scaling.split(',')]
         frequency_scaling[0] = int(frequency_scaling[0])  # num_filters
         frequency_scaling[1] = int(frequency_scaling[1])  # num_freq
         frequency_scaling[2] = float(frequency_scaling[2])  # freq_resolution
-        freq_multiplier = np.linspace(0, frequency_scaling[1] * frequency_scaling[2], frequency_scaling[1])
 
-    mnx_a = pkl.load(open(minmax_ali, 'rb'))
-    mnx_f = pkl.load(open(minmax_feat, 'rb'))
-    mn_a, mx_a = mnx_a['min'], mnx_a['max']
-    mn_f, mx_f = mnx_f['min'], mnx_f['max']
-    sig_bins = np.linspace(mn_f, mx_f, num_bins + 1)
-    dist = np.zeros((num_shifts, feat_dim, num_bins, mx_a))
-    cc = 0
-    for uttid, feats in kaldi_io.read_mat_scp(feat_scp):
-        cc += 1
-    nums = cc
-    count = 0
-    absent_keys = 0
-    for key, feats in kaldi_io.read_mat_scp(feat_scp):
-        count += 1
-        if make_absolute:
-            feats = np.abs(feats)
-        if frequency_scaling:
-            feats = np.reshape(feats, (-1, frequency_scaling[0], frequency_scaling[1]))
-            feats *= freq_multiplier
-            feats = np.reshape(feats, (-1, frequency_scaling[0] * frequency_scaling[1]))
-
-        print('Processing {:f} % of files'.format(count * 100 / nums))
-        if key in alis:
-            for sh_idx, sh in enumerate(shifts):
-                one_feat = np.roll(feats, shift=sh, axis=0)
-                for idx, label in enumerate(alis[key]):
-                    f = one_feat[idx, :]
-                    for r in range(feat_dim):
-                        ii = int(bisect.bisect_left(sig_bins, f[r]))
-                        jj = label - 1
-                        if ii == 0:
-                            ii = 1
-                        if ii == num_bins + 1:
-                            ii = num_bins
-                        ii = ii - 1
-                        dist[sh_idx, r, ii, jj] += 1
+    if transition_width is not None:
+        # Columns: away from a phone boundary, at a phone boundary
+        num_labels, labels = 2, np.arange(2)
+    elif streaming:
+        if isinstance(alis, AlignmentStore):
+            # Same label columns in every job
+            mx_a = alis.max_label
         else:
-            absent_keys += 1
+            mx_a = max(np.max(ali) for ali in alis.values())
+        num_labels, labels = mx_a, np.arange(1, mx_a + 1)
+    else:
+        mnx_a = pkl.load(open(minmax_ali, 'rb'))
+        mn_a, mx_a = mnx_a['min'], mnx_a['max']
+        num_labels, labels = mx_a, np.arange(1, mx_a + 1)
+
+    with open(feat_scp, 'r') as fid:
+        scp_lines = [line for line in fid if line.strip()]
+    nums = len(scp_lines)
+
+    if write_bin_codes and read_bin_codes:
+        raise ValueError('Bin codes are either written or read, not both')
+    bin_codes, new_code_writer = None, None
+    if streaming:
+        if write_bin_codes or read_bin_codes:
+            raise ValueError('Bin codes need fixed bin edges, they cannot be used with streaming')
+        # The feature range is found on the fly and the bin edges are fixed when combining the dumps
+        new_dist = functools.partial(StreamingJointHistogram, shifts, feat_dim, num_labels,
+                                     num_fine_bins=num_fine_bins, labels=labels, exclude_wrap=exclude_wrap)
+    else:
+        if read_bin_codes:
+            bin_codes = BinCodeStore(read_bin_codes, uttids=[line.split(None, 1)[0] for line in scp_lines])
+            if bin_codes.binning != binning or bin_codes.sig_bins.shape[-1] != num_bins + 1 \
+                    or bin_codes.feat_dim != feat_dim:
+                raise ValueError('Bin code store {:s} has {:d} {:s} bins of {:d} dimensions, not {:d} {:s} bins of '
+                                 '{:d}'.format(read_bin_codes, bin_codes.sig_bins.shape[-1] - 1, bin_codes.binning,
+                                               bin_codes.feat_dim, num_bins, binning, feat_dim))
+            print('Reading bin codes from {:s}'.format(read_bin_codes))
+            sig_bins = bin_codes.sig_bins
+        else:
+            sig_bins = get_sig_bins(minmax_feat, binning=binning, num_bins=num_bins)
+            if write_bin_codes:
+                new_code_writer = functools.partial(BinCodeWriter, write_bin_codes, sig_bins=sig_bins,
+                                                    binning=binning, feat_dim=feat_dim)
+        new_dist = functools.partial(JointHistogram, sig_bins, shifts, feat_dim, num_labels, labels=labels,
+                                     exclude_wrap=exclude_wrap)
+
+    job = {'alis': alis, 'new_dist': new_dist, 'make_absolute': make_absolute,
+           'frequency_scaling': frequency_scaling, 'transition_width': transition_width,
+           'bin_codes': bin_codes, 'new_code_writer': new_code_writer}
+    if num_workers > 1:
+        # More shards than workers to balance the load, the counts are summed in any order
+        num_shards = min(nums, 4 * num_workers)
+        shards = [('{:s}.{:d}'.format(part, n), scp_lines[n::num_shards]) for n in range(num_shards)]
+        _shard_job = job
+        # Empty like the serial path when the scp file has no utterances
+        dist = new_dist()
+        absent_keys = 0
+        with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+            for one_dist, one_absent in pool.imap_unordered(_histogram_shard, shards):
+                dist += one_dist
+                absent_keys += one_absent
+        _shard_job = None
+    else:
+        dist, absent_keys = histogram_scp_lines(scp_lines, part=part, **job)
 
     print('{:d}/{:d} number of keys were absent in the alignment dictionary'.format(absent_keys, nums))
     return dist
 
 
-def get_signal_trans_joint_distribution(alis, feats, minmax_ali, minmax_feat, feat_dim=80, num_bins=100):
-    mnx_f = pkl.load(open(minmax_feat, 'rb'))
-    mn_f, mx_f = mnx_f['min'], mnx_f['max']
-    sig_bins = np.linspace(mn_f, mx_f, num_bins + 1)
-    dist = np.zeros((feat_dim, num_bins, 2))
-    nums = len(list(feats.keys()))
-    count = 0
-    for key in feats:
-        count += 1
-        print('Processing {:f} % of files'.format(count * 100 / nums))
-        for idx, label in enumerate(alis[key]):
-            f = feats[key][idx, :]
-            for r in range(feat_dim):
-                ii = int(bisect.bisect_left(sig_bins, f[r]))
-                jj = int(label)
-                if ii == 0:
-                    ii = 1
-                if ii == num_bins + 1:
-                    ii = num_bins
-                ii = ii - 1
-                dist[r, ii, jj] += 1
+def get_signal_trans_joint_distribution(alis, feat_scp, minmax_ali, minmax_feat, feat_dim=80, num_bins=100,
+                                        shifts='0', transition_width=1, **kwargs):
+    """Joint histogram of the features and whether a frame is at a phone boundary, see get_transition_labels"""
 
-    return dist
+    return get_signal_label_joint_distribution(alis, feat_scp, minmax_ali, minmax_feat, shifts, feat_dim=feat_dim,
+                                               num_bins=num_bins, transition_width=transition_width, **kwargs)
+
+
+def get_phoneme_labels(ali_dir, uttids=None):
+    return load_alignments(ali_dir, uttids=uttids)
 
 
-def get_phoneme_labels(ali_dir):
-    ali_files = []
-    all_ali_dirs = ali_dir.split(',')
-    for ali_dir in all_ali_dirs:
-        ali_files.extend([os.path.join(ali_dir, f) for f in os.listdir(ali_dir) if f.startswith('ali.')])
+def get_transition_labels(ali, width=1):
+    """Mark the frames within width frames of a phone boundary
 
-    pdf_ali_dict = {}
+    A boundary at frame t, the first frame of a new phone, marks frames
+    t - width to t + width, clipped to the utterance.
 
-    for file in ali_files:
-        pdf_ali_file = "ark:ali-to-phones --per-frame {} ark:'gunzip -c {} |' ark:- |".format(
-            os.path.join(ali_dir, "final.mdl"),
-            file)
-        pdf_ali_dict.update({u: d for u, d in kaldi_io.read_vec_int_ark(pdf_ali_file)})
+    Args:
+        ali (numpy.ndarray): Frame-wise phone labels.
+        width (int): Neighborhood of a boundary in frames.
 
-    return pdf_ali_dict
+    Returns:
+        trans (numpy.ndarray): 1 for frames near a boundary and 0 elsewhere (int64).
 
+    """
 
-def get_transitions(alis):
-    trans_dict = {}
-    for utt in alis:
-        one_ali = alis[utt]
-        r_prev = 2222222
-        one_trans = np.zeros(one_ali.shape[0])
-        for idx, r in enumerate(one_ali):
-            if idx > 0:
-                if r_prev != r:
-                    # There is a transition here
-                    one_trans[idx] = 1
-                    one_trans[idx - 1] = 1
-                    one_trans[idx + 1] = 1
-            r_prev = r
-        trans_dict[utt] = one_trans
+    num_frames = len(ali)
+    boundaries = np.flatnonzero(np.diff(ali)) + 1
+    # +1 where a neighborhood starts and -1 after it ends, overlapping ones add up
+    edges = np.bincount(np.maximum(boundaries - width, 0), minlength=num_frames + 1) \
+        - np.bincount(np.minimum(boundaries + width + 1, num_frames), minlength=num_frames + 1)
+    return (np.cumsum(edges[:num_frames]) > 0).astype(np.int64)
 
-    return trans_dict
+
+def get_transitions(alis, width=1):
+    return {utt: get_transition_labels(alis[utt], width) for utt in alis}
 
 
 def get_feats(feat_scp):
@@ -151,33 +270,61 @@ def get_feats(feat_scp):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Compute Signal-Label Confusion Matrix')
     parser.add_argument('scp', help='Feature scp file')
-    parser.add_argument('phoneme_ali_dir', help='Phoneme alignment directory')
-    parser.add_argument('minmax_ali', help='Alignmnet minmax file')
-    parser.add_argument('minmax_feat', help='Feature minmax file')
+    parser.add_argument('phoneme_ali_dir', help='Phoneme alignment directory or alignment store')
+    parser.add_argument('minmax_ali', help="Alignmnet minmax file ('-' with --streaming)")
+    parser.add_argument('minmax_feat', help="Feature minmax file ('-' with --streaming)")
     parser.add_argument('out_file', help='Output file')
     parser.add_argument("--feat_size", type=int, default=80, help="Feature size")
     parser.add_argument("--make_absolute", type=bool, default=False,
                         help="Compute np.abs() on features before computing MI")
     parser.add_argument("--analyze_transitions", action="store_true", help="Set to compute MI at transitions")
+    parser.add_argument("--transition_width", type=int, default=1,
+                        help="Frames on either side of a phone boundary counted as transition with "
+                             "--analyze_transitions")
     parser.add_argument("--frequency_scaling", type=str, default=None,
                         help="If scaling by 1/f you can set this option as num_filters,num_freq_components,freq_resolution [Option used when computing MI of modulation spectrum]")
     parser.add_argument("--shifts", type=str, default='0',
                         help="Shift features along time axis along these dimension eg. '-1,0,1'")
+    parser.add_argument("--num_bins", type=int, default=100, help="Number of histogram bins per feature dimension")
+    parser.add_argument("--binning", type=str, default='global', choices=BINNINGS,
+                        help="Bin edges: equal bins over the global feature range (global), over the range of every "
+                             "dimension (per_dim) or equal-frequency bins of every dimension (quantile). per_dim and "
+                             "quantile need the sketch of compute_minmax.py, or combine_histogram_dumps.py "
+                             "--binning with --streaming")
+    parser.add_argument("--write_bin_codes", type=str, default=None,
+                        help="Write the uint8 bin codes of the features to this bin code store directory (needs "
+                             "--num_bins <= 256). The store is read only once it is marked complete, see bin_codes.py")
+    parser.add_argument("--read_bin_codes", type=str, default=None,
+                        help="Histogram the bin codes of a complete bin code store instead of the features")
+    parser.add_argument("--exclude_wrap", action="store_true",
+                        help="Do not count frames whose shifted features would wrap around the utterance")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Find the feature range on the fly instead of reading the minmax files, "
+                             "the bin edges are fixed by combine_histogram_dumps.py")
+    parser.add_argument("--num_fine_bins", type=int, default=1024,
+                        help="Number of fine bins per feature dimension kept with --streaming")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Number of worker processes, each one histograms a shard of the scp file")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Store only the non-zero histogram cells in a compressed dump")
     args = parser.parse_args()
 
-    all_alis = get_phoneme_labels(args.phoneme_ali_dir)
-    if args.analyze_transitions:
-        all_alis = get_transitions(all_alis)
+    # With an alignment store only the utterances of this job are loaded
+    all_alis = get_phoneme_labels(args.phoneme_ali_dir, uttids=scp_uttids(args.scp))
 
     if args.frequency_scaling:
         logging.info('Frequency scaling activated')
 
-    if args.analyze_transitions:
-        dist = get_signal_trans_joint_distribution(all_alis, args.scp, args.minmax_ali, args.minmax_feat,
-                                                   feat_dim=args.feat_size, num_bins=100)
-    else:
-        dist = get_signal_label_joint_distribution(all_alis, args.scp, args.minmax_ali, args.minmax_feat, args.shifts,
-                                                   feat_dim=args.feat_size, num_bins=100,
-                                                   make_absolute=args.make_absolute,
-                                                   frequency_scaling=args.frequency_scaling)
-    pkl.dump(dist, open(args.out_file + '.pkl', 'wb'))
+    # Transitions are detected per utterance while histogramming
+    dist = get_signal_label_joint_distribution(all_alis, args.scp, args.minmax_ali, args.minmax_feat, args.shifts,
+                                               feat_dim=args.feat_size, num_bins=args.num_bins,
+                                               make_absolute=args.make_absolute,
+                                               frequency_scaling=args.frequency_scaling,
+                                               streaming=args.streaming, num_fine_bins=args.num_fine_bins,
+                                               num_workers=args.num_workers, exclude_wrap=args.exclude_wrap,
+                                               binning=args.binning, write_bin_codes=args.write_bin_codes,
+                                               read_bin_codes=args.read_bin_codes,
+                                               part=os.path.basename(args.out_file),
+                                               transition_width=args.transition_width if args.analyze_transitions
+                                               else None)
+    save_histogram(args.out_file + '.hist.npz', dist, sparse=args.sparse)
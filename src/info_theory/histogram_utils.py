@@ -0,0 +1,567 @@
+"""
+Utility functions for accumulating joint feature-label histograms
+
+Author: Samik Sadhu
+"""
+
+import numpy as np
+import os
+import struct
+import time
+import zipfile
+
+
+class ThroughputMeter(object):
+    '''Reports the number of processed files, frames/sec and bytes/sec of a job
+
+    Args:
+        total (int): Total number of files, if known.
+        report_every (int): Print a report every this many files.
+
+    '''
+
+    def __init__(self, total=None, report_every=100):
+        self.total = total
+        self.report_every = report_every
+        self.num_files = 0
+        self.num_frames = 0
+        self.num_bytes = 0
+        self.start_time = time.time()
+
+    def update(self, num_frames, num_bytes):
+        self.num_files += 1
+        self.num_frames += num_frames
+        self.num_bytes += num_bytes
+        if self.num_files % self.report_every == 0:
+            self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        if self.total:
+            done = '{:d}/{:d} files ({:.1f} %)'.format(self.num_files, self.total, self.num_files * 100 / self.total)
+        else:
+            done = '{:d} files'.format(self.num_files)
+        print('Processed {:s}, {:d} frames in {:.1f} sec: {:.1f} frames/sec, {:.2f} MB/sec'.format(
+            done, self.num_frames, elapsed, self.num_frames / elapsed, self.num_bytes / elapsed / 1e6))
+
+
+def get_bin_indices(feats, sig_bins):
+    '''Vectorized bisect_left binning with edge clamping
+
+    Values below the first edge go to the first bin and values above the last
+    edge go to the last bin, exactly like the scalar bisect loop used so far.
+
+    Args:
+        feats (numpy.ndarray): Feature matrix (frames x feat_dim).
+        sig_bins (numpy.ndarray): Bin edges, ``num_bins + 1`` values shared by all dimensions or one row of
+            edges per dimension (feat_dim x num_bins + 1).
+
+    Returns:
+        bin_idx (numpy.ndarray): Bin index for every element of ``feats``.
+
+    '''
+
+    num_bins = sig_bins.shape[-1] - 1
+    if sig_bins.ndim == 1:
+        bin_idx = np.searchsorted(sig_bins, feats, side='left')
+    else:
+        # A single searchsorted on edges offset per dimension is no faster, even at 2000 dimensions: the
+        # binary searches dominate and get longer on the flattened edges, the loop itself is cheap
+        bin_idx = np.empty(feats.shape, dtype=np.int64)
+        for dim in range(feats.shape[1]):
+            bin_idx[:, dim] = np.searchsorted(sig_bins[dim], feats[:, dim], side='left')
+    return np.clip(bin_idx, 1, num_bins) - 1
+
+
+# Ways of placing the bin edges, see get_bin_edges
+BINNINGS = ['global', 'per_dim', 'quantile']
+
+
+def sketch_quantile_edges(counts, width, offset, feat_min, feat_max, num_bins):
+    '''Equal-frequency bin edges of one dimension from its fine histogram
+
+    The counts are assumed to be spread uniformly inside every fine bin, as
+    in StreamingJointHistogram.finalize, so binning the sketch with these
+    edges gives bins of equal mass. The outer edges are the observed minimum
+    and maximum. Point masses give repeated edges, i.e. empty bins.
+
+    Args:
+        counts (numpy.ndarray): Counts of the fine bins.
+        width (float): Width of the fine bins.
+        offset (int): Grid index of the first fine bin.
+        feat_min (float): Smallest value seen.
+        feat_max (float): Largest value seen.
+        num_bins (int): Number of bins.
+
+    Returns:
+        sig_bins (numpy.ndarray): ``num_bins + 1`` non-decreasing edges.
+
+    '''
+
+    counts = np.asarray(counts, dtype=np.float64)
+    cum_counts = np.concatenate([[0], np.cumsum(counts)])
+    targets = np.linspace(0, cum_counts[-1], num_bins + 1)
+    # Fine bin holding every target quantile and the position inside it
+    idx = np.clip(np.searchsorted(cum_counts, targets, side='left') - 1, 0, len(counts) - 1)
+    frac = (targets - cum_counts[idx]) / np.maximum(counts[idx], 1)
+    sig_bins = np.clip((offset + idx + frac) * width, feat_min, feat_max)
+    sig_bins[0], sig_bins[-1] = feat_min, feat_max
+    return np.maximum.accumulate(sig_bins)
+
+
+def get_bin_edges(binning, num_bins, sketch):
+    '''Bin edges of a binning strategy
+
+    global: num_bins equal bins between the global minimum and maximum, the
+        same edges for every dimension.
+    per_dim: num_bins equal bins between the minimum and maximum of every
+        dimension.
+    quantile: num_bins equal-frequency bins of every dimension.
+
+    Args:
+        binning (str): One of BINNINGS.
+        num_bins (int): Number of bins.
+        sketch (StreamingJointHistogram): Feature range and fine histogram, e.g. written by compute_minmax.py
+            or merged from streaming dumps. The quantiles are taken from its first shift, summed over labels.
+
+    Returns:
+        sig_bins (numpy.ndarray): Edges, num_bins + 1 values or feat_dim x num_bins + 1 with per dimension
+            edges.
+
+    '''
+
+    if binning == 'global':
+        return np.linspace(np.min(sketch.feat_min), np.max(sketch.feat_max), num_bins + 1)
+    elif binning == 'per_dim':
+        return np.linspace(sketch.feat_min, sketch.feat_max, num_bins + 1, axis=1)
+    elif binning == 'quantile':
+        counts = np.sum(sketch.counts[0], axis=-1)
+        return np.stack([sketch_quantile_edges(counts[dim], sketch.width[dim], sketch.offset[dim],
+                                               sketch.feat_min[dim], sketch.feat_max[dim], num_bins)
+                         for dim in range(counts.shape[0])])
+    raise ValueError('Invalid binning {:s}, it should be one of {:s}'.format(binning, ', '.join(BINNINGS)))
+
+
+def shift_segments(num_rows, num_frames, shift, exclude_wrap=False):
+    '''Contiguous pieces of the rows that np.roll(feats, shift, axis=0)[:num_frames] would take
+
+    Args:
+        num_rows (int): Number of feature rows.
+        num_frames (int): Number of labelled frames.
+        shift (int): Shift along the time axis.
+        exclude_wrap (bool): Leave out the frames that np.roll wraps around from the other end.
+
+    Returns:
+        segments (list): (first frame, end frame, first source row) of every piece.
+
+    '''
+
+    if exclude_wrap:
+        start, end = max(0, shift), min(num_frames, num_rows + shift)
+        return [(start, end, start - shift)] if start < end else []
+    segments = []
+    t = 0
+    while t < num_frames:
+        src = (t - shift) % num_rows
+        n = min(num_frames - t, num_rows - src)
+        segments.append((t, t + n, src))
+        t += n
+    return segments
+
+
+def accumulate_shifted_histogram(dist, bin_idx, labels, shifts, exclude_wrap=False):
+    '''Add one utterance at every shift to a (num_shifts, feat_dim, num_bins, num_labels) histogram
+
+    The features are binned once, every shift reads its rows from the same
+    bin index matrix through offset slices, and the cells of all shifts are
+    counted in one scatter-add.
+
+    Args:
+        dist (numpy.ndarray): Histogram, updated in place.
+        bin_idx (numpy.ndarray): Bin indices of the unshifted features (frames x feat_dim).
+        labels (numpy.ndarray): Label column of every frame, -num_labels to num_labels - 1.
+        shifts (list): Shifts of the features along the time axis, as np.roll.
+        exclude_wrap (bool): Do not count frames whose shifted features wrap around the utterance.
+
+    Raises:
+        ValueError: If a label is out of range, nothing is added then.
+
+    '''
+
+    num_shifts, feat_dim, num_bins, num_labels = dist.shape
+    num_frames = min(len(labels), bin_idx.shape[0])
+    labels = np.asarray(labels[:num_frames], dtype=np.int64)
+    # Out of range labels would land in the cells of other bins or dimensions
+    if num_frames > 0 and (np.min(labels) < -num_labels or np.max(labels) >= num_labels):
+        raise ValueError('Labels must be between {:d} and {:d}, found {:d} to {:d}'.format(
+            -num_labels, num_labels - 1, int(np.min(labels)), int(np.max(labels))))
+    # Negative labels wrap around like plain numpy indexing does
+    labels = np.where(labels < 0, labels + num_labels, labels)
+    # Cell of every (row, dimension) without the label and shift offsets
+    base = (np.arange(feat_dim) * num_bins + bin_idx[:, :feat_dim]) * num_labels
+    cells = []
+    for sh_idx, sh in enumerate(shifts):
+        offset = sh_idx * feat_dim * num_bins * num_labels
+        for start, end, src in shift_segments(bin_idx.shape[0], num_frames, sh, exclude_wrap):
+            cells.append((base[src:src + end - start] + (labels[start:end, np.newaxis] + offset)).ravel())
+    if not cells:
+        return
+    cells = np.concatenate(cells)
+    if cells.size >= dist.size // 8:
+        # Dense enough that counting every cell is cheaper than sorting
+        dist += np.bincount(cells, minlength=dist.size).reshape(dist.shape).astype(dist.dtype)
+    else:
+        cells, counts = np.unique(cells, return_counts=True)
+        dist[np.unravel_index(cells, dist.shape)] += counts.astype(dist.dtype)
+
+
+def update_joint_distribution(dist, feats, labels, sig_bins, shifts, exclude_wrap=False):
+    '''Bin one utterance and add it to a (num_shifts, feat_dim, num_bins, num_labels) histogram
+
+    Args:
+        dist (numpy.ndarray): Histogram, updated in place.
+        feats (numpy.ndarray): Feature matrix (frames x feat_dim).
+        labels (numpy.ndarray): Label column of every frame.
+        sig_bins (numpy.ndarray): Bin edges, shared or per dimension.
+        shifts (list): Shifts of the features along the time axis.
+        exclude_wrap (bool): Do not count frames whose shifted features wrap around the utterance.
+
+    '''
+
+    feat_dim = dist.shape[1]
+    accumulate_shifted_histogram(dist, get_bin_indices(feats[:, :feat_dim], sig_bins), labels, shifts,
+                                 exclude_wrap=exclude_wrap)
+
+
+def _promote_counts(counts, num_frames):
+    '''Switch to 64 bit counts once a cell could overflow the current dtype'''
+
+    if counts.dtype.kind == 'u' and num_frames > np.iinfo(counts.dtype).max:
+        return counts.astype(np.uint64)
+    return counts
+
+
+class JointHistogram(object):
+    '''Joint feature-label histogram with fixed bin edges
+
+    Counts are kept as uint32 and promoted to uint64 only when the number of
+    frames could overflow a cell.
+
+    Args:
+        sig_bins (numpy.ndarray): Bin edges, shared by all dimensions or one row per dimension.
+        shifts (list): Shifts of the features along the time axis.
+        feat_dim (int): Feature dimension.
+        num_labels (int): Number of label columns.
+        labels (numpy.ndarray): Label of every column, defaults to the column index.
+        exclude_wrap (bool): Do not count frames whose shifted features wrap around the utterance.
+
+    '''
+
+    def __init__(self, sig_bins, shifts, feat_dim, num_labels, labels=None, exclude_wrap=False):
+        self.sig_bins = np.asarray(sig_bins, dtype=np.float64)
+        self.shifts = list(shifts)
+        self.exclude_wrap = exclude_wrap
+        self.labels = np.arange(num_labels) if labels is None else np.asarray(labels)
+        self.counts = np.zeros((len(self.shifts), feat_dim, self.sig_bins.shape[-1] - 1, num_labels),
+                               dtype=np.uint32)
+        self.num_frames = 0
+
+    def bin_indices(self, feats):
+        return get_bin_indices(feats[:, :self.counts.shape[1]], self.sig_bins)
+
+    def update(self, feats, labels):
+        '''Add one utterance, labels are the label columns of every frame'''
+
+        self.update_bin_indices(self.bin_indices(feats), labels)
+
+    def update_bin_indices(self, bin_idx, labels):
+        '''Add one utterance binned with sig_bins before, e.g. bin codes read from a BinCodeStore'''
+
+        self.num_frames += min(len(labels), bin_idx.shape[0])
+        self.counts = _promote_counts(self.counts, self.num_frames)
+        accumulate_shifted_histogram(self.counts, bin_idx, labels, self.shifts, exclude_wrap=self.exclude_wrap)
+
+    def check_compatible(self, other):
+        if self.shifts != other.shifts or self.counts.shape != other.counts.shape \
+                or not np.array_equal(self.sig_bins, other.sig_bins) or not np.array_equal(self.labels, other.labels) \
+                or self.exclude_wrap != other.exclude_wrap:
+            raise ValueError('Cannot add histograms with different shifts, shapes, bin edges, labels or wrap handling')
+
+    def __iadd__(self, other):
+        self.check_compatible(other)
+        self.num_frames += other.num_frames
+        self.counts = _promote_counts(self.counts, self.num_frames)
+        self.counts += other.counts.astype(self.counts.dtype)
+        return self
+
+
+def _project_fine_bins(counts, width, offset, new_width, new_offset):
+    '''Move (shifts, fine_bins, labels) counts of one dimension onto a coarser grid'''
+
+    ratio = int(round(new_width / width))
+    target = np.floor_divide(offset + np.arange(counts.shape[1]), ratio) - new_offset
+    # Fine bins falling outside the new window are empty
+    inside = (target >= 0) & (target < counts.shape[1])
+    projected = np.zeros_like(counts)
+    np.add.at(projected, (slice(None), target[inside]), counts[:, inside])
+    return projected
+
+
+class StreamingJointHistogram(object):
+    '''Joint feature-label histogram that does not need the feature range in advance
+
+    Every feature dimension is binned into ``num_fine_bins`` bins of width
+    2**e placed on a grid anchored at zero. Whenever the data outgrows the
+    current range the width is doubled and neighbouring bins are merged, so
+    histograms from different jobs can always be brought onto a common grid
+    and summed. The final bin edges are only fixed in ``finalize``.
+
+    Args:
+        shifts (list): Shifts of the features along the time axis.
+        feat_dim (int): Feature dimension.
+        num_labels (int): Number of label columns.
+        num_fine_bins (int): Number of fine bins kept per dimension.
+        labels (numpy.ndarray): Label of every column, defaults to the column index.
+        exclude_wrap (bool): Do not count frames whose shifted features wrap around the utterance.
+
+    '''
+
+    def __init__(self, shifts, feat_dim, num_labels, num_fine_bins=1024, labels=None, exclude_wrap=False):
+        self.shifts = list(shifts)
+        self.exclude_wrap = exclude_wrap
+        self.labels = np.arange(num_labels) if labels is None else np.asarray(labels)
+        self.counts = np.zeros((len(self.shifts), feat_dim, num_fine_bins, num_labels), dtype=np.uint32)
+        self.num_frames = 0
+        self.width = np.zeros(feat_dim)  # 0 means no data seen yet
+        self.offset = np.zeros(feat_dim, dtype=np.int64)
+        self.feat_min = np.full(feat_dim, np.inf)
+        self.feat_max = np.full(feat_dim, -np.inf)
+
+    def _fit_grid(self, lo, hi, min_width):
+        num_fine_bins = self.counts.shape[2]
+        span = hi - lo
+        if span <= 0:
+            span = max(abs(hi), 1.0) * 2.0 ** -20
+        exponent = int(np.ceil(np.log2(span / num_fine_bins)))
+        if min_width > 0:
+            exponent = max(exponent, int(np.log2(min_width)))
+        while np.floor(hi / np.ldexp(1.0, exponent)) - np.floor(lo / np.ldexp(1.0, exponent)) >= num_fine_bins:
+            exponent += 1
+        width = np.ldexp(1.0, exponent)
+        return width, int(np.floor(lo / width))
+
+    def _extend(self, dim, lo, hi, min_width=0):
+        lo = min(lo, self.feat_min[dim])
+        hi = max(hi, self.feat_max[dim])
+        width, offset = self.width[dim], self.offset[dim]
+        if width > 0 and width >= min_width and offset <= np.floor(lo / width) \
+                and np.floor(hi / width) < offset + self.counts.shape[2]:
+            self.feat_min[dim], self.feat_max[dim] = lo, hi
+            return
+        new_width, new_offset = self._fit_grid(lo, hi, max(width, min_width))
+        if width > 0:
+            self.counts[:, dim] = _project_fine_bins(self.counts[:, dim], width, offset, new_width, new_offset)
+        self.width[dim], self.offset[dim] = new_width, new_offset
+        self.feat_min[dim], self.feat_max[dim] = lo, hi
+
+    def update(self, feats, labels):
+        '''Add one utterance
+
+        Args:
+            feats (numpy.ndarray): Feature matrix (frames x feat_dim).
+            labels (numpy.ndarray): Label column of every frame.
+
+        '''
+
+        feat_dim = self.counts.shape[1]
+        feats = feats[:, :feat_dim]
+        if min(len(labels), feats.shape[0]) == 0:
+            # Nothing to add and no range to extend
+            return
+        for dim, (lo, hi) in enumerate(zip(np.min(feats, axis=0), np.max(feats, axis=0))):
+            self._extend(dim, lo, hi)
+
+        self.num_frames += min(len(labels), feats.shape[0])
+        self.counts = _promote_counts(self.counts, self.num_frames)
+        bin_idx = np.floor(feats / self.width).astype(np.int64) - self.offset
+        accumulate_shifted_histogram(self.counts, bin_idx, labels, self.shifts, exclude_wrap=self.exclude_wrap)
+
+    def check_compatible(self, other):
+        if self.shifts != other.shifts or self.counts.shape != other.counts.shape \
+                or not np.array_equal(self.labels, other.labels) or self.exclude_wrap != other.exclude_wrap:
+            raise ValueError('Cannot merge histograms with different shifts, shapes, labels or wrap handling')
+
+    def merge(self, other):
+        '''Add the counts of another StreamingJointHistogram to this one'''
+
+        self.check_compatible(other)
+        self.num_frames += other.num_frames
+        self.counts = _promote_counts(self.counts, self.num_frames)
+        for dim in np.nonzero(other.width > 0)[0]:
+            self._extend(dim, other.feat_min[dim], other.feat_max[dim], min_width=other.width[dim])
+            self.counts[:, dim] += _project_fine_bins(other.counts[:, dim], other.width[dim], other.offset[dim],
+                                                      self.width[dim], self.offset[dim]).astype(self.counts.dtype)
+
+    def __iadd__(self, other):
+        self.merge(other)
+        return self
+
+    def minmax(self):
+        '''Global minimum and maximum of all the features seen so far'''
+
+        return np.min(self.feat_min), np.max(self.feat_max)
+
+    def finalize(self, sig_bins):
+        '''Re-bin the fine histogram with the final bin edges
+
+        The counts are assumed to be spread uniformly inside every fine bin,
+        i.e. the cumulative counts are linearly interpolated at the final
+        edges. Values outside the edges go to the first and last bins.
+
+        Args:
+            sig_bins (numpy.ndarray): Final bin edges, shared by all dimensions or one row per dimension.
+
+        Returns:
+            dist (numpy.ndarray): Histogram of shape
+                (num_shifts, feat_dim, num_bins, num_labels).
+
+        '''
+
+        num_shifts, feat_dim, num_fine_bins, num_labels = self.counts.shape
+        dist = np.zeros((num_shifts, feat_dim, sig_bins.shape[-1] - 1, num_labels))
+        for dim in np.nonzero(self.width > 0)[0]:
+            edges = sig_bins if sig_bins.ndim == 1 else sig_bins[dim]
+            cum_counts = np.cumsum(self.counts[:, dim], axis=1, dtype=np.float64)
+            cum_counts = np.concatenate([np.zeros((num_shifts, 1, num_labels)), cum_counts], axis=1)
+            # Position of the inner edges in units of fine bins
+            pos = np.clip(edges[1:-1] / self.width[dim] - self.offset[dim], 0, num_fine_bins)
+            idx = np.minimum(np.floor(pos).astype(np.int64), num_fine_bins - 1)
+            frac = (pos - idx)[:, np.newaxis]
+            cum_edges = cum_counts[:, idx] + frac * (cum_counts[:, idx + 1] - cum_counts[:, idx])
+            cum_edges = np.concatenate([np.zeros((num_shifts, 1, num_labels)), cum_edges, cum_counts[:, -1:]], axis=1)
+            dist[:, dim] = np.diff(cum_edges, axis=1)
+        return dist
+
+
+def _memmap_npz_member(filename, name):
+    '''Memory map an uncompressed array stored in an npz file, None if it is compressed'''
+
+    with zipfile.ZipFile(filename) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(filename, 'rb') as fid:
+        fid.seek(info.header_offset)
+        name_len, extra_len = struct.unpack('<HH', fid.read(30)[26:30])
+        fid.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(fid)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fid)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fid)
+        offset = fid.tell()
+    return np.memmap(filename, dtype=dtype, mode='r', shape=shape, order='F' if fortran_order else 'C',
+                     offset=offset)
+
+
+def save_histogram(filename, hist, sparse=False, **extra_fields):
+    '''Write a JointHistogram or StreamingJointHistogram to an npz file
+
+    Dense counts are stored uncompressed so that they can be memory mapped by
+    ``load_histogram``. With ``sparse=True`` only the non-zero cells are
+    stored, as flat indices and counts in a compressed npz file.
+
+    Args:
+        filename (str): Output file.
+        hist: JointHistogram or StreamingJointHistogram.
+        sparse (bool): Store the counts in COO format.
+        extra_fields: Additional arrays to store in the file.
+
+    '''
+
+    fields = {'shifts': np.asarray(hist.shifts, dtype=np.int64), 'num_frames': np.asarray(hist.num_frames),
+              'labels': hist.labels, 'exclude_wrap': np.asarray(hist.exclude_wrap)}
+    fields.update(extra_fields)
+    if isinstance(hist, StreamingJointHistogram):
+        fields.update({'kind': np.asarray('streaming'), 'width': hist.width, 'offset': hist.offset,
+                       'feat_min': hist.feat_min, 'feat_max': hist.feat_max})
+    else:
+        fields.update({'kind': np.asarray('fixed'), 'sig_bins': hist.sig_bins})
+
+    with open(filename, 'wb') as fid:
+        if sparse:
+            cells = np.flatnonzero(hist.counts)
+            np.savez_compressed(fid, coo_cells=cells, coo_counts=hist.counts.reshape(-1)[cells],
+                                shape=np.asarray(hist.counts.shape, dtype=np.int64), **fields)
+        else:
+            np.savez(fid, counts=hist.counts, **fields)
+
+
+def load_histogram(filename, mmap=False):
+    '''Read a histogram written by save_histogram
+
+    Args:
+        filename (str): Histogram file.
+        mmap (bool): Memory map dense counts instead of reading them.
+
+    Returns:
+        hist: JointHistogram or StreamingJointHistogram.
+
+    '''
+
+    with np.load(filename) as data:
+        fields = {key: data[key] for key in data.files if key != 'counts'}
+        counts = None
+        if 'counts' in data.files:
+            if mmap:
+                counts = _memmap_npz_member(filename, 'counts')
+            if counts is None:
+                counts = data['counts']
+    if counts is None:
+        shape = tuple(fields['shape'])
+        counts = np.zeros(np.prod(shape), dtype=fields['coo_counts'].dtype)
+        counts[fields['coo_cells']] = fields['coo_counts']
+        counts = counts.reshape(shape)
+
+    shifts = [int(x) for x in fields['shifts']]
+    # Dumps written before exclude_wrap existed used np.roll
+    exclude_wrap = bool(fields['exclude_wrap']) if 'exclude_wrap' in fields else False
+    if str(fields['kind']) == 'streaming':
+        hist = StreamingJointHistogram(shifts, counts.shape[1], counts.shape[3], num_fine_bins=counts.shape[2],
+                                       labels=fields['labels'], exclude_wrap=exclude_wrap)
+        hist.width, hist.offset = fields['width'], fields['offset']
+        hist.feat_min, hist.feat_max = fields['feat_min'], fields['feat_max']
+    else:
+        hist = JointHistogram(fields['sig_bins'], shifts, counts.shape[1], counts.shape[3], labels=fields['labels'],
+                              exclude_wrap=exclude_wrap)
+    hist.counts = counts
+    hist.num_frames = int(fields['num_frames'])
+    return hist
+
+
+def get_dump_files(out_dir, prefix='', num_jobs=None, exclude=None):
+    '''List the histogram dumps <prefix>.<job>.hist.npz of a directory
+
+    Args:
+        out_dir (str): Dump directory.
+        prefix (str): Only dumps starting with this prefix.
+        num_jobs (int): If given, exactly the dumps of jobs 1 to num_jobs.
+        exclude (str): Absolute path of a file to leave out, e.g. the combined histogram.
+
+    Returns:
+        hist_files (list): Dump files.
+
+    '''
+
+    if num_jobs:
+        hist_files = [os.path.join(out_dir, '{:s}.{:d}.hist.npz'.format(prefix, n)) for n in range(1, num_jobs + 1)]
+        missing = [f for f in hist_files if not os.path.isfile(f)]
+        if missing:
+            raise IOError('{:d} histogram dumps are missing, first one: {:s}'.format(len(missing), missing[0]))
+    else:
+        hist_files = [os.path.join(out_dir, f) for f in sorted(os.listdir(out_dir))
+                      if f.startswith(prefix) and f.endswith('.hist.npz')]
+        hist_files = [f for f in hist_files if os.path.abspath(f) != exclude]
+    if not hist_files:
+        raise IOError('No histogram dumps found in {:s}'.format(out_dir))
+    return hist_files